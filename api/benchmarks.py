@@ -0,0 +1,340 @@
+"""
+Micro-benchmarks for the talker and its helpers. These are not tests, run them by hand:
+
+    PYTHONPATH=thirdparty python -m api.benchmarks [name ...]
+"""
+import os
+import sys
+import timeit
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.common")
+
+__author__ = 'trey'
+
+BENCHMARKS = []
+
+def benchmark(f):
+    BENCHMARKS.append(f)
+    return f
+
+def report(name, seconds, number):
+    print '%-40s %10.2f us/call' % (name, seconds / number * 1000000)
+
+def measure(name, func, number=10000):
+    report(name, min(timeit.repeat(func, number=number, repeat=3)), number)
+
+
+@benchmark
+def dispatch():
+    """Per request overhead of the talker next to a bare Django view."""
+    from django.http import HttpResponse
+    from django.test.client import RequestFactory
+    from api.work.talker import Endpoint
+    from api.work.middleware import critical_middleware
+
+    def bare_view(request):
+        return HttpResponse('{"hello": true}', content_type='application/json')
+
+    class Bare(Endpoint):
+        def get(self, request):
+            return HttpResponse('{"hello": true}', content_type='application/json')
+
+    class Payload(Endpoint):
+        def get(self, request):
+            return {'hello': True}
+
+    request = RequestFactory().get('/', HTTP_ACCEPT='application/json')
+    bare, full = Bare(), Payload(middleware=critical_middleware)
+    bare.compile()
+    full.compile()
+
+    measure('django view', lambda: bare_view(request))
+    measure('endpoint, no middleware', lambda: bare.dispatch(request))
+    measure('endpoint, critical middleware', lambda: full.dispatch(request))
+
+
+@benchmark
+def validation():
+    """DataModel.validate per row and validate_many over a 10k row import."""
+    from api.data import DataModel, CharData, EmailData, IntegerData, BooleanData, SlugData
+
+    class ContactData(DataModel):
+        firstname = CharData(max_length=75)
+        lastname = CharData(max_length=75)
+        email = EmailData()
+        slug = SlugData(default_from='lastname')
+        age = IntegerData(required=False, min_value=0)
+        active = BooleanData(default=True)
+
+    row = {'firstname': 'Trey', 'lastname': 'Smith', 'email': 'trey@example.com', 'age': '30'}
+    rows = [dict(row, age=str(i)) for i in range(10000)]
+    model = ContactData()
+
+    measure('validate', lambda: model.validate(row))
+    measure('validate_many, 10k rows', lambda: model.validate_many(rows), number=1)
+
+
+@benchmark
+def temporal():
+    """DateTimeData parsing against the plain strptime loop it replaced."""
+    import datetime
+    from django.utils import formats
+    from api.data import DateTimeData
+
+    input_formats = formats.get_format_lazy('DATETIME_INPUT_FORMATS')
+    def strptime_loop(value):
+        for format in input_formats:
+            try:
+                return datetime.datetime.strptime(value, format)
+            except ValueError:
+                continue
+
+    iso = [u'2012-%02d-%02d %02d:%02d:%02d' % (m, d, d % 24, m, d) for m in range(1, 13) for d in range(1, 29)]
+    us = [u'%02d/%02d/%d %02d:%02d' % (m, d, 2012, d % 24, m) for m in range(1, 13) for d in range(1, 29)]
+    field = DateTimeData()
+
+    for name, values in (('iso-8601', iso), ('us', us)):
+        measure('strptime loop, %s' % name, lambda: [strptime_loop(v) for v in values], number=10)
+        field._parsed.clear()
+        measure('parse, %s, cold' % name, lambda: ([field.parse(v) for v in values], field._parsed.clear()), number=10)
+        measure('parse, %s, cached' % name, lambda: [field.parse(v) for v in values], number=10)
+
+
+@benchmark
+def negotiation():
+    """Content negotiation with realistic browser and client Accept headers."""
+    import mimeparse
+    from django.test.client import RequestFactory
+    from api.work.middleware import ContentSerializationMiddleware
+
+    headers = (
+        'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8', #Firefox
+        'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8', #Chrome
+        'application/json, text/javascript, */*; q=0.01', #jQuery
+        'image/jpeg, application/x-ms-application, image/gif, application/xaml+xml, */*', #IE
+        'application/json',
+    )
+    middleware = ContentSerializationMiddleware()
+    requests = [RequestFactory().get('/', HTTP_ACCEPT=h) for h in headers]
+    types = middleware.types
+
+    def uncached():
+        for h in headers:
+            mimeparse.best_match(reversed(types), h)
+
+    def cached():
+        for request in requests:
+            middleware.negotiate_format(request)
+
+    measure('mimeparse.best_match, 5 headers', uncached)
+    measure('negotiate_format, 5 headers', cached)
+
+
+@benchmark
+def receive():
+    """Receiving 4-16MB replies, string concatenation against recv_into, and unpacking them."""
+    import socket
+    import struct
+    import threading
+    import bson
+    from pymongo import helpers
+    from pymongo.connection import Connection
+    from pymongo.errors import ConnectionFailure
+
+    def concatenate(length, sock):
+        message = ""
+        while len(message) < length:
+            chunk = sock.recv(length - len(message))
+            if chunk == "":
+                raise ConnectionFailure("connection closed")
+            message += chunk
+        return message
+
+    connection = Connection(_connect=False)
+    receive_into = connection._Connection__receive_data_on_socket
+    document = bson.BSON.encode({'firstname': 'Trey', 'lastname': 'Smith', 'notes': 'x' * 1000})
+
+    for megabytes in (4, 8, 16):
+        count = megabytes * 1024 * 1024 / len(document)
+        reply = struct.pack('<iqii', 0, 0, 0, count) + document * count
+
+        def receiver(recv):
+            def run():
+                a, b = socket.socketpair()
+                writer = threading.Thread(target=b.sendall, args=(reply,))
+                writer.start()
+                received = recv(len(reply), a)
+                writer.join()
+                a.close()
+                b.close()
+                return received
+            return run
+
+        measure('concatenate, %dMB' % megabytes, receiver(concatenate), number=3)
+        run = receiver(receive_into)
+        measure('recv_into, %dMB' % megabytes, run, number=3)
+        received = run()
+        measure('_unpack_response, %dMB' % megabytes, lambda: helpers._unpack_response(received), number=3)
+
+@benchmark
+def decoding():
+    """Pure Python BSON decoding of Contact documents, alone and 1000 at a time, against the slice based decoder."""
+    import datetime
+    import struct
+    import bson
+    from bson.objectid import ObjectId
+    from api.models import Contact, ContactBase
+
+    #The decoder as it was, slicing every embedded document and value out into a copy, for the element types a Contact uses.
+    def sliced_c_string(data, position):
+        end = data.index("\x00", position)
+        return unicode(data[position:end], "utf-8"), end + 1
+
+    def sliced_string(data, position):
+        length = struct.unpack("<i", data[position:position + 4])[0] - 1
+        position += 4
+        return unicode(data[position:position + length], "utf-8"), position + length + 1
+
+    def sliced_object(data, position):
+        obj_size = struct.unpack("<i", data[position:position + 4])[0]
+        return sliced_elements(data[position + 4:position + obj_size - 1]), position + obj_size
+
+    def sliced_array(data, position):
+        obj, position = sliced_object(data, position)
+        result = []
+        i = 0
+        while True:
+            try:
+                result.append(obj[str(i)])
+                i += 1
+            except KeyError:
+                break
+        return result, position
+
+    sliced_getter = {
+        "\x01": lambda data, position: (struct.unpack("<d", data[position:position + 8])[0], position + 8),
+        "\x02": sliced_string,
+        "\x03": sliced_object,
+        "\x04": sliced_array,
+        "\x07": lambda data, position: (ObjectId(data[position:position + 12]), position + 12),
+        "\x08": lambda data, position: (data[position] == "\x01", position + 1),
+        "\x09": lambda data, position: (bson.EPOCH_AWARE + datetime.timedelta(
+            seconds=float(struct.unpack("<q", data[position:position + 8])[0]) / 1000.0), position + 8),
+        "\x0A": lambda data, position: (None, position),
+        "\x10": lambda data, position: (struct.unpack("<i", data[position:position + 4])[0], position + 4),
+        "\x12": lambda data, position: (long(struct.unpack("<q", data[position:position + 8])[0]), position + 8),
+    }
+
+    def sliced_elements(data):
+        result = {}
+        position = 0
+        end = len(data) - 1
+        while position < end:
+            element_type = data[position]
+            key, position = sliced_c_string(data, position + 1)
+            result[key], position = sliced_getter[element_type](data, position)
+        return result
+
+    def sliced_decode_all(data):
+        docs = []
+        position = 0
+        end = len(data) - 1
+        while position < end:
+            obj_size = struct.unpack("<i", data[position:position + 4])[0]
+            docs.append(sliced_elements(data[position + 4:position + obj_size - 1]))
+            position += obj_size
+        return docs
+
+    contact = Contact(
+        contact=ContactBase(email='trey@example.com', firstname='Trey', lastname='Smith', phone='555-0100',
+            addr_street='1 Main St', addr_locality='Springfield', addr_region='IL', addr_country='US', note='x' * 200),
+        custom={'score': 12, 'source': 'import', 'history': [{'at': datetime.datetime(2012, 1, d), 'n': d} for d in range(1, 6)]},
+        tags=['customer', 'vip', 'newsletter'],
+        origin='web',
+        created_on=datetime.datetime(2012, 1, 1),
+        viewed_on=datetime.datetime(2012, 2, 1),
+    )
+    document = bson.BSON.encode(contact.to_mongo())
+    batch = document * 1000
+
+    print '(C extension in use: %s, %d byte documents)' % (bson._use_c, len(document))
+    assert sliced_decode_all(batch) == bson.decode_all(batch)
+    measure('sliced decoder, as it was', lambda: sliced_decode_all(document))
+    measure('BSON.decode', document.decode)
+    measure('sliced decoder, 1000 documents', lambda: sliced_decode_all(batch), number=10)
+    measure('decode_all, 1000 documents', lambda: bson.decode_all(batch), number=10)
+    measure('decode_all, 1000 documents, buffer', lambda: bson.decode_all(buffer(batch)), number=10)
+
+    #A listing that reads 3 of the 20 fields of each contact.
+    from bson.lazy import LazyDocument
+    def listing(documents):
+        return [(d['contact']['email'], d['origin'], d['created_on']) for d in documents]
+    measure('decode_all, 1000 documents, 3 fields', lambda: listing(bson.decode_all(batch)), number=10)
+    measure('lazy, 1000 documents, 3 fields', lambda: listing(LazyDocument.decode_all(batch)), number=10)
+    measure('lazy, 1000 documents, materialize', lambda: [d.materialize() for d in LazyDocument.decode_all(batch)], number=10)
+
+
+@benchmark
+def batches():
+    """Consuming a 50k document batch from a cursor, one at a time and as a whole."""
+    from collections import deque
+    from pymongo.connection import Connection
+
+    docs = [{'n': i} for i in range(50000)]
+    collection = Connection(_connect=False)['benchmarks']['contacts']
+    def cursor():
+        cursor = collection.find()
+        cursor._Cursor__data = deque(docs)
+        cursor._Cursor__killed = True
+        return cursor
+
+    def pop_front():
+        data = list(docs)
+        while data:
+            data.pop(0)
+
+    measure('list.pop(0), as it was', pop_front, number=1)
+    measure('next()', lambda: list(cursor()), number=10)
+    measure('next_batch()', lambda: cursor().next_batch(), number=10)
+
+
+@benchmark
+def prefetch():
+    """Iterating 20 batches with 5ms of simulated network latency and 5ms of work per batch."""
+    import struct
+    import time
+    import bson
+    from pymongo.connection import Connection
+
+    batch = ''.join(bson.BSON.encode({'n': i}) for i in range(100))
+
+    class SlowServer(Connection):
+        def __init__(self):
+            super(SlowServer, self).__init__(_connect=False)
+            self.sent = 0
+
+        def _send_message_with_response(self, message, **kwargs):
+            time.sleep(0.005)
+            self.sent += 1
+            return struct.pack('<iqii', 0, 99 if self.sent < 20 else 0, (self.sent - 1) * 100, 100) + batch
+
+        def close_cursor(self, cursor_id):
+            pass
+
+    def consume(batches):
+        cursor = SlowServer().test.contacts.find().batch_size(100).prefetch(batches)
+        for i, document in enumerate(cursor):
+            if i % 100 == 99:
+                time.sleep(0.005)
+
+    measure('no read ahead', lambda: consume(0), number=3)
+    measure('prefetch(1)', lambda: consume(1), number=3)
+    measure('prefetch(4)', lambda: consume(4), number=3)
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for f in BENCHMARKS:
+        if not names or f.__name__ in names:
+            print '== %s: %s' % (f.__name__, f.__doc__)
+            f()
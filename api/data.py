@@ -1,5 +1,6 @@
 import datetime
 import re
+from copy import copy
 from functools import wraps, partial
 #from decorator import decorator
 from django.core import validators
@@ -8,8 +9,11 @@ from django.forms.util import to_current_timezone, from_current_timezone
 from django.utils import formats
 from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_unicode, force_unicode
-from django.utils.translation import ugettext_lazy as _
+from django.utils.timezone import utc
+from django.utils.translation import ugettext_lazy as _, get_language
+from django.utils.tzinfo import FixedOffset
 from django.core.validators import BaseValidator
+from lib.utilities import LRUCache
 
 
 notspecified = object()
@@ -23,6 +27,7 @@ def validate(model, strict=False):
             return f(*a, **kw)
 
         inner.contract = model
+        inner.strict = strict
 
         return inner
     return wrapper
@@ -84,21 +89,28 @@ class Data(object):
             self.model = model
 
     def clean(self):
-        return self.value
+        return self.clean_value(self.value, getattr(self, 'data', None))
 
-    def get_default(self):
+    def clean_value(self, value, data=None):
+        """
+        Converts value into its python type without touching the field's state, data is the whole
+        payload being validated. Subclasses should override this rather than clean().
+        """
+        return value
+
+    def get_default(self, data=None):
         if callable(self.default):
             return self.default()
         return self.default
 
     def validate(self):
-        errors = []
-
-
+        self.run_validators(self.value)
 
+    def run_validators(self, value):
+        errors = []
         for v in self.validators:
             try:
-                v(self.value)
+                v(value)
             except ValidationError as e:
                 if hasattr(e, 'code') and e.code in self.error_messages:
                     message = self.error_messages[e.code]
@@ -125,8 +137,8 @@ class CharData(Data):
         if max_length is not None:
             self.validators.append(validators.MaxLengthValidator(max_length))
 
-    def clean(self):
-        value = super(CharData, self).clean()
+    def clean_value(self, value, data=None):
+        value = super(CharData, self).clean_value(value, data)
         if value in EMPTY_VALUES:
             return u''
         return smart_unicode(value)
@@ -146,8 +158,8 @@ class IntegerData(Data):
         if min_value is not None:
             self.validators.append(validators.MinValueValidator(min_value))
 
-    def clean(self):
-        value = super(IntegerData, self).clean()
+    def clean_value(self, value, data=None):
+        value = super(IntegerData, self).clean_value(value, data)
         try:
             value = int(str(value))
         except (ValueError, TypeError):
@@ -159,8 +171,8 @@ class FloatData(IntegerData):
         'invalid': _(u'Enter a number.'),
     }
 
-    def clean(self):
-        value = self.value #No super here, because it would convert it to an int.
+    def clean_value(self, value, data=None):
+        #No super here, because it would convert it to an int.
 
         if value in EMPTY_VALUES:
             return None
@@ -179,14 +191,22 @@ class SlugData(CharData):
     default_validators = [validators.validate_slug]
 
     def __init__(self, default_from=None, **kwargs):
+        self.default_from = default_from
         if default_from is not None:
             kwargs['default'] = partial(self.build, default_from)
         super(SlugData, self).__init__(**kwargs)
 
-    def build(self, key):
-        if key not in self.data:
+    def get_default(self, data=None):
+        if self.default_from is not None and data is not None:
+            return self.build(self.default_from, data)
+        return super(SlugData, self).get_default(data)
+
+    def build(self, key, data=None):
+        if data is None:
+            data = self.data
+        if key not in data:
             raise ValidationError(_(u'Cannot build slug from %s' % key))
-        return self.slugify(self.data.get(key))
+        return self.slugify(data.get(key))
 
     @staticmethod
     def slugify(value):
@@ -204,87 +224,188 @@ class ListData(Data):
 class DictData(Data):
     default_validators = [TypeValidator(dict)]
 
+iso_date_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})$')
+iso_time_re = re.compile(r'(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?$')
+iso_datetime_re = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+def parse_iso_date(value):
+    match = iso_date_re.match(value)
+    if match:
+        y, m, d = match.groups()
+        return datetime.date(int(y), int(m), int(d))
+
+def parse_iso_time(value):
+    match = iso_time_re.match(value)
+    if match:
+        h, mi, sec, usec = match.groups()
+        return datetime.time(int(h), int(mi), int(sec or 0), int(usec.ljust(6, '0')) if usec else 0)
+
+def parse_iso_datetime(value):
+    """
+    Parses the ISO-8601 profile we care about, a date, optionally followed by a 'T' or space, a time
+    and a UTC offset. Returns None if value isn't in that shape.
+    """
+    match = iso_datetime_re.match(value)
+    if match is None:
+        date = parse_iso_date(value)
+        if date is not None:
+            return datetime.datetime(date.year, date.month, date.day)
+        return None
+    y, m, d, h, mi, sec, usec, tz = match.groups()
+    if tz is not None:
+        if tz == 'Z':
+            tz = utc
+        else:
+            offset = 60 * int(tz[1:3]) + int(tz[-2:])
+            tz = FixedOffset(-offset if tz[0] == '-' else offset)
+    return datetime.datetime(int(y), int(m), int(d), int(h), int(mi), int(sec or 0),
+        int(usec.ljust(6, '0')) if usec else 0, tz)
+
+
 class BaseTemporalData(Data):
+    """
+    Strings are parsed by ``parse_iso`` first, then by trying ``input_formats`` in order starting with
+    whichever format matched last time. Successful parses are remembered in a small ``LRUCache`` per field.
+
+    Fields are shared by every validation, the cache is thread safe and ``last_format`` is only a hint,
+    so racing parses can at worst try the formats in a different order.
+    """
+    parse_iso = None
+    parse_cache_size = 1024
+
     def __init__(self, input_formats=None, *args, **kwargs):
         super(BaseTemporalData, self).__init__(*args, **kwargs)
         if input_formats is not None:
             self.input_formats = input_formats
+        self.last_format = None
+        self._parsed = LRUCache(self.parse_cache_size)
 
     def strptime(self, value, format):
         raise NotImplementedError()
 
-    def clean(self):
-        value = super(BaseTemporalData, self).clean()
+    def clean_value(self, value, data=None):
+        value = super(BaseTemporalData, self).clean_value(value, data)
         # Try to coerce the value to unicode.
         unicode_value = force_unicode(value, strings_only=True)
         if isinstance(unicode_value, unicode):
             value = unicode_value.strip()
-            # If unicode, try to strptime against each input format.
         if isinstance(value, unicode):
-            for format in self.input_formats:
+            result, format = self.parse(value)
+            if result is not None:
+                return result
+        raise ValidationError(self.error_messages['invalid'])
+
+    def parse(self, value, format=None):
+        """
+        Returns (result, format), format being the input format that matched or None for ISO-8601.
+        result is None if nothing matched. format, if given, is tried before the other input formats,
+        otherwise the last format that matched is.
+        """
+        parsed = self._parsed.get(value)
+        if parsed is not None:
+            return parsed
+
+        if self.parse_iso is not None:
+            try:
+                result = self.parse_iso(value)
+            except ValueError:
+                result = None
+            if result is not None:
+                self._parsed.set(value, (result, None))
+                return result, None
+
+        #Input formats are locale dependent, so are their results.
+        key = (get_language(), value)
+        parsed = self._parsed.get(key)
+        if parsed is not None:
+            return parsed
+
+        parsed = self.parse_formats(value, format or self.last_format)
+        if parsed[0] is not None:
+            self.last_format = parsed[1]
+            self._parsed.set(key, parsed)
+        return parsed
+
+    def parse_formats(self, value, first=None):
+        if first is not None:
+            result = self.parse_format(value, first)
+            if result is not None:
+                return result, first
+
+        for format in self.input_formats:
+            if format == first:
+                continue
+            result = self.parse_format(value, format)
+            if result is not None:
+                return result, format
+        return None, None
+
+    def parse_format(self, value, format):
+        try:
+            return self.strptime(value, format)
+        except ValueError:
+            if format.endswith('.%f'):
+                # Compatibility with datetime in pythons < 2.6.
+                # See: http://docs.python.org/library/datetime.html#strftime-and-strptime-behavior
+                if value.count('.') != format.count('.'):
+                    return None
                 try:
-                    return self.strptime(value, format)
+                    datetime_str, usecs_str = value.rsplit('.', 1)
+                    usecs = int(usecs_str[:6].ljust(6, '0'))
+                    return self.strptime(datetime_str, format[:-3]).replace(microsecond=usecs)
                 except ValueError:
-                    if format.endswith('.%f'):
-                        # Compatibility with datetime in pythons < 2.6.
-                        # See: http://docs.python.org/library/datetime.html#strftime-and-strptime-behavior
-                        if value.count('.') != format.count('.'):
-                            continue
-                        try:
-                            datetime_str, usecs_str = value.rsplit('.', 1)
-                            usecs = int(usecs_str[:6].ljust(6, '0'))
-                            dt = datetime.datetime.strptime(datetime_str, format[:-3])
-                            return dt.replace(microsecond=usecs)
-                        except ValueError:
-                            continue
-        raise ValidationError(self.error_messages['invalid'])
+                    return None
 
 class DateData(BaseTemporalData):
     input_formats = formats.get_format_lazy('DATE_INPUT_FORMATS')
+    parse_iso = staticmethod(parse_iso_date)
     default_error_messages = {
         'invalid': _(u'Enter a valid date.'),
         }
 
-    def clean(self):
+    def clean_value(self, value, data=None):
         """
         Validates that the input can be converted to a date. Returns a Python
         datetime.date object.
         """
-        value = self.value
         if value in EMPTY_VALUES:
             return None
         if isinstance(value, datetime.datetime):
             return value.date()
         if isinstance(value, datetime.date):
             return value
-        return super(DateData, self).clean()
+        return super(DateData, self).clean_value(value, data)
 
     def strptime(self, value, format):
         return datetime.datetime.strptime(value, format).date()
 
 class TimeData(BaseTemporalData):
     input_formats = formats.get_format_lazy('TIME_INPUT_FORMATS')
+    parse_iso = staticmethod(parse_iso_time)
     default_error_messages = {
         'invalid': _(u'Enter a valid time.')
     }
 
-    def clean(self):
+    def clean_value(self, value, data=None):
         """
         Validates that the input can be converted to a time. Returns a Python
         datetime.time object.
         """
-        value = self.value
         if value in EMPTY_VALUES:
             return None
         if isinstance(value, datetime.time):
             return value
-        return super(TimeData, self).clean()
+        return super(TimeData, self).clean_value(value, data)
 
     def strptime(self, value, format):
         return datetime.datetime.strptime(value, format).time()
 
 class DateTimeData(BaseTemporalData):
     input_formats = formats.get_format_lazy('DATETIME_INPUT_FORMATS')
+    parse_iso = staticmethod(parse_iso_datetime)
     default_error_messages = {
         'invalid': _(u'Enter a valid date/time.'),
     }
@@ -294,12 +415,11 @@ class DateTimeData(BaseTemporalData):
 #            value = to_current_timezone(value)
 #        return value
 
-    def clean(self):
+    def clean_value(self, value, data=None):
         """
         Validates that the input can be converted to a datetime. Returns a
         Python datetime.datetime object.
         """
-        value = self.value
         if value in EMPTY_VALUES:
             return None
         if isinstance(value, datetime.datetime):
@@ -315,7 +435,7 @@ class DateTimeData(BaseTemporalData):
             if value[0] in EMPTY_VALUES and value[1] in EMPTY_VALUES:
                 return None
             value = '%s %s' % tuple(value)
-        result = super(DateTimeData, self).clean()
+        result = super(DateTimeData, self).clean_value(value, data)
         return from_current_timezone(result)
 
     def strptime(self, value, format):
@@ -327,12 +447,12 @@ class EmailData(CharData):
     }
     default_validators = [validators.validate_email]
 
-    def clean(self):
-        return super(EmailData, self).clean().strip()
+    def clean_value(self, value, data=None):
+        return super(EmailData, self).clean_value(value, data).strip()
 
 class BooleanData(Data):
-    def clean(self):
-        value = super(BooleanData, self).clean()
+    def clean_value(self, value, data=None):
+        value = super(BooleanData, self).clean_value(value, data)
         if isinstance(value, basestring) and value.lower() in ('false', '0'):
             value = False
         value = bool(value)
@@ -392,46 +512,101 @@ class BaseDataModel(object):
         |   N    |     Y     |    Y    |     N    | USE
         |   N    |     Y     |    Y    |     Y    | USE
         """
-        #If there are name overrides this will fail.
-        d = data.copy()
-        cleaned_data = {}
-        errors = {}
-
-        #Iterate over fields consuming our data as we go.
-        for k, field in self.base_fields.items():
-            v = d.pop(k, notspecified)
+        cleaned_data, errors = self.run_plan(self.get_plan(), data, for_update, strict)
+        if errors:
+            raise ValidationError(errors)
+        return cleaned_data
 
-            field.set(v, data, self)
+    def validate_many(self, rows, for_update=False, strict=False):
+        """
+        Validates a list of dicts with the same rules as validate(). Returns a list of cleaned data,
+        with None in place of rows that failed, and a dict of row index to that row's errors.
+        """
+        plan = self.get_plan()
+        run_plan = self.run_plan
+        results, row_errors = [], {}
+        for i, data in enumerate(rows):
+            cleaned_data, errors = run_plan(plan, data, for_update, strict)
+            if errors:
+                row_errors[i] = ValidationError(errors).message_dict
+                cleaned_data = None
+            results.append(cleaned_data)
+        return results, row_errors
+
+    @classmethod
+    def get_plan(cls):
+        """
+        The plan is compiled once per class, it's a tuple of (name, check) where check is a closure that
+        validates a single field without touching any state shared between requests.
+        """
+        plan = cls.__dict__.get('_validation_plan')
+        if plan is None:
+            plan = tuple((k, compile_field(field)) for k, field in cls.base_fields.items())
+            cls._validation_plan = plan
+        return plan
 
-            #If there is no data and this is an update or there is no default and not required, skip.
-            if v is notspecified and (for_update is True or (field.required is False and field.default is None)):
-                continue
+    @staticmethod
+    def run_plan(plan, data, for_update=False, strict=False):
+        cleaned_data = {}
+        errors = {}
 
+        for k, check in plan:
             try:
-                if field.readonly is True and v is not notspecified:
-                    raise ValidationError(_(u'This field\'s readonly.'))
-
-                #We do some default/require processing here because the output changes based on if a value was specified.
-                if v is notspecified:
-                    if field.default is not None:
-                        field.set(field.get_default())
-                    elif field.required is True:
-                        raise ValidationError(_(u'This field is required.'), code='required')
-
-                field.set(field.clean()) #This does more than just clean the value, it makes the internal state right.
-                field.validate()
-
-                cleaned_data[k] = field.value
+                v = check(data.get(k, notspecified), data, for_update)
+                if v is not notspecified:
+                    cleaned_data[k] = v
             except ValidationError as e:
                 errors[k] = e.messages
 
         #If data wasn't totally consumed in strict mode this is an error.
-        if strict is True and d:
-            errors['__all__'] = _(u'Fields %s were refused' % unicode(data.keys()))
+        if strict is True:
+            names = plan_names(plan)
+            if [k for k in data if k not in names]:
+                errors['__all__'] = [force_unicode(_(u'Fields %s were refused') % unicode(data.keys()))]
 
-        if errors:
-            raise ValidationError(errors)
-        return cleaned_data
+        return cleaned_data, errors
+
+
+def plan_names(plan):
+    return set(k for k, check in plan)
+
+def compile_field(field):
+    """
+    Compiles the required/readonly/default handling described in BaseDataModel.validate for a
+    single field into a closure. It returns the cleaned value, notspecified if the field should
+    be skipped or raises a ValidationError.
+    """
+    readonly, required = field.readonly, field.required
+    has_default = field.default is not None
+    optional = field.required is False and not has_default
+    get_default, run_validators = field.get_default, field.run_validators
+
+    if type(field).clean.im_func is Data.clean.im_func:
+        clean = field.clean_value
+    else:
+        #An old style field that overrides clean(), it has to work on its own copy.
+        def clean(value, data):
+            bound = copy(field)
+            bound.set(value, data)
+            return bound.clean()
+
+    def check(value, data, for_update):
+        #If there is no data and this is an update or there is no default and not required, skip.
+        if value is notspecified:
+            if for_update is True or optional:
+                return notspecified
+            #We do some default/require processing here because the output changes based on if a value was specified.
+            if has_default:
+                value = get_default(data)
+            elif required is True:
+                raise ValidationError(_(u'This field is required.'), code='required')
+        elif readonly is True:
+            raise ValidationError(_(u'This field\'s readonly.'))
+
+        value = clean(value, data)
+        run_validators(value)
+        return value
+    return check
 
 class DataModel(BaseDataModel):
     __metaclass__ = DeclarativeDataMetaclass
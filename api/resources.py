@@ -1,13 +1,19 @@
 from django.conf import settings
 from django.conf.urls import url
 from django.core.exceptions import ValidationError
-from pymongo import Connection
 from tastypie import resources, fields
+from pymongo import ASCENDING, DESCENDING
 from tastypie.authorization import Authorization
 from tastypie.bundle import Bundle
+from tastypie.constants import ALL
+from tastypie.exceptions import InvalidSortError, NotFound
+from tastypie.http import HttpCreated
 from tastypie.utils.urls import trailing_slash
 from tastypie.validation import Validation
 from tastypie.resources import ModelDeclarativeMetaclass
+from tastypie.utils import dict_strip_unicode_keys
+from lib.pymongo_extras import get_connection, bulk_insert
+from lib.tastypie_extras import MongoPaginator, BulkCreateMixin
 
 import logging
 log = logging.getLogger()
@@ -22,11 +28,28 @@ class ModeledValidator(Validation):
         return {}
 
 
-class ModeledResource(resources.Resource):
-    __metaclass__ = ModelDeclarativeMetaclass
+class ModeledDeclarativeMetaclass(ModelDeclarativeMetaclass):
+    def __new__(cls, name, bases, attrs):
+        new_class = super(ModeledDeclarativeMetaclass, cls).__new__(cls, name, bases, attrs)
+        #Swap tastypie's default paginator for one that speaks Mongo, unless Meta picked one.
+        if not hasattr(getattr(new_class, 'Meta', None), 'paginator_class'):
+            new_class._meta.paginator_class = MongoPaginator
+        return new_class
+
+
+class ModeledResource(BulkCreateMixin, resources.Resource):
+    """
+    List requests are compiled into the cursor: ``order_by`` becomes a ``sort``, the page becomes
+    ``skip``/``limit`` (see ``MongoPaginator``) and only the attributes of the resource's fields are
+    fetched. Set ``project_fields = False`` in Meta if dehydration needs more of the document.
+
+    Lists POSTed or PATCHed to the resource are validated with ``validate_many`` and written with batched
+    inserts, see ``BulkCreateMixin``.
+    """
+    __metaclass__ = ModeledDeclarativeMetaclass
 
     def _db(self):
-        connection = Connection(**settings.MONGO_CONNECTION_PARAMS)
+        connection = get_connection(**settings.MONGO_CONNECTION_PARAMS)
         return connection[settings.MONGO_DATABASE]
 
     def _collection(self):
@@ -144,25 +167,155 @@ class ModeledResource(resources.Resource):
         pass
         #return self._collection().find()
 
+    def get_projection(self):
+        """
+        The document keys full_dehydrate() will read, or None for whole documents.
+        """
+        if not getattr(self._meta, 'project_fields', True):
+            return None
+        fields = set(f.attribute for f in self.fields.values() if f.attribute)
+        fields.add(self._lookup_field())
+        return list(fields)
+
     def obj_get_list(self, request=None, **kwargs):
         # Filtering disabled for brevity...
         log.debug('OBJECT LIST')
-        return self._collection().find(kwargs)
+        spec = kwargs
+        paginator_class = self._meta.paginator_class
+        if request is not None and hasattr(paginator_class, 'find_spec'):
+            #A keyset page is a range query, which has to be part of the spec.
+            spec = paginator_class.find_spec(request.GET, self.get_sort(request.GET), spec)
+        return self._collection().find(spec, fields=self.get_projection())
+
+    def get_list(self, request, **kwargs):
+        """
+        Same as tastypie's, except that the paginator comes from ``build_paginator``.
+        """
+        kwargs = self.remove_api_resource_names(kwargs)
+        objects = self.obj_get_list(request=request, **kwargs)
+        sorted_objects = self.apply_sorting(objects, options=request.GET)
+
+        paginator = self.build_paginator(request, sorted_objects, **kwargs)
+        to_be_serialized = paginator.page()
+
+        bundles = [self.build_bundle(obj=obj, request=request) for obj in to_be_serialized['objects']]
+        to_be_serialized['objects'] = [self.full_dehydrate(bundle) for bundle in bundles]
+        to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+        return self.create_response(request, to_be_serialized)
+
+    def build_paginator(self, request, objects, **kwargs):
+        paginator_class = self._meta.paginator_class
+        extra = {}
+        if hasattr(paginator_class, 'find_spec'):
+            #A keyset paginator can't read the sort off the cursor, nor count it past the range.
+            extra = dict(ordering=self.get_sort(request.GET), unbounded=self._collection().find(kwargs))
+        return paginator_class(request.GET, objects, resource_uri=self.get_resource_list_uri(), limit=self._meta.limit, **extra)
+
+    def apply_sorting(self, obj_list, options=None):
+        """
+        Turns ``order_by`` (``field`` or ``-field``, repeatable) into a sort on the cursor.
+        """
+        sort = self.get_sort(options)
+        if not sort:
+            return obj_list
+        return obj_list.sort(sort)
+
+    def get_sort(self, options=None):
+        """
+        The (key, direction) list ``order_by`` in options asks for, empty when it asks for nothing.
+        """
+        if not options or 'order_by' not in options:
+            return []
+
+        if hasattr(options, 'getlist'):
+            order_bits = options.getlist('order_by')
+        else:
+            order_bits = options.get('order_by')
+            if not isinstance(order_bits, (list, tuple)):
+                order_bits = [order_bits]
+
+        sort = []
+        for order_by in order_bits:
+            direction = ASCENDING
+            field_name = order_by
+            if order_by.startswith('-'):
+                direction, field_name = DESCENDING, order_by[1:]
+
+            if not field_name in self.fields:
+                raise InvalidSortError("No matching '%s' field for ordering on." % field_name)
+            if self._meta.ordering != ALL and not field_name in self._meta.ordering:
+                raise InvalidSortError("The '%s' field does not allow ordering." % field_name)
+            if self.fields[field_name].attribute is None:
+                raise InvalidSortError("The '%s' field has no 'attribute' for ordering with." % field_name)
+
+            sort.append((self.fields[field_name].attribute, direction))
+
+        return sort
 
     def obj_get(self, request=None, **kwargs):
         return self._collection().find_one(kwargs)
 
     def obj_create(self, bundle, request=None, **kwargs):
         log.debug('OBJECT CREATE')
-        bundle.obj = RiakObject(initial=kwargs)
-        bundle = self.full_hydrate(bundle)
-        bucket = self._bucket()
-        new_message = bucket.new(bundle.obj.uuid, data=bundle.obj.to_dict())
-        new_message.store()
+        bundle.obj = dict(bundle.data, **kwargs)
+        self._collection().insert(bundle.obj, safe=True)
         return bundle
 
+    def validate_many(self, request, rows):
+        return self._meta.object_class().validate_many(rows)
+
+    def obj_create_many(self, request, rows, **kwargs):
+        log.debug('OBJECT CREATE MANY')
+        docs = [dict(row, **kwargs) for row in rows]
+        results = bulk_insert(self._collection(), docs)
+        return [r if isinstance(r, Exception) else doc for doc, r in zip(docs, results)]
+
+    def post_detail_data(self, request, deserialized, **kwargs):
+        deserialized = self.alter_deserialized_detail_data(request, deserialized)
+        bundle = self.build_bundle(data=dict_strip_unicode_keys(deserialized), request=request)
+        self.is_valid(bundle, request)
+        updated_bundle = self.obj_create(bundle, request=request, **self.remove_api_resource_names(kwargs))
+        location = self.get_resource_uri(updated_bundle)
+
+        if not self._meta.always_return_data:
+            return HttpCreated(location=location)
+        else:
+            updated_bundle = self.full_dehydrate(updated_bundle)
+            updated_bundle = self.alter_detail_data_to_serialize(request, updated_bundle)
+            return self.create_response(request, updated_bundle, response_class=HttpCreated, location=location)
+
     def obj_update(self, bundle, request=None, **kwargs):
-        return self.obj_create(bundle, request, **kwargs)
+        """
+        Sets the bundle's data on the document at the lookup field, other keys of the document are left
+        alone. Raises NotFound when there's no such document, which makes a PUT create it.
+        """
+        log.debug('OBJECT UPDATE')
+        lookup = self._lookup_field()
+        if lookup not in kwargs and isinstance(bundle.obj, dict) and lookup in bundle.obj:
+            kwargs[lookup] = bundle.obj[lookup]
+        if lookup not in kwargs:
+            raise NotFound("No '%s' to update the document by." % lookup)
+
+        spec = {lookup: kwargs[lookup]}
+        changes = dict((k, v) for k, v in bundle.data.items() if k != 'resource_uri' and k != '_id')
+        changes.update(kwargs)
+        changes.pop('_id', None)
+        if changes:
+            result = self._collection().update(spec, {'$set': changes}, safe=True)
+            if not result or not result.get('updatedExisting'):
+                raise NotFound("No document with %s '%s'." % (lookup, kwargs[lookup]))
+        bundle.obj = self._collection().find_one(spec)
+        if bundle.obj is None:
+            raise NotFound("No document with %s '%s'." % (lookup, kwargs[lookup]))
+        return bundle
+
+    def update_in_place(self, request, original_bundle, new_data):
+        #Documents are dicts, they're updated by their lookup field rather than a pk.
+        original_bundle.data.update(**dict_strip_unicode_keys(new_data))
+        self.alter_deserialized_detail_data(request, original_bundle.data)
+        self.is_valid(original_bundle, request)
+        lookup = self._lookup_field()
+        return self.obj_update(original_bundle, request=request, **{lookup: original_bundle.obj[lookup]})
 
     def obj_delete_list(self, request=None, **kwargs):
         self._collection().remove(kwargs)
@@ -223,20 +223,1487 @@ class EndpointTest(TestCase):
         print self.c.get('/t3/', {'id': 302}).content
 
 
+class ConnectionRegistryTest(TestCase):
+    class FakeConnection(object):
+        def __init__(self, **params):
+            self.params = params
 
+        def disconnect(self):
+            pass
 
+    def test_reuse(self):
+        from lib.pymongo_extras import ConnectionRegistry
+        r = ConnectionRegistry(self.FakeConnection)
+        a = r.get(host='a', port=1)
+        self.assertTrue(a is r.get(port=1, host='a'))
+        self.assertFalse(a is r.get(host='b', port=1))
+        self.assertEqual(r.stats, {'connects': 2, 'reuses': 1, 'lock_waits': 0})
 
+    def test_lock_waits(self):
+        import threading
+        from lib.pymongo_extras import ConnectionRegistry
+        r = ConnectionRegistry(self.FakeConnection)
+        r._lock.acquire()
+        t = threading.Thread(target=r.get, kwargs={'host': 'a'})
+        t.start()
+        t.join(0.1)
+        self.assertEqual(r.stats['connects'], 0)
+        r._lock.release()
+        t.join()
+        self.assertEqual(r.stats, {'connects': 1, 'reuses': 0, 'lock_waits': 1})
 
+    def test_fork(self):
+        from lib.pymongo_extras import ConnectionRegistry
+        r = ConnectionRegistry(self.FakeConnection)
+        a = r.get(host='a')
+        r._pid = -1 #Pretend we've been forked.
+        self.assertFalse(a is r.get(host='a'))
+        self.assertEqual(r.stats['connects'], 1)
 
 
+class TranslatorTest(TestCase):
+    def test_dst_per_hour(self):
+        import time
+        from datetime import datetime, timedelta
+        from api.work import translator
+        translator.LocalTimezone._dst_hours.clear()
+        calls = []
+        mktime = time.mktime
+        def counting_mktime(tt):
+            calls.append(tt)
+            return mktime(tt)
+        translator.time.mktime = counting_mktime
+        try:
+            expected = translator.to_utc(datetime(2011, 7, 1, 12, 0))
+            for minute in range(60):
+                self.assertEqual(translator.to_utc(datetime(2011, 7, 1, 12, minute)) - expected,
+                    timedelta(minutes=minute))
+            self.assertEqual(len(calls), 1)
+            translator.to_utc(datetime(2011, 7, 1, 13, 0))
+            self.assertEqual(len(calls), 2)
+        finally:
+            translator.time.mktime = mktime
+
+    def test_resolve(self):
+        from decimal import Decimal
+        from api.work.translator import SimpleTranslator
+        t = SimpleTranslator()
+        self.assertEqual(t.resolve({'a': [1, {'b': (2, Decimal('1.5'))}], 'c': (x for x in [[3]])}),
+            {'a': [1, {'b': [2, '1.5']}], 'c': [[3]]})
+
+    def test_registration_invalidates(self):
+        from decimal import Decimal
+        from api.work.translator import SimpleTranslator, NoTransformer, HIGH_PRIORITY
+        t = SimpleTranslator()
+        self.assertEqual(t.resolve([1]), [1])
+        t.register_type('int', int, lambda x: x * 2, priority=HIGH_PRIORITY)
+        self.assertEqual(t.resolve([1]), [2])
+        self.assertEqual(t.resolve(Decimal(1)), '1')
+        t.unregister_type('dec')
+        self.assertRaises(NoTransformer, t.resolve, Decimal(1))
+
+    def test_profiles(self):
+        from datetime import datetime
+        from api.work.translator import get_json_encoder, utc
+        payload = {'a': datetime(2012, 1, 2, 3, 4, 5, tzinfo=utc)}
+        self.assertEqual(get_json_encoder('compact').encode(payload), '{"a":"2012-01-02 03:04:05+00:00"}')
+        self.assertEqual(get_json_encoder('pretty'), get_json_encoder('nonsense'))
+        self.assertEqual(json.loads(get_json_encoder().encode(payload))['a']['epoch'], 1325473445)
+
+
+class StreamingTest(TestCase):
+    def test_stream(self):
+        from api.work.middleware import ContentSerializationMiddleware
+        from api.work.responses import APIOK
+        m = ContentSerializationMiddleware()
+        m.stream_chunk_size = 2
+        request = RequestFactory().get('/')
+
+        response = m.process_response(request, APIOK(({'i': i} for i in range(5)))())
+        self.assertEqual(json.loads(response.content), [{'i': i} for i in range(5)])
+
+        response = m.process_response(request, APIOK((i for i in ()))())
+        self.assertEqual(json.loads(response.content), [])
+
+        request = RequestFactory().get('/', {'callback': 'cb'})
+        response = m.process_response(request, APIOK((i for i in (1, 2)))())
+        self.assertEqual(response.content, 'cb([1,2])')
+
+
+class DispatchTest(TestCase):
+    class Echo(object):
+        def get(self, request, id=None):
+            return {'id': id}
+
+        def post(self, request, id=None):
+            return None
+
+    def endpoint(self, middleware=()):
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+        return type('EchoEndpoint', (self.Echo, Endpoint), {})(middleware=middleware or critical_middleware)
+
+    def test_dispatch_table(self):
+        e = self.endpoint()
+        e.compile()
+        rf = RequestFactory()
+        self.assertEqual(json.loads(e.dispatch(rf.get('/'), id='x').content), {'id': 'x'})
+        self.assertEqual(e.dispatch(rf.post('/', '{}', content_type='application/json')).status_code, 201)
+        self.assertEqual(e.dispatch(rf.delete('/')).status_code, 501)
+        response = e.dispatch(rf.patch('/'))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response['Allow'], 'get, post, put, delete, options')
+
+    def test_lazy_compile(self):
+        e = self.endpoint()
+        self.assertEqual(e.dispatch(RequestFactory().get('/')).status_code, 200)
+
+    def test_compile_once(self):
+        from api.work.middleware import critical_middleware
+        e = self.endpoint()
+        e.urls
+        table = e._dispatch_table
+        e.urls
+        self.assertTrue(e._dispatch_table is table)
+
+        e.middleware = list(critical_middleware)[:1]
+        e.urls
+        self.assertFalse(e._dispatch_table is table)
+        table = e._dispatch_table
+
+        e.delete = lambda request, id=None: {'deleted': id}
+        e.urls
+        self.assertFalse(e._dispatch_table is table)
+        self.assertEqual(e.dispatch(RequestFactory().delete('/'), id='z').status_code, 200)
+
+    def test_shared_pipeline(self):
+        from api.work.talker import API, get_pipeline
+        from api.work.middleware import critical_middleware
+        api = API((('a', self.endpoint()), ('b', self.endpoint())), critical_middleware)
+        api.urls
+        (_, a), (_, b) = api.endpoints
+        self.assertTrue(a._middleware is b._middleware is get_pipeline(list(critical_middleware)))
+        self.assertEqual(a.dispatch(RequestFactory().get('/'), id='y').status_code, 200)
+
+    def test_timing(self):
+        from api.work.timing import timings
+        from api.work.diagnostics import TimingsEndpoint
+        timings.reset()
+        e = self.endpoint()
+        e.timing = True
+        e.dispatch(RequestFactory().get('/'))
+        stages = timings.snapshot()['EchoEndpoint']
+        for stage in ('total', 'handler', 'normalize', 'request:ContentSerializationMiddleware',
+                      'view:ContractMiddleware', 'response:ContentSerializationMiddleware'):
+            self.assertEqual(stages[stage]['count'], 1)
+
+        diagnostics = TimingsEndpoint()
+        self.assertTrue('EchoEndpoint' in json.loads(diagnostics.dispatch(RequestFactory().get('/')).content))
+        self.assertTrue('handler' in diagnostics.dispatch(RequestFactory().get('/', {'as': 'text'})).content)
+        diagnostics.dispatch(RequestFactory().delete('/'))
+        self.assertEqual(timings.snapshot(), {})
+
+        #Endpoints compiled before the reset keep recording.
+        e.dispatch(RequestFactory().get('/'))
+        self.assertEqual(timings.snapshot()['EchoEndpoint']['handler']['count'], 1)
+
+
+class ValidationPlanTest(TestCase):
+    def test_stateless(self):
+        m = SlugTestModel()
+        m.validate({'t': 'Hello There!'})
+        for field in SlugTestModel.base_fields.values():
+            self.assertFalse(hasattr(field, 'value'))
+
+    def test_validate_many(self):
+        m = FieldBehaviorTestModel()
+        results, errors = m.validate_many([{'ny': 3}, {}, {'ny': 'x', 'nn': 1}])
+        self.assertEqual(results, [{'yy': 10, 'ny': 3, 'yn': 10}, None, None])
+        self.assertEqual(errors, {1: {'ny': [u'This field is required.']}, 2: {'ny': [u'Enter a whole number.']}})
+
+    def test_strict(self):
+        m = IntegerTestModel()
+        self.assertEqual(m.validate({'f': 1}, strict=True), {'f': 1})
+        self.assertRaises(ValidationError, m.validate, {'f': 1, 'g': 2}, strict=True)
+
+    def test_legacy_clean(self):
+        class UpperData(CharData):
+            def clean(self):
+                return self.value.upper()
+
+        class LegacyModel(DataModel):
+            f = UpperData()
+
+        self.assertEqual(LegacyModel().validate({'f': 'abc'}), {'f': 'ABC'})
+        self.assertFalse(hasattr(LegacyModel.base_fields['f'], 'value'))
+
+
+class TemporalDataTest(TestCase):
+    def test_iso(self):
+        import datetime
+        from django.utils.timezone import utc
+        f = DateTimeData()
+        self.assertEqual(f.clean_value(u'2012-01-02T03:04:05.5Z'), datetime.datetime(2012, 1, 2, 3, 4, 5, 500000, utc))
+        self.assertEqual(f.clean_value(u'2012-01-02 03:04:05+01:00').astimezone(utc), datetime.datetime(2012, 1, 2, 2, 4, 5, tzinfo=utc))
+        self.assertEqual(f.clean_value(u'2012-01-02').date(), datetime.date(2012, 1, 2))
+        self.assertEqual(DateData().clean_value(u'2012-01-02'), datetime.date(2012, 1, 2))
+        self.assertEqual(TimeData().clean_value(u'03:04'), datetime.time(3, 4))
+        self.assertEqual(TimeData().clean_value(u'03:04:05.123'), datetime.time(3, 4, 5, 123000))
+        self.assertRaises(ValidationError, DateData().clean_value, u'2012-13-02')
+        self.assertRaises(ValidationError, TimeData().clean_value, u'03:04 pm')
+
+    def test_formats(self):
+        import datetime
+        from django.utils import translation
+        f = DateData()
+        self.assertEqual(f.clean_value(u'10/25/2006'), datetime.date(2006, 10, 25))
+        self.assertEqual(f.last_format, '%m/%d/%Y')
+        self.assertEqual(f.parse(u'10/26/2006'), (datetime.date(2006, 10, 26), '%m/%d/%Y'))
+        self.assertEqual(f.parse(u'10/25/06'), (datetime.date(2006, 10, 25), '%m/%d/%y'))
+        self.assertEqual(f.last_format, '%m/%d/%y')
+        self.assertEqual(f.parse(u'10/27/06', '%m/%d/%Y'), (datetime.date(2006, 10, 27), '%m/%d/%y'))
+        self.assertEqual(f.parse(u'2006-10-25'), (datetime.date(2006, 10, 25), None))
+        self.assertEqual(f.parse(u'nonsense'), (None, None))
+        self.assertEqual(f.last_format, '%m/%d/%y')
+
+        f = DateData()
+        f._parsed.max_size = 2
+        for value in (u'10/25/2006', u'10/26/2006', u'10/27/2006'):
+            f.clean_value(value)
+        self.assertEqual(len(f._parsed), 2)
+        self.assertEqual(f._parsed.get((translation.get_language(), u'10/27/2006')), (datetime.date(2006, 10, 27), '%m/%d/%Y'))
+
+
+class ContractTest(TestCase):
+    def test_contract(self):
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+
+        class Contracted(Endpoint):
+            @validate(IntegerTestModel)
+            def get(self, request):
+                return request.cleaned_data
+
+            @validate(IntegerTestModel)
+            def put(self, request):
+                return request.cleaned_data
+
+        e = Contracted(middleware=critical_middleware)
+        rf = RequestFactory()
+        self.assertEqual(json.loads(e.dispatch(rf.get('/', {'f': '1'})).content), {'f': 1})
+        response = e.dispatch(rf.get('/', {'f': 'x'}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['details'], {'f': ['Enter a whole number.']})
+        response = e.dispatch(rf.put('/', json.dumps({'f': 2}), content_type='application/json'))
+        self.assertEqual(json.loads(response.content), {'f': 2})
+        self.assertEqual(e.dispatch(rf.put('/', json.dumps({}), content_type='application/json')).status_code, 400)
+
+    def test_reserved_parameters(self):
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+
+        class Strict(Endpoint):
+            @validate(IntegerTestModel, strict=True)
+            def get(self, request):
+                return request.cleaned_data
+
+        e = Strict(middleware=critical_middleware)
+        rf = RequestFactory()
+        response = e.dispatch(rf.get('/', {'f': '1', 'format': 'json', 'profile': 'compact', 'total_count': 'false'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'f': 1})
+        self.assertEqual(e.dispatch(rf.get('/', {'f': '1', 'g': '2'})).status_code, 400)
+
+
+class NegotiationTest(TestCase):
+    def test_lru(self):
+        from lib.utilities import LRUCache
+        c = LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (1, None, 3))
+
+    def test_determine_format(self):
+        from api.work.middleware import ContentSerializationMiddleware
+        m = ContentSerializationMiddleware()
+        rf = RequestFactory()
+        accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+        self.assertEqual(m.determine_format(rf.get('/', HTTP_ACCEPT=accept)), 'json')
+        self.assertEqual(m.accepted_formats.get(accept), 'json')
+        self.assertEqual(m.determine_format(rf.get('/', HTTP_ACCEPT='text/javascript')), 'jsonp')
+        self.assertEqual(m.determine_format(rf.get('/', HTTP_ACCEPT='INVALID')), 'json')
+        self.assertEqual(m.determine_format(rf.get('/', {'format': 'jsonp'}, HTTP_ACCEPT=accept)), 'jsonp')
+
+        request = rf.get('/')
+        request.api_format = 'jsonp'
+        self.assertEqual(m.determine_format(request), 'jsonp')
+
+
+class RequestDataTest(TestCase):
+    def run_middleware(self, request):
+        from api.work.middleware import RequestVERBHelperMiddleware, ContentSerializationMiddleware
+        RequestVERBHelperMiddleware().process_request(request)
+        ContentSerializationMiddleware().process_request(request)
+        return request
+
+    def test_json_skips_form_parser(self):
+        request = self.run_middleware(RequestFactory().put('/', json.dumps({'a': 1}), content_type='application/json'))
+        self.assertEqual(request.data, {'a': 1})
+        self.assertFalse(hasattr(request, 'PUT'))
+        self.assertFalse(hasattr(request, '_post'))
+
+    def test_lazy(self):
+        from api.work.middleware import ContentSerializationMiddleware
+        calls = []
+
+        class Counting(ContentSerializationMiddleware):
+            def from_json(self, payload, options=None):
+                calls.append(payload)
+                return super(Counting, self).from_json(payload, options)
+
+        request = RequestFactory().post('/', json.dumps({'a': 1}), content_type='application/json')
+        Counting().process_request(request)
+        self.assertEqual(calls, [])
+        self.assertEqual(request.data, {'a': 1})
+        self.assertEqual(request.data, {'a': 1})
+        self.assertEqual(len(calls), 1)
+
+        request = RequestFactory().post('/', json.dumps({'a': 1}), content_type='application/json')
+        Counting().process_request(request)
+        request.data = {'b': 2}
+        self.assertEqual(request.data, {'b': 2})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(RequestFactory().get('/').__class__, request.__class__.__base__)
+
+    def test_form(self):
+        self.assertRaises(Exception, self.run_middleware, RequestFactory().put('/', {'a': '1'}))
+        self.assertRaises(Exception, self.run_middleware, RequestFactory().post('/', {'a': '1'}))
+        self.assertEqual(self.run_middleware(RequestFactory().get('/')).data, {})
+
+
+class FakeCursor(object):
+    """Just enough of pymongo's Cursor to test resources and paginators without a server."""
+    def __init__(self, documents):
+        self.documents = documents
+        self._skip, self._limit, self._sort = 0, 0, None
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def sort(self, sort):
+        self._sort = sort
+        for key, direction in reversed(sort):
+            self.documents = sorted(self.documents, key=lambda d: d.get(key), reverse=direction < 0)
+        return self
+
+    def count(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        end = self._skip + self._limit if self._limit else None
+        return iter(self.documents[self._skip:end])
+
+
+class MongoListTest(TestCase):
+    def test_paginator(self):
+        from lib.tastypie_extras import MongoPaginator
+        docs = [{'i': i} for i in range(5)]
+        page = MongoPaginator({'limit': '2', 'offset': '2'}, FakeCursor(docs), resource_uri='/r/').page()
+        self.assertEqual(list(page['objects']), docs[2:4])
+        self.assertEqual(page['meta']['total_count'], 5)
+        self.assertTrue(page['meta']['next'])
+
+        page = MongoPaginator({'limit': '2', 'offset': '2', 'total_count': 'false'}, FakeCursor(docs), resource_uri='/r/').page()
+        self.assertEqual(page['objects'], docs[2:4])
+        self.assertEqual(page['meta']['total_count'], None)
+        self.assertTrue(page['meta']['next'])
+
+        page = MongoPaginator({'limit': '2', 'offset': '4', 'total_count': 'false'}, FakeCursor(docs), resource_uri='/r/').page()
+        self.assertEqual(page['objects'], docs[4:])
+        self.assertEqual(page['meta']['next'], None)
+
+    def test_sorting_and_projection(self):
+        from tastypie.exceptions import InvalidSortError
+        from api.resources import ModeledResource
+
+        class Thing(DataModel):
+            a = IntegerData()
+            b = IntegerData()
+
+        class ThingResource(ModeledResource):
+            class Meta:
+                resource_name = 'thing'
+                object_class = Thing
+                ordering = ['a']
+
+        r = ThingResource()
+        self.assertEqual(sorted(r.get_projection()), ['_id', 'a', 'b'])
+        cursor = r.apply_sorting(FakeCursor([{'a': 1}, {'a': 2}]), {'order_by': '-a'})
+        self.assertEqual(cursor._sort, [('a', -1)])
+        self.assertRaises(InvalidSortError, r.apply_sorting, FakeCursor([]), {'order_by': 'b'})
+
+    def test_paginator_class(self):
+        from tastypie.paginator import Paginator
+        from api.resources import ModeledResource
+        from lib.tastypie_extras import MongoPaginator
+
+        class DefaultResource(ModeledResource):
+            class Meta:
+                resource_name = 'default'
+
+        class PlainResource(ModeledResource):
+            class Meta:
+                resource_name = 'plain'
+                paginator_class = Paginator
+
+        self.assertTrue(DefaultResource()._meta.paginator_class is MongoPaginator)
+        self.assertTrue(PlainResource()._meta.paginator_class is Paginator)
+
+    def test_keyset_paginator(self):
+        from api.resources import ModeledResource
+        from lib.tastypie_extras import KeysetPaginator
+
+        class Thing(DataModel):
+            a = IntegerData()
+
+        class ThingResource(ModeledResource):
+            class Meta:
+                resource_name = 'thing'
+                object_class = Thing
+                ordering = ['a']
+                paginator_class = KeysetPaginator
+
+        docs = [{'_id': i, 'a': i % 3} for i in range(5)]
+        r = ThingResource()
+        collection = FakeCollection()
+        collection.find = lambda spec, fields=None: KeysetCursor(docs, spec)
+        r._collection = lambda: collection
+        r.get_resource_list_uri = lambda: '/thing/'
+
+        request = RequestFactory().get('/', {'order_by': '-a', 'limit': '2', 'total_count': 'true'})
+        paginator = r.build_paginator(request, r.apply_sorting(r.obj_get_list(request), request.GET))
+        self.assertEqual(paginator.ordering, [('a', -1)])
+        page = paginator.page()
+        self.assertEqual([d['_id'] for d in page['objects']], [2, 4])
+        self.assertEqual(page['meta']['total_count'], 5)
+
+        request = RequestFactory().get(page['meta']['next'])
+        paginator = r.build_paginator(request, r.apply_sorting(r.obj_get_list(request), request.GET))
+        page = paginator.page()
+        self.assertEqual([d['_id'] for d in page['objects']], [1, 3])
+        self.assertEqual(page['meta']['total_count'], 5)
+
+
+class KeysetCursor(FakeCursor):
+    """A FakeCursor found with a spec, that understands range queries."""
+    def __init__(self, documents, spec=None):
+        super(KeysetCursor, self).__init__(documents)
+        self.spec = spec or {}
+
+    def count(self):
+        return len([d for d in self.documents if self.matches(d, self.spec)])
+
+    def matches(self, doc, spec):
+        for key, condition in spec.items():
+            if key == '$or':
+                if not any(self.matches(doc, c) for c in condition):
+                    return False
+            elif key == '$and':
+                if not all(self.matches(doc, c) for c in condition):
+                    return False
+            elif isinstance(condition, dict):
+                op, value = condition.items()[0]
+                if op == '$ne':
+                    if doc.get(key) == value:
+                        return False
+                elif doc.get(key) is None or not (doc[key] > value if op == '$gt' else doc[key] < value):
+                    return False
+            elif doc.get(key) != condition:
+                return False
+        return True
+
+    def __iter__(self):
+        docs = [d for d in self.documents if self.matches(d, self.spec)]
+        return iter(docs[:self._limit or None])
+
+
+class KeysetPaginatorTest(TestCase):
+    def walk(self, docs, sort, spec=None, **params):
+        from urlparse import parse_qsl
+        from lib.tastypie_extras import KeysetPaginator
+        params.setdefault('limit', '2')
+        pages = []
+        while True:
+            cursor = KeysetCursor(docs, KeysetPaginator.find_spec(params, sort, spec)).sort(sort)
+            page = KeysetPaginator(params, cursor, resource_uri='/r/', ordering=sort, unbounded=KeysetCursor(docs, spec)).page()
+            pages.append(page)
+            if not page['meta']['next']:
+                return pages
+            params = dict(parse_qsl(page['meta']['next'].split('?', 1)[1]))
+
+    def test_walk(self):
+        docs = [{'_id': i, 'a': i // 2} for i in range(7)]
+        pages = self.walk(docs, [('a', -1)])
+        self.assertEqual([len(p['objects']) for p in pages], [2, 2, 2, 1])
+        walked = [d['_id'] for p in pages for d in p['objects']]
+        self.assertEqual(walked, [6, 5, 4, 3, 2, 1, 0])
+        self.assertEqual(pages[0]['meta']['total_count'], None)
+
+        pages = self.walk(docs, [('a', -1)], total_count='true')
+        self.assertEqual([p['meta']['total_count'] for p in pages], [7, 7, 7, 7])
+
+    def test_walk_nulls(self):
+        docs = [{'_id': i, 'a': i % 3 or None} for i in range(7)]
+        del docs[3]['a']
+        for direction in (1, -1):
+            pages = self.walk(docs, [('a', direction)])
+            walked = [d['_id'] for p in pages for d in p['objects']]
+            expected = sorted(docs, key=lambda d: (d.get('a') or 0, d['_id']), reverse=direction < 0)
+            self.assertEqual(walked, [d['_id'] for d in expected])
+
+    def test_find_spec(self):
+        from lib.tastypie_extras import KeysetPaginator
+        docs = [{'_id': i, 'a': i // 2, 'b': i % 2} for i in range(8)]
+        pages = self.walk(docs, [('a', 1)], spec={'a': {'$gt': 0}, 'b': 1})
+        self.assertEqual([d['_id'] for p in pages for d in p['objects']], [3, 5, 7])
+
+        self.assertEqual(KeysetPaginator.find_spec({}, [('a', 1)], {'a': 1}), {'a': 1})
+        token = KeysetPaginator.encode_token([2, 5])
+        spec = KeysetPaginator.find_spec({'after': token}, [('a', 1)], {'a': {'$lt': 4}})
+        self.assertEqual(spec, {'$and': [{'a': {'$lt': 4}}, KeysetPaginator.range_query([('a', 1), ('_id', 1)], [2, 5])]})
+
+    def test_range_query_and_count(self):
+        from lib.tastypie_extras import KeysetPaginator
+        query = KeysetPaginator.range_query([('a', 1), ('_id', -1)], [3, 9])
+        self.assertEqual(query, {'$or': [{'a': {'$gt': 3}}, {'a': 3, '_id': {'$lt': 9}}]})
+        query = KeysetPaginator.range_query([('a', -1), ('_id', -1)], [None, 9])
+        self.assertEqual(query, {'a': None, '_id': {'$lt': 9}})
+        query = KeysetPaginator.range_query([('a', -1), ('_id', 1)], [3, 9])
+        self.assertEqual(query, {'$or': [{'a': {'$lt': 3}}, {'a': None}, {'a': 3, '_id': {'$gt': 9}}]})
+
+        docs = [{'_id': i} for i in range(3)]
+        page = KeysetPaginator({'limit': '5', 'total_count': 'true'}, KeysetCursor(docs), resource_uri='/r/').page()
+        self.assertEqual(page['meta']['total_count'], 3)
+        self.assertEqual(page['meta']['next'], None)
+
+    def test_bad_token(self):
+        from tastypie.exceptions import BadRequest
+        from lib.tastypie_extras import KeysetPaginator
+        self.assertRaises(BadRequest, KeysetPaginator.find_spec, {'after': 'nonsense'}, [], {})
+        token = KeysetPaginator.encode_token([1, 2, 3])
+        self.assertRaises(BadRequest, KeysetPaginator.find_spec, {'after': token}, [('a', 1)], {})
+
+
+class FakeCollection(object):
+    """
+    Enough of a pymongo Collection for bulk inserts, documents with a 'bad' key are rejected. Like
+    Collection.insert, inserts are split into messages (of batch_size documents) and a failure in one of
+    several messages is a BulkInsertError.
+    """
+    class FakeConnection(object):
+        pass
+
+    def __init__(self, batch_size=None, max_bson_size=4 * 1024 * 1024):
+        self.database = self.FakeConnection()
+        self.database.connection = self.FakeConnection()
+        self.database.connection.max_bson_size = max_bson_size
+        self.batch_size = batch_size
+        self.documents, self.inserts = [], []
+
+    def insert(self, docs, safe=False, continue_on_error=False, **kwargs):
+        from bson import BSON
+        from bson.errors import InvalidDocument
+        from pymongo.errors import OperationFailure, BulkInsertError
+        for doc in docs:
+            if len(BSON.encode(doc, check_keys=True)) > self.database.connection.max_bson_size:
+                raise InvalidDocument('too large')
+
+        size = self.batch_size or len(docs)
+        results, failure = [], None
+        for start in range(0, len(docs), size):
+            batch = docs[start:start + size]
+            result = {'ids': [doc['_id'] for doc in batch], 'sent': False, 'error': None}
+            results.append(result)
+            if failure is not None and not continue_on_error:
+                continue
+            result['sent'] = True
+            self.inserts.append(len(batch))
+            for doc in batch:
+                if 'bad' in doc:
+                    result['error'] = failure = OperationFailure('bad document')
+                    if not continue_on_error:
+                        break
+                else:
+                    self.documents.append(doc)
+        if failure is not None:
+            if len(results) == 1:
+                raise failure
+            raise BulkInsertError(str(failure), None, results)
+        return [doc['_id'] for doc in docs]
+
+    def find(self, spec, fields=None):
+        ids = spec['_id']['$in']
+        return [d for d in self.documents if d['_id'] in ids]
+
+    def find_one(self, spec):
+        for d in self.documents:
+            if all(d.get(k) == v for k, v in spec.items()):
+                return d
+
+    def update(self, spec, document, safe=False):
+        d = self.find_one(spec)
+        if d is not None:
+            d.update(document['$set'])
+        return {'updatedExisting': d is not None, 'n': int(d is not None)}
+
+
+class BulkInsertTest(TestCase):
+    def test_unencodable(self):
+        from bson.errors import InvalidDocument
+        from lib.pymongo_extras import bulk_insert
+        collection = FakeCollection(max_bson_size=500)
+        docs = [{'x': 'a' * 100} for i in range(4)] + [{'x': 'a' * 1000}, {'$x': 1}]
+        results = bulk_insert(collection, docs)
+        self.assertEqual(collection.inserts, [4])
+        self.assertEqual(results[:4], [d['_id'] for d in collection.documents])
+        self.assertTrue(all(isinstance(r, InvalidDocument) for r in results[4:]))
+
+    def test_bulk_insert(self):
+        from pymongo.errors import OperationFailure
+        from lib.pymongo_extras import bulk_insert
+        collection = FakeCollection(3)
+        docs = [{'x': 'a' * 100} for i in range(6)]
+        docs[1]['bad'] = True
+        results = bulk_insert(collection, docs)
+        self.assertEqual(collection.inserts, [3, 3])
+        self.assertTrue(isinstance(results[1], OperationFailure))
+        self.assertEqual([r for i, r in enumerate(results) if i != 1], [d['_id'] for d in collection.documents])
+
+        collection = FakeCollection(3)
+        results = bulk_insert(collection, [dict(d) for d in docs], continue_on_error=False)
+        self.assertEqual(collection.inserts, [3])
+        self.assertEqual([isinstance(r, OperationFailure) for r in results], [False] + [True] * 5)
+
+    def test_post_list(self):
+        from api.resources import ModeledResource
+
+        class Thing(DataModel):
+            a = IntegerData()
+
+        class ThingResource(ModeledResource):
+            class Meta:
+                resource_name = 'thing'
+                object_class = Thing
+
+        collection = FakeCollection()
+        r = ThingResource()
+        r._collection = lambda: collection
+        r.get_resource_uri = lambda obj: '/thing/%s/' % obj['_id']
+
+        from tastypie.exceptions import ImmediateHttpResponse
+        request = RequestFactory().post('/', json.dumps([{'a': 1}, {'a': 'x'}]), content_type='application/json')
+        try:
+            r.post_list(request)
+            self.fail('Invalid items were accepted.')
+        except ImmediateHttpResponse as e:
+            self.assertEqual(e.response.status_code, 400)
+            self.assertEqual(json.loads(e.response.content)['errors'].keys(), ['1'])
+        self.assertEqual(collection.documents, [])
+
+        request = RequestFactory().post('/', json.dumps({'objects': [{'a': 1}, {'a': '2'}]}), content_type='application/json')
+        response = r.post_list(request)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([d['a'] for d in collection.documents], [1, 2])
+        self.assertEqual(collection.inserts, [2])
+        self.assertEqual(json.loads(response.content)['objects'][1]['resource_uri'], '/thing/%s/' % collection.documents[1]['_id'])
+
+    def test_obj_update(self):
+        from api.resources import ModeledResource
+        from tastypie.bundle import Bundle
+        from tastypie.exceptions import NotFound
 
+        class Thing(DataModel):
+            a = IntegerData()
 
+        class ThingResource(ModeledResource):
+            class Meta:
+                resource_name = 'thing'
+                object_class = Thing
 
+        collection = FakeCollection()
+        collection.documents = [{'_id': 'x', 'a': 1, 'b': 2}]
+        r = ThingResource()
+        r._collection = lambda: collection
 
+        bundle = r.obj_update(Bundle(data={'a': 5, 'resource_uri': '/thing/x/'}), _id='x')
+        self.assertEqual(collection.documents, [{'_id': 'x', 'a': 5, 'b': 2}])
+        self.assertEqual(bundle.obj['a'], 5)
+        self.assertRaises(NotFound, r.obj_update, Bundle(data={'a': 5}), _id='y')
+        self.assertEqual(len(collection.documents), 1)
 
+    def test_patch_list(self):
+        from mongoengine.queryset import DoesNotExist
+        from api.resources import ModeledResource
 
+        class Thing(DataModel):
+            a = IntegerData()
 
+        class ThingResource(ModeledResource):
+            class Meta:
+                resource_name = 'thing'
+                object_class = Thing
 
+            def obj_get(self, request=None, **kwargs):
+                if kwargs['_id'] == 'gone':
+                    raise DoesNotExist()
+                return super(ThingResource, self).obj_get(request, **kwargs)
 
+            def full_dehydrate(self, bundle):
+                #The fields read attributes, the fake collection's documents are plain dicts.
+                bundle.data.update(bundle.obj)
+                return bundle
 
+        collection = FakeCollection()
+        collection.documents = [{'_id': 'x', 'a': 1}]
+        r = ThingResource()
+        r._collection = lambda: collection
+        r.get_resource_uri = lambda obj: '/thing/%s/' % obj['_id']
+        r.lookup_via_uri = lambda uri: {'_id': uri.strip('/').split('/')[-1]}
+
+        objects = [{'resource_uri': '/thing/x/', 'a': 5}, {'resource_uri': '/thing/y/', 'a': '6'},
+                   {'a': 7}, {'resource_uri': '/thing/gone/', 'a': 8}]
+        request = RequestFactory().post('/', json.dumps({'objects': objects}), content_type='application/json')
+        response = r.patch_list(request)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(collection.documents[0], {'_id': 'x', 'a': 5})
+        self.assertEqual([(d['_id'], d['a']) for d in collection.documents[:2] + collection.documents[3:]],
+            [('x', 5), ('y', 6), ('gone', 8)])
+        self.assertEqual(collection.documents[2]['a'], 7)
+        self.assertEqual(collection.inserts, [3])
+        self.assertEqual([o['resource_uri'] for o in json.loads(response.content)['objects']][::2], ['/thing/y/', '/thing/gone/'])
+
+
+class ConditionalTest(TestCase):
+    def test_body_etag(self):
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+
+        class Hello(Endpoint):
+            def get(self, request):
+                return {'hello': True}
+
+        e = Hello(middleware=critical_middleware)
+        response = e.dispatch(RequestFactory().get('/'))
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        response = e.dispatch(RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Vary'], 'Accept')
+
+        response = e.dispatch(RequestFactory().get('/', HTTP_IF_NONE_MATCH='"other"'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_up_front(self):
+        import datetime
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+        from api.work.conditional import conditional, version_etag
+
+        updated = datetime.datetime(2012, 3, 1, 12, 0)
+        calls = []
+
+        class Doc(Endpoint):
+            @conditional(etag=lambda self, request: version_etag('doc', updated), last_modified=lambda self, request: updated)
+            def get(self, request):
+                calls.append(1)
+                return {'doc': True}
+
+        e = Doc(middleware=critical_middleware)
+        response = e.dispatch(RequestFactory().get('/'))
+        self.assertEqual(response['ETag'], version_etag('doc', updated))
+        self.assertEqual(len(calls), 1)
+
+        response = e.dispatch(RequestFactory().get('/', HTTP_IF_NONE_MATCH=version_etag('doc', updated)))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept')
+        self.assertEqual(len(calls), 1)
+
+        response = e.dispatch(RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']))
+        self.assertEqual(response.status_code, 304)
+        response = e.dispatch(RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE='Thu, 01 Mar 2012 11:00:00 GMT'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+
+
+    def test_headers_not_shared(self):
+        from api.work.responses import APIOK
+
+        headers = {'X-Thing': 'a'}
+        response = APIOK({}, headers=headers, etag='v1')
+        self.assertEqual(headers, {'X-Thing': 'a'})
+        self.assertEqual(response.headers['ETag'], '"v1"')
+
+
+class ResponseCacheTest(TestCase):
+    def test_endpoint(self):
+        from api.work.talker import Endpoint
+        from api.work.middleware import critical_middleware
+        from api.work.cache import ResponseCache
+        calls = []
+
+        class Things(Endpoint):
+            cache = ResponseCache(ttl=60)
+
+            def get(self, request):
+                calls.append(1)
+                return {'things': len(calls)}
+
+            def post(self, request):
+                self.invalidate_cache()
+
+        e = Things(middleware=critical_middleware)
+        rf = RequestFactory()
+        first = e.dispatch(rf.get('/', {'a': '1', 'b': '2'}))
+        second = e.dispatch(rf.get('/?b=2&a=1'))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(e.dispatch(rf.get('/?b=2&a=1', HTTP_IF_NONE_MATCH=first['ETag'])).status_code, 304)
+
+        e.dispatch(rf.get('/', {'a': '1', 'b': '2', 'format': 'jsonp', 'callback': 'cb'}))
+        self.assertEqual(len(calls), 2)
+
+        e.dispatch(rf.post('/', '{}', content_type='application/json'))
+        e.dispatch(rf.get('/?b=2&a=1'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(Things.cache.stats['hits'], 2)
+        self.assertEqual(Things.cache.stats['invalidations'], 1)
+
+    def test_isolation(self):
+        from api.work.talker import Endpoint, get_pipeline
+        from api.work.middleware import critical_middleware
+        from api.work.cache import ResponseCache
+        from api.work.responses import BadRequest
+        calls = []
+
+        class Things(Endpoint):
+            cache = ResponseCache(ttl=60)
+
+            def get(self, request):
+                calls.append(1)
+                return {'things': len(calls)}
+
+            def post(self, request):
+                self.invalidate_cache()
+
+        class Others(Things):
+            cache = ResponseCache(ttl=60)
+
+        things, others = Things(middleware=critical_middleware), Others(middleware=critical_middleware)
+        rf = RequestFactory()
+        things.dispatch(rf.get('/'))
+        things.dispatch(rf.get('/', HTTP_COOKIE='sessionid=a'))
+        things.dispatch(rf.get('/', HTTP_AUTHORIZATION='Basic eDp5'))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(things.dispatch(rf.get('/', HTTP_COOKIE='sessionid=a')).status_code, 200)
+        self.assertEqual(len(calls), 3)
+
+        #Invalidating one endpoint leaves the others alone.
+        others.dispatch(rf.get('/'))
+        things.dispatch(rf.post('/', '{}', content_type='application/json'))
+        others.dispatch(rf.get('/'))
+        self.assertEqual(len(calls), 4)
+        self.assertNotEqual(Things.cache.prefix, Others.cache.prefix)
+
+        #Request middleware still runs in front of a hit.
+        class Deny(object):
+            def process_request(self, request):
+                return BadRequest('denied')()
+        things.dispatch(rf.get('/'))
+        self.assertEqual(len(calls), 5)
+        denied = Things(middleware=get_pipeline(critical_middleware)._replace(request=(Deny().process_request,)))
+        self.assertEqual(denied.dispatch(rf.get('/')).status_code, 400)
+        self.assertEqual(things.dispatch(rf.get('/')).status_code, 200)
+        self.assertEqual(len(calls), 5)
+
+    def test_backend(self):
+        from api.work.cache import ResponseCache
+        from django.http import HttpResponse
+        backend = 'django.core.cache.backends.locmem.LocMemCache'
+        a, b = ResponseCache(backend=backend, prefix='t'), ResponseCache(backend=backend, prefix='t')
+        request = RequestFactory().get('/x')
+        key = a.make_key(request, 'json')
+        a.set(key, HttpResponse('{}', content_type='application/json'), a.generation())
+
+        response = b.get(key, b.generation())
+        self.assertEqual(response.content, '{}')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(b.stats['backend_hits'], 1)
+
+        a.invalidate()
+        self.assertEqual(b.get(key, b.generation()), None)
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        from api.work.talker import API, Endpoint
+        from api.work.middleware import critical_middleware
+
+        class Hello(Endpoint):
+            def get(self, request):
+                return {'hello': request.GET.get('name', 'world')}
+
+        class Whoami(Endpoint):
+            def get(self, request):
+                from django.utils import translation
+                request.user.seen.append(1)
+                return {'user': id(request.user), 'language': translation.get_language()}
+
+        class Echo(Endpoint):
+            params = ('id',)
+
+            def get(self, request, id):
+                return 'text'
+
+            def post(self, request, id):
+                return dict(request.data, id=id)
+
+        self.api = API((('hello', Hello), ('echo', Echo), ('whoami', Whoami)), critical_middleware)
+        self.api.urls
+
+    def batch(self, data, path='/v1/batch/', location='batch', **attributes):
+        from api.work.talker import BatchEndpoint
+        batch = BatchEndpoint(self.api, middleware=self.api.middleware, location=location)
+        request = RequestFactory().post(path, json.dumps(data), content_type='application/json')
+        for k, v in attributes.items():
+            setattr(request, k, v)
+        response = batch.dispatch(request)
+        return response.status_code, json.loads(response.content)
+
+    def test_batch(self):
+        status, results = self.batch([
+            {'path': 'hello/?name=trey'},
+            {'path': '/v1/echo/5/', 'method': 'POST', 'body': {'a': 1}},
+            {'path': 'echo/6/'},
+            {'path': 'nowhere/'},
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual([r['status'] for r in results], [200, 200, 200, 404])
+        self.assertEqual(results[0]['body'], {'hello': 'trey'})
+        self.assertEqual(results[1]['body'], {'a': 1, 'id': '5'})
+        self.assertEqual(results[2]['body'], 'text')
+        self.assertTrue(results[3]['body']) #Errors are serialized too.
+
+    def test_location(self):
+        for location in ('bulk', None):
+            status, results = self.batch([{'path': '/v1/echo/5/'}, {'path': 'hello/'}], path='/v1/bulk/', location=location)
+            self.assertEqual(status, 200)
+            self.assertEqual([r['status'] for r in results], [200, 200])
+
+    def test_parallel(self):
+        requests = [{'path': 'hello/?name=%d' % i} for i in range(6)]
+        status, results = self.batch({'requests': requests, 'parallel': True})
+        self.assertEqual([r['body']['hello'] for r in results], [str(i) for i in range(6)])
+
+    def test_parallel_state(self):
+        from django.utils import translation
+        class User(object):
+            def __init__(self):
+                self.seen = []
+        user = User()
+        translation.activate('de')
+        try:
+            status, results = self.batch({'requests': [{'path': 'whoami/'}] * 4, 'parallel': True}, user=user)
+        finally:
+            translation.deactivate()
+        self.assertEqual([r['body']['language'] for r in results], ['de'] * 4)
+        self.assertEqual(len(set(r['body']['user'] for r in results)), 4)
+        self.assertEqual(user.seen, [])
+
+    def test_limits(self):
+        status, results = self.batch([{'path': 'hello/'}] * 100)
+        self.assertEqual(status, 400)
+        status, results = self.batch([{'method': 'GET'}])
+        self.assertEqual(status, 400)
+
+
+class PoolTest(TestCase):
+    def make_pool(self, max_size=2, **kwargs):
+        import socket
+        from pymongo.pool import Pool
+        peers = self.peers = []
+        class PairPool(Pool):
+            def connect(self):
+                sock, peer = socket.socketpair()
+                peers.append(peer)
+                return sock
+        return PairPool(('localhost', 27017), max_size, None, None, False, **kwargs)
+
+    def test_shared(self):
+        import threading
+        pool = self.make_pool()
+        sock, authset = pool.get_socket()
+        self.assertTrue(pool.get_socket()[0] is sock) #Nested checkouts get the same socket.
+        pool.return_socket()
+        pool.return_socket()
+
+        seen = []
+        def worker():
+            seen.append(pool.get_socket()[0])
+            pool.return_socket()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertTrue(seen[0] is sock)
+        self.assertEqual(pool.stats['creations'], 1)
+        self.assertEqual(pool.stats['checkouts'], 2)
+
+    def test_wait_timeout(self):
+        import threading
+        from pymongo.errors import ConnectionFailure
+        pool = self.make_pool(max_size=1, wait_queue_timeout=0.05)
+        pool.get_socket()
+
+        errors = []
+        def worker():
+            try:
+                pool.get_socket()
+            except ConnectionFailure as e:
+                errors.append(e)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(pool.stats['timeouts'], 1)
+
+        #A returned socket wakes up a waiting thread.
+        pool.wait_queue_timeout = 5
+        got = []
+        def waiter():
+            got.append(pool.get_socket()[0])
+            pool.return_socket()
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        pool.return_socket()
+        thread.join()
+        self.assertEqual(len(got), 1)
+        self.assertEqual(pool.count, 1)
+
+    def test_eviction(self):
+        pool = self.make_pool(max_idle_time=0)
+        pool.get_socket()
+        pool.return_socket()
+        sock = pool.get_socket()[0]
+        pool.return_socket()
+        self.assertEqual(pool.stats['creations'], 2)
+        self.assertEqual(pool.stats['discards'], 1)
+
+        #Sockets the server closed are replaced on checkout.
+        pool = self.make_pool()
+        pool.check_interval = -1
+        first = pool.get_socket()[0]
+        pool.return_socket()
+        self.peers[0].close()
+        self.assertFalse(pool.get_socket()[0] is first)
+        self.assertEqual(pool.stats['discards'], 1)
+        pool.discard_socket()
+        self.assertEqual(pool.count, 0)
+
+    def test_request(self):
+        pool = self.make_pool()
+        pool.start_request()
+        sock = pool.get_socket()[0]
+        pool.return_socket()
+        self.assertTrue(pool.get_socket()[0] is sock)
+        pool.return_socket()
+        self.assertEqual(pool.sockets, [])
+        pool.end_request()
+        self.assertEqual(len(pool.sockets), 1)
+
+
+    def test_ismaster_failure(self):
+        from pymongo import common
+        from pymongo.connection import Connection
+        from pymongo.errors import OperationFailure
+        from pymongo.replica_set_connection import ReplicaSetConnection
+        pool = self.make_pool(max_size=1)
+        connection = object.__new__(ReplicaSetConnection)
+        connection._ReplicaSetConnection__auth_credentials = {}
+        def unauthorized(sock, dbname, spec):
+            raise OperationFailure('unauthorized')
+        connection._ReplicaSetConnection__simple_command = unauthorized
+        mongo = {'pool': pool, 'last_checkout': 0}
+        self.assertRaises(OperationFailure, connection._ReplicaSetConnection__pooled_is_master, mongo)
+        #The socket went back to the pool instead of staying checked out.
+        self.assertEqual(pool.local.sock_info, None)
+        self.assertEqual(len(pool.sockets), 1)
+
+        self.assertEqual(Connection(_connect=False)._Connection__wait_queue_timeout, common.WAIT_QUEUE_TIMEOUT)
+
+
+class ReceiveTest(TestCase):
+    def test_receive(self):
+        import socket
+        import struct
+        import threading
+        import bson
+        from pymongo import helpers
+        from pymongo.connection import Connection
+        from pymongo.errors import ConnectionFailure
+
+        documents = [{'n': i, 's': 'x' * i} for i in range(200)]
+        body = struct.pack('<iqii', 0, 42, 0, len(documents)) + ''.join(bson.BSON.encode(d) for d in documents)
+        a, b = socket.socketpair()
+        writer = threading.Thread(target=b.sendall, args=(struct.pack('<iiii', 16 + len(body), 0, 7, 1) + body,))
+        writer.start()
+        try:
+            response = Connection(_connect=False)._Connection__receive_message_on_socket(1, 7, a)
+        finally:
+            writer.join()
+        self.assertTrue(isinstance(response, bytearray))
+        result = helpers._unpack_response(response)
+        self.assertEqual(result['cursor_id'], 42)
+        self.assertEqual(result['data'], documents)
+
+        b.close()
+        self.assertRaises(ConnectionFailure, Connection(_connect=False)._Connection__receive_data_on_socket, 16, a)
+        a.close()
+
+
+class BSONDecodeTest(TestCase):
+    def test_round_trip(self):
+        import datetime
+        import re
+        import bson
+        from bson.son import SON
+        from bson.dbref import DBRef
+        from bson.objectid import ObjectId
+        from bson.timestamp import Timestamp
+
+        documents = [
+            {},
+            {'_id': ObjectId(), 'n': 1, 'f': 2.5, 'big': 2 ** 40, 's': u'h\xe9llo', 'none': None, 'yes': True},
+            {'contact': {'email': 'trey@example.com', 'tags': ['a', ['b', {'c': []}]]}, 'empty': {}},
+            {'on': datetime.datetime(2012, 5, 6, 7, 8, 9, 123000), 'ts': Timestamp(5, 6)},
+            {'ref': DBRef('contact', ObjectId()), 'ref2': DBRef('contact', 5, 'db', extra=1)},
+        ]
+        data = ''.join(bson.BSON.encode(d) for d in documents)
+        self.assertEqual(bson.decode_all(data, tz_aware=False), documents)
+        self.assertEqual(bson.decode_all(buffer(data, 0), tz_aware=False), documents)
+        self.assertEqual(bson.decode_all(bytearray(data), tz_aware=False), documents)
+        self.assertEqual([bson.BSON.encode(d).decode() for d in documents], documents)
+
+        decoded = bson.decode_all(data, SON)[2]
+        self.assertTrue(isinstance(decoded['contact'], SON))
+        self.assertTrue(isinstance(decoded['contact']['tags'][1][1], SON))
+
+        pattern = bson.BSON.encode({'re': re.compile('a.b', re.I)}).decode()['re']
+        self.assertEqual((pattern.pattern, pattern.flags & re.I), ('a.b', re.I))
+
+    def test_invalid(self):
+        import bson
+        from bson.errors import InvalidBSON
+
+        data = bson.BSON.encode({'a': {'b': 'c'}, 'd': [1, 2]})
+        self.assertRaises(InvalidBSON, bson.decode_all, data[:-1])
+        self.assertRaises(InvalidBSON, bson.decode_all, data[:-1] + '\x01')
+        self.assertRaises(InvalidBSON, bson.decode_all, data[:8] + '\x7e' + data[9:]) #Bad inner document length.
+        self.assertFalse(bson.is_valid(data + 'x'))
+
+
+class LazyDocumentTest(TestCase):
+    def test_lazy(self):
+        import datetime
+        import bson
+        from bson.lazy import LazyDocument
+        from bson.dbref import DBRef
+        from bson.objectid import ObjectId
+
+        document = {'_id': ObjectId(), 'n': 1, 'on': datetime.datetime(2012, 1, 1),
+            'contact': {'email': 'trey@example.com', 'tags': ['a', {'b': 2}]}, 'owner': DBRef('user', 5)}
+        raw = bson.BSON.encode(document)
+        lazy, other = LazyDocument.decode_all(raw * 2, tz_aware=False)
+        self.assertEqual(lazy.raw, raw)
+        self.assertEqual(lazy['n'], 1)
+        self.assertTrue(isinstance(lazy['contact'], LazyDocument))
+        self.assertTrue(isinstance(lazy['contact']['tags'][1], LazyDocument))
+        self.assertEqual(lazy['owner'], DBRef('user', 5))
+        self.assertEqual(sorted(lazy), sorted(document))
+        self.assertEqual(lazy, document)
+        self.assertEqual(other.materialize(), document)
+        self.assertEqual(type(other.materialize()['contact']), dict)
+
+        lazy['added'] = True
+        del lazy['n']
+        self.assertFalse('n' in lazy)
+        expected = dict(document, added=True)
+        del expected['n']
+        self.assertEqual(bson.BSON.encode(lazy).decode(), expected)
+        self.assertEqual(lazy.raw, raw)
+
+    def test_translate(self):
+        import bson
+        from bson.lazy import LazyDocument
+        from api.work.translator import translator
+
+        lazy = LazyDocument(bson.BSON.encode({'a': {'b': [1, {'c': 2}]}}))
+        self.assertEqual(translator.resolve([lazy]), [{'a': {'b': [1, {'c': 2}]}}])
+
+    def test_write_back(self):
+        import bson
+        from bson.lazy import LazyDocument
+        from pymongo.connection import Connection
+
+        class Recorder(Connection):
+            def __init__(self):
+                super(Recorder, self).__init__(_connect=False)
+                self.messages = []
+
+            def _send_message(self, message, with_last_error=False):
+                self.messages.append(message)
+
+        connection = Recorder()
+        collection = connection.test.contacts
+        lazy = LazyDocument(bson.BSON.encode({'name': 'a'}))
+        _id = collection.insert(lazy)
+        self.assertEqual(lazy['_id'], _id)
+        lazy['name'] = 'b'
+        self.assertEqual(collection.save(lazy), _id)
+        collection.update(LazyDocument(bson.BSON.encode({'_id': _id})), lazy)
+        collection.remove(LazyDocument(bson.BSON.encode({'_id': _id})))
+        self.assertEqual(len(connection.messages), 4)
+        self.assertTrue(bson.BSON.encode({'_id': _id, 'name': 'b'}) in connection.messages[1][1])
+        self.assertTrue(bson.BSON.encode({'_id': _id}) in connection.messages[3][1])
+
+
+class CursorBatchTest(TestCase):
+    def cursor(self, docs):
+        from collections import deque
+        from pymongo.connection import Connection
+        from pymongo.son_manipulator import SONManipulator
+
+        class Tag(SONManipulator):
+            def transform_outgoing(self, son, collection):
+                son['tagged'] = collection.name
+                return son
+
+        db = Connection(_connect=False)['test']
+        db.add_son_manipulator(Tag())
+        cursor = db.contacts.find()
+        #Pretend the query already ran and returned everything.
+        cursor._Cursor__data = deque(docs)
+        cursor._Cursor__killed = True
+        return cursor
+
+    def test_batches(self):
+        cursor = self.cursor([{'n': i} for i in range(5)])
+        self.assertEqual(cursor.next(), {'n': 0, 'tagged': 'contacts'})
+        self.assertEqual(cursor.next_batch(), [{'n': i, 'tagged': 'contacts'} for i in range(1, 5)])
+        self.assertRaises(StopIteration, cursor.next_batch)
+        self.assertRaises(StopIteration, cursor.next)
+
+        cursor = self.cursor([{'n': i} for i in range(3)])
+        self.assertEqual([[d['n'] for d in batch] for batch in cursor.iter_batches()], [[0, 1, 2]])
+        self.assertEqual(list(self.cursor([{'n': 1}, {'n': 2}])), [{'n': 1, 'tagged': 'contacts'}, {'n': 2, 'tagged': 'contacts'}])
+
+
+class CursorPrefetchTest(TestCase):
+    def connection(self, total, fail_at=None, delay=0):
+        import struct
+        import threading
+        import time
+        import bson
+        from pymongo.connection import Connection
+        from pymongo.errors import OperationFailure
+
+        class FakeServer(Connection):
+            """Answers queries and getMores with batches of {'n': i} documents."""
+            def __init__(self):
+                super(FakeServer, self).__init__(_connect=False)
+                self.sent, self.killed, self.threads, self.events = [], [], set(), []
+                self.position = 0
+
+            def _send_message_with_response(self, message, **kwargs):
+                data = message[1]
+                op = struct.unpack_from('<i', data, 12)[0]
+                self.threads.add(threading.current_thread())
+                self.sent.append(op)
+                if fail_at is not None and len(self.sent) == fail_at:
+                    raise OperationFailure('getMore failed')
+                if op == 2004: #Query: flags, name, skip, ntoreturn
+                    start = data.index('\x00', 20) + 1
+                    ntoreturn = struct.unpack_from('<i', data, start + 4)[0]
+                else: #getMore: zero, name, ntoreturn, cursor id
+                    start = data.index('\x00', 20) + 1
+                    ntoreturn = struct.unpack_from('<i', data, start)[0]
+                n = min(ntoreturn or total, total - self.position)
+                docs = ''.join(bson.BSON.encode({'n': i}) for i in range(self.position, self.position + n))
+                starting_from, self.position = self.position, self.position + n
+                cursor_id = 99 if self.position < total else 0
+                if delay and op != 2004:
+                    time.sleep(delay)
+                self.events.append('reply')
+                return struct.pack('<iqii', 0, cursor_id, starting_from, n) + docs
+
+            def close_cursor(self, cursor_id):
+                self.events.append('kill')
+                self.killed.append(cursor_id)
+
+        return FakeServer()
+
+    def test_prefetch(self):
+        import threading
+        connection = self.connection(100)
+        cursor = connection.test.contacts.find().batch_size(10).prefetch(2)
+        self.assertEqual([d['n'] for d in cursor], range(100))
+        self.assertEqual(len(connection.sent), 10)
+        self.assertTrue(len(connection.threads) > 1) #getMores came from the read ahead thread.
+
+        connection = self.connection(100)
+        cursor = connection.test.contacts.find(limit=25).batch_size(10).prefetch(1)
+        self.assertEqual([d['n'] for d in cursor], range(25))
+
+    def test_bounded(self):
+        import time
+        connection = self.connection(1000)
+        cursor = connection.test.contacts.find().batch_size(10).prefetch(2)
+        cursor.next()
+        time.sleep(0.2)
+        #The query, two queued batches and one waiting for room in the queue.
+        self.assertEqual(len(connection.sent), 4)
+        prefetcher = cursor._Cursor__prefetcher
+        cursor.close()
+        prefetcher.thread.join(1)
+        self.assertFalse(prefetcher.thread.is_alive())
+        self.assertEqual(connection.killed, [99])
+        self.assertTrue(len(connection.sent) <= 5)
+        self.assertEqual(len(list(cursor)), 9) #Only what was already returned to the cursor.
+
+    def test_close_waits(self):
+        import time
+        connection = self.connection(1000, delay=0.2)
+        cursor = connection.test.contacts.find().batch_size(10).prefetch(1)
+        cursor.next()
+        time.sleep(0.05) #The first getMore is in flight.
+        prefetcher = cursor._Cursor__prefetcher
+        cursor.close()
+        self.assertFalse(prefetcher.thread.is_alive())
+        self.assertEqual(connection.events[-1], 'kill')
+
+    def test_failure(self):
+        from pymongo.errors import OperationFailure
+        connection = self.connection(100, fail_at=3)
+        cursor = connection.test.contacts.find().batch_size(10).prefetch(1)
+        self.assertEqual([cursor.next()['n'] for i in range(20)], range(20))
+        self.assertRaises(OperationFailure, cursor.next)
+
+
+class InsertBatchTest(TestCase):
+    def connection(self, max_message_size, fail=()):
+        import struct
+        from pymongo.connection import Connection
+        from pymongo.errors import DuplicateKeyError
+
+        class FakeServer(Connection):
+            """Records the number of documents in each insert message, safe ones listed in ``fail`` fail."""
+            def __init__(self):
+                super(FakeServer, self).__init__(_connect=False)
+                self._Connection__max_message_size = max_message_size
+                self.inserts = []
+
+            def _send_message(self, message, with_last_error=False):
+                data = message[1]
+                length = struct.unpack_from('<i', data)[0]
+                position = data.index('\x00', 20) + 1
+                count = 0
+                while position < length:
+                    position += struct.unpack_from('<i', data, position)[0]
+                    count += 1
+                self.inserts.append(count)
+                if with_last_error and len(self.inserts) - 1 in fail:
+                    raise DuplicateKeyError('E11000 duplicate key', 11000)
+                if with_last_error:
+                    return {'ok': 1.0, 'err': None, 'message': len(self.inserts) - 1}
+
+        return FakeServer()
+
+    def test_split(self):
+        connection = self.connection(1000)
+        docs = [{'x': 'a' * 100} for i in range(20)]
+        ids = connection.test.contacts.insert(docs)
+        self.assertEqual(sum(connection.inserts), 20)
+        self.assertTrue(len(connection.inserts) > 1)
+        self.assertEqual(ids, [d['_id'] for d in docs])
+
+        connection = self.connection(100000)
+        connection.test.contacts.insert(docs, safe=True)
+        self.assertEqual(connection.inserts, [20])
+
+    def test_safe(self):
+        from pymongo.errors import BulkInsertError
+        docs = [{'x': 'a' * 100} for i in range(20)]
+        connection = self.connection(1000, fail=(1,))
+        try:
+            connection.test.contacts.insert(docs, safe=True)
+            self.fail('The failed batch was not reported.')
+        except BulkInsertError as e:
+            self.assertEqual(e.code, 11000)
+            self.assertEqual(len(connection.inserts), 2)
+            self.assertEqual([r['sent'] for r in e.results], [True, True] + [False] * (len(e.results) - 2))
+            self.assertEqual([r['error'] is None for r in e.results[:2]], [True, False])
+            self.assertEqual(sum(len(r['ids']) for r in e.results), 20)
+
+        connection = self.connection(1000, fail=(1,))
+        try:
+            connection.test.contacts.insert([dict(d) for d in docs], safe=True, continue_on_error=True)
+            self.fail('The failed batch was not reported.')
+        except BulkInsertError as e:
+            self.assertEqual(sum(connection.inserts), 20)
+            self.assertTrue(all(r['sent'] for r in e.results))
+            self.assertEqual([i for i, r in enumerate(e.results) if r['error'] is not None], [1])
+
+    def test_results(self):
+        docs = [{'x': 'a' * 100} for i in range(20)]
+        connection = self.connection(1000)
+        ids, results = connection.test.contacts.insert(docs, safe=True, return_results=True)
+        self.assertEqual(ids, [d['_id'] for d in docs])
+        self.assertEqual(len(results), len(connection.inserts))
+        self.assertEqual([r['response']['message'] for r in results], range(len(results)))
+        self.assertEqual(sum((r['ids'] for r in results), []), ids)
+        self.assertTrue(all(r['sent'] and r['error'] is None for r in results))
+
+        connection = self.connection(100000)
+        _id, results = connection.test.contacts.insert({'x': 1}, safe=True, return_results=True)
+        self.assertEqual(results, [{'ids': [_id], 'sent': True, 'error': None, 'response': {'ok': 1.0, 'err': None, 'message': 0}}])
+        _id, results = connection.test.contacts.insert({'x': 1}, return_results=True)
+        self.assertEqual(results[0]['response'], None)
+
+    def test_error_class(self):
+        from pymongo.errors import BulkInsertError, DuplicateKeyError
+        docs = [{'x': 'a' * 100} for i in range(20)]
+        for max_message_size in (1000, 100000):
+            connection = self.connection(max_message_size, fail=(0,))
+            self.assertRaises(DuplicateKeyError, connection.test.contacts.insert, [dict(d) for d in docs], safe=True)
+        try:
+            self.connection(1000, fail=(0,)).test.contacts.insert(docs, safe=True)
+            self.fail('The failed batch was not reported.')
+        except BulkInsertError as e:
+            self.assertTrue(isinstance(e, DuplicateKeyError))
+            self.assertEqual(e.code, 11000)
 
+    def test_too_large(self):
+        from bson.errors import InvalidDocument
+        connection = self.connection(1000)
+        connection._Connection__max_bson_size = 500
+        docs = [{'x': 'a' * 100}, {'x': 'a' * 1000}]
+        self.assertRaises(InvalidDocument, connection.test.contacts.insert, docs)
+        self.assertEqual(connection.inserts, [])
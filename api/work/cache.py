@@ -0,0 +1,133 @@
+"""
+An opt-in response cache for GET endpoints. Give an endpoint a ``ResponseCache`` and its GETs are served
+from memory until the entry's TTL runs out or the endpoint calls ``invalidate_cache()`` (do that from the
+write methods). The lookup runs after the request and view middleware, so authentication and contracts are
+still enforced on every GET. Responses are keyed on path, normalized query string, negotiated format and the
+requester's identity (the authenticated user, ``Authorization`` and ``Cookie``), only complete 200s are kept
+and streamed responses never are.
+
+Each endpoint gets its own entries and invalidation generation, the ``prefix`` defaults to the endpoint's
+class path.
+
+Entries live in a size bounded in process LRU and, when a Django cache ``backend`` is named, in that cache
+as well so that processes share them. With a backend the invalidation generation lives there too, so an
+invalidation in one process is seen by every other one at the price of one extra cache lookup per GET.
+"""
+import hashlib
+import threading
+from time import time
+from urllib import urlencode
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+
+from lib.utilities import LRUCache
+
+__author__ = 'trey'
+
+#Settings and Defaults
+API_CACHE_TTL = getattr(settings, 'API_CACHE_TTL', 60)
+API_CACHE_SIZE = getattr(settings, 'API_CACHE_SIZE', 1000)
+API_CACHE_BACKEND = getattr(settings, 'API_CACHE_BACKEND', None)
+
+#Memcached reads anything longer than 30 days as a timestamp.
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+#Headers Django works out again for every response, they're not worth keeping.
+skipped_headers = ('content-length', 'set-cookie')
+
+#Request headers that tell requesters apart.
+identity_headers = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE')
+
+
+class ResponseCache(object):
+    def __init__(self, ttl=API_CACHE_TTL, max_size=API_CACHE_SIZE, backend=API_CACHE_BACKEND, prefix=None):
+        self.ttl = ttl
+        self.local = LRUCache(max_size)
+        self.backend = get_cache(backend) if backend else None
+        self.prefix = prefix
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'hits': 0,
+            'backend_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'invalidations': 0,
+        }
+
+    def generation(self):
+        if self.backend is None:
+            return self._generation
+        key = self.prefix + ':generation'
+        generation = self.backend.get(key)
+        if generation is None:
+            #Never seen or evicted, start somewhere no earlier generation can have been.
+            generation = int(time() * 1000)
+            if not self.backend.add(key, generation, GENERATION_TIMEOUT):
+                generation = self.backend.get(key, generation)
+        return generation
+
+    def invalidate(self):
+        """
+        Forgets every entry, here and (through the generation) in every other process.
+        """
+        with self._lock:
+            self._generation += 1
+            self.local.clear()
+        if self.backend is not None:
+            try:
+                self.backend.incr(self.prefix + ':generation')
+            except ValueError:
+                self.backend.set(self.prefix + ':generation', int(time() * 1000), GENERATION_TIMEOUT)
+        self.stats['invalidations'] += 1
+
+    def make_key(self, request, format):
+        query = urlencode(sorted((k, v) for k in request.GET for v in request.GET.getlist(k)))
+        raw = u'%s?%s|%s' % (request.path, query, format)
+        digest = hashlib.md5(raw.encode('utf-8'))
+        for header in identity_headers:
+            digest.update('|%s' % request.META.get(header, ''))
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            digest.update('|user:%s' % user.pk)
+        return '%s:%s' % (self.prefix, digest.hexdigest())
+
+    def get(self, key, generation):
+        now = time()
+        fresh = lambda entry: entry is not None and entry[0] == generation and entry[1] >= now
+
+        entry = self.local.get(key)
+        if not fresh(entry) and self.backend is not None:
+            entry = self.backend.get(key)
+            if fresh(entry):
+                self.stats['backend_hits'] += 1
+                self.local.set(key, entry)
+
+        if not fresh(entry):
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        status, content, headers = entry[2]
+        response = HttpResponse(content, status=status)
+        for k, v in headers:
+            response[k] = v
+        return response
+
+    def set(self, key, response, generation):
+        """
+        Keeps response under key. generation must be read before the response was built, so that a response
+        built while an invalidation happened is stored as already stale.
+        """
+        if response.status_code != 200 or getattr(response, '_base_content_is_iter', False):
+            return
+        headers = [(k, v) for k, v in response.items() if k.lower() not in skipped_headers]
+        entry = (generation, time() + self.ttl, (response.status_code, response.content, headers))
+        self.local.set(key, entry)
+        if self.backend is not None:
+            self.backend.set(key, entry, self.ttl)
+        self.stats['stores'] += 1
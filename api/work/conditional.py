@@ -0,0 +1,94 @@
+"""
+Conditional GET. A handler that can tell cheaply whether its data changed (a version, an update time)
+should say so up front with ``@conditional``, a matching request then gets a 304 without running the
+handler or the serializer. Everything else is tagged by ``ContentSerializationMiddleware`` with an ETag
+hashed from the encoded body, which still saves the client the download.
+"""
+import hashlib
+from functools import wraps
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, parse_http_date_safe
+
+from responses import APIResponse, APIOK, validator_headers
+
+__author__ = 'trey'
+
+safe_methods = ('GET', 'HEAD')
+
+#The body depends on the negotiated format, so every tagged response varies on these.
+negotiated_headers = ('Accept',)
+
+#Headers a 304 has to repeat from the response it stands in for.
+not_modified_headers = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Vary', 'Content-Location')
+
+def make_etag(content):
+    """A strong ETag for an encoded body."""
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+def version_etag(*parts):
+    """A strong ETag for a version made up of parts, e.g. a document's ``_id`` and update time."""
+    return '"%s"' % hashlib.md5('|'.join(unicode(p).encode('utf-8') for p in parts)).hexdigest()
+
+def not_modified(request, response):
+    """
+    True when the validators on response match the request's ``If-None-Match`` or, failing that,
+    its ``If-Modified-Since``.
+    """
+    if request.method not in safe_methods or response.status_code != 200:
+        return False
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etag = response.get('ETag')
+        if etag is None:
+            return False
+        etags = parse_etags(if_none_match)
+        return '*' in etags or parse_etags(etag)[0] in etags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    last_modified = response.get('Last-Modified')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and parse_http_date_safe(last_modified) <= if_modified_since
+    return False
+
+def not_modified_response(response):
+    not_modified = HttpResponseNotModified()
+    for header in not_modified_headers:
+        if response.has_header(header):
+            not_modified[header] = response[header]
+    return not_modified
+
+def conditional(etag=None, last_modified=None):
+    """
+    Decorates an endpoint method. etag and last_modified are called with the method's arguments and
+    should return a version string (see ``version_etag``) and a datetime, or None when they can't tell.
+    The validators are put on the handler's response as well.
+    """
+    def decorator(method):
+        @wraps(method)
+        def inner(self, request, *args, **kwargs):
+            headers = validator_headers(
+                etag(self, request, *args, **kwargs) if etag else None,
+                last_modified(self, request, *args, **kwargs) if last_modified else None)
+
+            if headers:
+                probe = HttpResponse()
+                for k, v in headers.items():
+                    probe[k] = v
+                patch_vary_headers(probe, negotiated_headers)
+                if not_modified(request, probe):
+                    return not_modified_response(probe)
+
+            response = method(self, request, *args, **kwargs)
+            if isinstance(response, APIResponse):
+                response.headers.update(headers)
+            elif isinstance(response, HttpResponse):
+                for k, v in headers.items():
+                    response[k] = v
+            elif response is not None:
+                response = APIOK(response, headers=headers)
+            return response
+        return inner
+    return decorator
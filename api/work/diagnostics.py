@@ -0,0 +1,28 @@
+"""
+Opt-in endpoints for looking inside a running process. None of these are routed by default, add them
+to an API (ideally behind some authentication) when you need them.
+"""
+from django.http import HttpResponse
+
+from talker import Endpoint
+from timing import timings
+
+__author__ = 'trey'
+
+
+class TimingsEndpoint(Endpoint):
+    """
+    GET returns the per endpoint, per stage latency histograms (``?as=text`` for a plain text table),
+    DELETE clears them.
+    """
+    http_method_names = ['get', 'delete']
+    middleware = ('api.work.middleware.ContentSerializationMiddleware',)
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('as') == 'text':
+            return HttpResponse(timings.as_text(), content_type='text/plain')
+        return timings.snapshot()
+
+    def delete(self, request, *args, **kwargs):
+        timings.reset()
+        return HttpResponse(status=204)
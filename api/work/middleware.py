@@ -1,13 +1,24 @@
+from functools import partial
+from types import GeneratorType
+from django.conf import settings
 from django.core.exceptions import ValidationError
 import mimeparse
-from django.utils.cache import patch_cache_control
+from pymongo.cursor import Cursor
+from lib.utilities import LRUCache
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.translation import gettext as _
-from translator import translator, date_aware_json_decoder, date_aware_json_encoder
+from translator import translator, date_aware_json_decoder, get_json_encoder
+from conditional import safe_methods, negotiated_headers, make_etag, not_modified, not_modified_response
 
-from responses import APIException
+from responses import APIException, BadRequest
 
 __author__ = 'trey'
 
+#Settings and Defaults
+API_STREAM_RESPONSES = getattr(settings, 'API_STREAM_RESPONSES', True)
+API_STREAM_CHUNK_SIZE = getattr(settings, 'API_STREAM_CHUNK_SIZE', 100)
+API_ETAGS = getattr(settings, 'API_ETAGS', True)
+
 #class AuthorizationMiddleware(object):
 #    def process_request(self, request):
 #        pass
@@ -21,16 +32,60 @@ __author__ = 'trey'
 #    def process_exception(self, request, exception):
 #        pass
 
+def declared_content_type(request):
+    return request.META.get('CONTENT_TYPE', 'application/json').split(';')[0]
+
+
+class LazyData(object):
+    """
+    ``request.data``, decoded by the request's ``_decode_data`` the first time it is read and kept from
+    then on. Assigning ``request.data`` replaces it without decoding anything.
+    """
+    def __get__(self, request, owner=None):
+        if request is None:
+            return self
+        try:
+            return request.__dict__['_data']
+        except KeyError:
+            data = request.__dict__['_data'] = request._decode_data()
+            return data
+
+    def __set__(self, request, value):
+        request.__dict__['_data'] = value
+
+_lazy_data_classes = {}
+
+def lazy_data(request, decode):
+    """
+    Gives request a ``data`` attribute that calls decode on first access. Django's requests have no
+    per instance properties, so the request's class becomes a subclass with a ``LazyData``.
+    """
+    cls = type(request)
+    if not isinstance(cls.__dict__.get('data'), LazyData):
+        try:
+            lazy_cls = _lazy_data_classes[cls]
+        except KeyError:
+            lazy_cls = _lazy_data_classes.setdefault(cls, type(cls.__name__, (cls,), {'data': LazyData()}))
+        request.__class__ = lazy_cls
+    request._decode_data = decode
+    return request
+
+
 class RequestVERBHelperMiddleware(object):
     """
     Django doesn't really process anything that isn't a POST. This middleware will make available
     the data from a PUT and a PATCH method.
+
+    Bodies in one of ``ContentSerializationMiddleware.input_types`` are left alone, the serializer
+    decodes those straight from the body and running Django's form parser first is wasted work.
     """
     verbs = ['PUT', 'PATCH']
 
     def process_request(self, request):
         verb = request.method.upper()
         if verb in self.verbs:
+            if declared_content_type(request) in ContentSerializationMiddleware.input_types:
+                return None
             self.convert_post_to_VERB(request, verb)
 
     # Based off of ``piston.utils.coerce_put_post``. Similarly BSD-licensed.
@@ -56,6 +111,28 @@ class RequestVERBHelperMiddleware(object):
 
 
 class ContentSerializationMiddleware(object):
+    """
+    Decodes request bodies into ``request.data`` and encodes ``response.payload`` into the negotiated format.
+
+    Payloads that are generators or pymongo cursors are streamed, the JSON array is produced a chunk
+    at a time while Django iterates the response so that only ``stream_chunk_size`` items are held in
+    memory at once. The status and headers are sent before the first item is read, so an error while
+    iterating can only truncate the body.
+
+    The JSON encoder profile (see ``translator.json_encoders``) can be picked per request with the
+    ``profile`` query parameter, otherwise ``API_JSON_PROFILE`` is used.
+
+    Conditional GETs are answered here (see ``conditional``): validators the handler put on its response
+    are checked before anything is serialized, otherwise 200s to GET and HEAD get an ETag hashed from the
+    encoded body when ``etags`` is on. Streamed bodies aren't known in advance and aren't tagged. Serialized
+    responses vary on ``Accept``, since json and jsonp of the same payload share its validators.
+    """
+    stream = API_STREAM_RESPONSES
+    etags = API_ETAGS
+    stream_chunk_size = API_STREAM_CHUNK_SIZE
+    streamable_types = (GeneratorType, Cursor)
+    accept_cache_size = 64
+
     input_types = {
         'application/json': 'json'
     }
@@ -65,26 +142,35 @@ class ContentSerializationMiddleware(object):
     }
 
     def process_request(self, request):
+        """
+        Makes the body available as ``request.data``. It is decoded the first time ``request.data`` is
+        read (see ``LazyData``), so handlers that never look at it never pay for it. Unsupported types
+        are still refused here. Anything already on ``request.data`` is kept.
+        """
+        if hasattr(request, 'data'):
+            return None
+
         if not len(request.body): #If there is no payload, then don't process it.
             request.data = {}
             return None
 
-        declared_type = request.META.get('CONTENT_TYPE', 'application/json').split(';')[0]
-
+        declared_type = declared_content_type(request)
         if declared_type not in self.input_types:
             raise Exception(_(u'The type %s is not supported.' % declared_type))
 
         #Requires some deserialization.
-        format = self.determine_format(request)
-
-        request.data = getattr(self, "from_%s" % format)(request.body)
-        print request.data
+        decode = getattr(self, "from_%s" % self.input_types[declared_type])
+        lazy_data(request, partial(decode, request.body))
 
     def process_response(self, request, response):
         """
         If "payload" is present in the HTTPResponse then we need to serialize it to the requested type.
         """
         if hasattr(response, 'payload'):
+            patch_vary_headers(response, negotiated_headers)
+            if not_modified(request, response):
+                return not_modified_response(response)
+
             payload = response.payload
             options = request.GET.dict()
             format = self.determine_format(request)
@@ -93,10 +179,20 @@ class ContentSerializationMiddleware(object):
                 response = APIException(_(u"You cannot request a JSONP output without specifying a callback parameter."))()
                 format = 'json'
 
+            if self.stream and isinstance(payload, self.streamable_types):
+                #Items are translated and encoded as the response is iterated.
+                response.content = getattr(self, "stream_%s" % format)(payload, options)
+                return response
+
             #Now, translate values according to specified translator and serialize.
             payload = self.translator.resolve(payload)
             response.content = getattr(self, "to_%s" % format)(payload, options)
 
+            if self.etags and request.method in safe_methods and response.status_code == 200 and not response.has_header('ETag'):
+                response['ETag'] = make_etag(response.content)
+                if not_modified(request, response):
+                    return not_modified_response(response)
+
         return response
 
     #def process_exception(self, request, exception):
@@ -106,27 +202,39 @@ class ContentSerializationMiddleware(object):
         self.formats = set(self.output_types.values())
         self.types = self.output_types.keys()
         self.translator = translator() if callable(translator) else translator
+        self.accepted_formats = LRUCache(self.accept_cache_size)
 
-    def get_json_encoder(self):
-        return date_aware_json_encoder
+    def get_json_encoder(self, profile=None):
+        return get_json_encoder(profile)
 
     def get_json_decoder(self):
         return date_aware_json_decoder
 
     def determine_format(self, request, default_format='json'):
+        """
+        The negotiated format is worked out once per request and kept on ``request.api_format``.
+        """
+        try:
+            return request.api_format
+        except AttributeError:
+            pass
+        request.api_format = format = self.negotiate_format(request, default_format)
+        return format
+
+    def negotiate_format(self, request, default_format='json'):
         # First, check if they forced the format.
         if request.GET.get('format', None) in self.formats:
             return request.GET.get('format')
 
         # Try to use the Accepts header.
-        if request.META.get('HTTP_ACCEPT', '*/*') != '*/*':
-            try:
-                best_format = mimeparse.best_match(reversed(self.types), request.META['HTTP_ACCEPT'])
-                if best_format:
-                    return self.output_types[best_format]
-            except ValueError as e:
-                #Invalid ACCEPT header.
-                pass
+        accept = request.META.get('HTTP_ACCEPT', '*/*')
+        if accept != '*/*':
+            best_format = self.accepted_formats.get(accept, False)
+            if best_format is False:
+                best_format = self.match_accept(accept)
+                self.accepted_formats.set(accept, best_format)
+            if best_format:
+                return best_format
 
         # If callback parameter is present, use JSONP.
         if 'callback' in request.GET and 'jsonp' in self.formats:
@@ -134,9 +242,20 @@ class ContentSerializationMiddleware(object):
 
         return default_format
 
+    def match_accept(self, accept):
+        try:
+            best_format = mimeparse.best_match(reversed(self.types), accept)
+            if best_format:
+                return self.output_types[best_format]
+        except ValueError as e:
+            #Invalid ACCEPT header.
+            pass
+        return None
+
     def to_json(self, payload, options=None):
         #return json.dumps(payload, sort_keys=True)
-        return self.get_json_encoder().encode(payload)
+        options = options or {}
+        return self.get_json_encoder(options.get('profile')).encode(payload)
 
     def from_json(self, payload, options=None):
         #return json.loads(payload)
@@ -150,21 +269,72 @@ class ContentSerializationMiddleware(object):
         options = options or {}
         return '%s(%s)' % (options['callback'], self.to_json(data, options))
 
+    def stream_json(self, payload, options=None):
+        """
+        Given an iterable, yields a JSON array of its translated items in chunks.
+        """
+        options = options or {}
+        encode = self.get_json_encoder(options.get('profile')).encode
+        resolve = self.translator.resolve
+        chunk_size = self.stream_chunk_size
+
+        yield '['
+        chunk, separator = [], ''
+        for item in payload:
+            chunk.append(separator + encode(resolve(item)))
+            separator = ','
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+        yield ']'
+
+    def stream_jsonp(self, payload, options=None):
+        options = options or {}
+        yield '%s(' % options['callback']
+        for chunk in self.stream_json(payload, options):
+            yield chunk
+        yield ')'
+
 
 class ContractMiddleware(object):
     """
     If the view method has a contract attached to it, use it to validate input.
+
+    Query parameters are validated for GET, HEAD and DELETE, ``request.data`` for everything else
+    (PATCH validates as an update). Invalid input gets a BadRequest with the errors before the handler
+    runs, valid input is left on ``request.cleaned_data``. The ``reserved_parameters`` that the API
+    itself reads from the query string are never part of the validated data.
     """
+    query_methods = ('GET', 'HEAD', 'DELETE')
+    reserved_parameters = frozenset(('format', 'callback', 'profile', 'total_count'))
+
+    def __init__(self):
+        self.contracts = {}
+
+    def get_contract(self, view):
+        key = getattr(view, 'im_func', view)
+        try:
+            return self.contracts[key]
+        except KeyError:
+            return self.contracts.setdefault(key, view.contract())
+
     def process_view(self, request, view, kwargs):
-        print view
-        if hasattr(view, 'contract'):
-            print 'SHOULD VALIDATE', view.contract
-            try:
-                print request.data
-                data = view.contract().validate(request.data)
-                print data
-            except ValidationError as e:
-                print e
+        if not hasattr(view, 'contract'):
+            return None
+
+        if request.method in self.query_methods:
+            reserved = self.reserved_parameters
+            data = dict((k, v) for k, v in request.GET.dict().items() if k not in reserved)
+        else:
+            data = getattr(request, 'data', None) or {}
+
+        try:
+            request.cleaned_data = self.get_contract(view).validate(data,
+                for_update=request.method == 'PATCH', strict=getattr(view, 'strict', False))
+        except ValidationError as e:
+            return BadRequest(payload=getattr(e, 'message_dict', None) or e.messages)()
         return None
 
 
@@ -2,9 +2,11 @@
 Exceptions should know how to represent their own data and types. For intance, a bad request exception should
 understand what data to return to the talker so that the user can comprehend the message.
 """
+from calendar import timegm
 from datetime import datetime
 from django.conf import settings
 from django.http import HttpResponse
+from django.utils.http import http_date, quote_etag
 from django.utils.translation import gettext as _
 
 __author__ = 'trey'
@@ -16,11 +18,23 @@ def create_response(payload, status, headers):
         response[k] = v
     return response
 
+def validator_headers(etag=None, last_modified=None):
+    """
+    The ETag and Last-Modified headers for a version string (quoted unless it already is) and a datetime.
+    """
+    headers = {}
+    if etag is not None:
+        headers['ETag'] = etag if etag.startswith('"') else quote_etag(etag)
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+    return headers
+
 class APIResponse(object):
     status = 200
-    def __init__(self, payload='', headers=None):
+    def __init__(self, payload='', headers=None, etag=None, last_modified=None):
         self.payload = payload
-        self.headers = headers or {}
+        self.headers = dict(headers or ())
+        self.headers.update(validator_headers(etag, last_modified))
 
     def __call__(self):
         return create_response(self.payload, self.status, self.headers)
@@ -32,7 +46,7 @@ class APIException(Exception):
     def __init__(self, message=None, payload='', headers=None):
         super(APIException, self).__init__()
         self.payload = payload
-        self.headers = headers or {}
+        self.headers = dict(headers or ())
         if message is not None:
             self.message = message
 
@@ -94,6 +108,10 @@ class BadRequest(APIException):
     status = 400
     message = _(u'Bad Request')
 
+class NotFound(APIException):
+    status = 404
+    message = _(u'Not Found')
+
 class NotAllowed(APIException):
     #:TODO: must have allow header.
     status = 405
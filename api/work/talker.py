@@ -2,22 +2,40 @@
 responsible for breaking down communications, listening to verbs and passing that information to the
 middleware and eventual handler.
 """
+import copy
+import json
+import threading
+from collections import namedtuple
+from cStringIO import StringIO
 from functools import partial
+from multiprocessing.pool import ThreadPool
 from api.work.responses import PlainException
 from django.conf import settings
 from django.conf.urls import url, patterns, include
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.urlresolvers import RegexURLResolver, Resolver404
+from django.db import close_connection
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.utils import translation
+from django.utils.functional import LazyObject, empty
 from django.utils.translation import gettext as _
 from django.utils.importlib import import_module
 
-from responses import APIResponse, APIOK, APIException, NotAllowed, HttpNotImplemented
+from responses import APIResponse, APIOK, APIException, NotAllowed, HttpNotImplemented, BadRequest, NotFound
+from conditional import not_modified, not_modified_response
+from timing import API_TIMING, timings
 
 __author__ = 'trey'
 
 #Settings and Defaults
 API_HANDLE_EXCEPTIONS   = getattr(settings, 'API_HANDLE_EXCEPTIONS', False)
 API_ALLOW_MISSING_SLASH = getattr(settings, 'API_ALLOW_MISSING_SLASH', False)
+API_BATCH_MAX           = getattr(settings, 'API_BATCH_MAX', 25)
+API_BATCH_WORKERS       = getattr(settings, 'API_BATCH_WORKERS', 4)
+
+#Every stage is a tuple of bound middleware methods, in the order they should be called.
+MiddlewarePipeline = namedtuple('MiddlewarePipeline', 'request view response exception')
 
 def load_middleware(middleware):
     from django.core import exceptions
@@ -55,27 +73,162 @@ def load_middleware(middleware):
         if hasattr(mw_instance, 'process_exception'):
             middleware_pipeline['exception'].insert(0, mw_instance.process_exception)
 
-    return middleware_pipeline
+    return MiddlewarePipeline(**dict((k, tuple(v)) for k, v in middleware_pipeline.items()))
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+def get_pipeline(middleware):
+    """
+    Returns the process wide pipeline for a list of middleware paths, importing and instantiating
+    the middleware only the first time that list is seen. Pipelines are passed through untouched.
+    """
+    if isinstance(middleware, MiddlewarePipeline):
+        return middleware
+
+    key = tuple(middleware)
+    try:
+        return _pipelines[key]
+    except KeyError:
+        pass
+
+    with _pipelines_lock:
+        if key not in _pipelines:
+            _pipelines[key] = load_middleware(key)
+        return _pipelines[key]
+
+
+def middleware_name(middleware_method):
+    instance = getattr(middleware_method, 'im_self', None)
+    if instance is not None:
+        return instance.__class__.__name__
+    return getattr(middleware_method, '__name__', repr(middleware_method))
+
+#Dispatch stages, each wraps a (request, *args, **kwargs) callable.
+def view_stage(call, method, view_middleware):
+    def stage(request, *args, **kwargs):
+        response = None
+        for middleware_method in view_middleware:
+            response = middleware_method(request, method, kwargs)
+            if response:
+                break
+        if response is None:
+            response = call(request, *args, **kwargs)
+        return response
+    return stage
+
+def exception_stage(call, exception_middleware):
+    def stage(request, *args, **kwargs):
+        try:
+            return call(request, *args, **kwargs)
+        except Exception as e:
+            for middleware_method in exception_middleware:
+                response = middleware_method(request, e)
+                if response:
+                    return response
+            raise
+    return stage
+
+def request_stage(call, request_middleware):
+    def stage(request, *args, **kwargs):
+        for middleware_method in request_middleware:
+            response = middleware_method(request)
+            if response:
+                return response
+        return call(request, *args, **kwargs)
+    return stage
+
+def cache_stage(call, cache, format_for):
+    """
+    Looks request up in cache once the request and view middleware have let it through. Hits are marked
+    ``from_cache``, misses leave the key on the request for ``compile_stage`` to store the finished response.
+    """
+    def stage(request, *args, **kwargs):
+        key = cache.make_key(request, format_for(request))
+        generation = cache.generation()
+        response = cache.get(key, generation)
+        if response is None:
+            request.api_cache_key = (key, generation)
+            return call(request, *args, **kwargs)
+        response.from_cache = True
+        return response
+    return stage
+
+def raise_not_allowed(http_method_names):
+    def stage(request, *args, **kwargs):
+        raise NotAllowed(http_method_names)
+    return stage
+
+def raise_not_found(request, *args, **kwargs):
+    raise NotFound(_(u'Nothing is routed at %s.' % request.path_info))
+
+def raise_not_implemented(request_method):
+    def stage(request, *args, **kwargs):
+        raise HttpNotImplemented(
+            _(u'The "%s" method is not implemented.' % request_method)
+        )
+    return stage
+
+_response_kinds = {}
+
+def normalize_response(response):
+    """
+    Normalize response from view_func based on known response types.
+    Responses from view functions should be and HTTPResponse, APIResponse
+    or a bare response which will be wrapped in an APIResponse
+    """
+    kind = type(response)
+    try:
+        normalize = _response_kinds[kind]
+    except KeyError:
+        if issubclass(kind, APIResponse):
+            normalize = kind.__call__
+        elif issubclass(kind, HttpResponse):
+            normalize = None
+        else:
+            normalize = lambda response: APIOK(response)() #Just received a raw value...
+        _response_kinds[kind] = normalize
+
+    if normalize is None:
+        return response
+    return normalize(response)
 
 
 class API(object):
     """
     This class provides a collection of endpoints into a single structure that can be used
     just like a regular single endpoint.
+
+    A ``BatchEndpoint`` is routed at ``batch_location`` (set it to None to leave it out).
     """
+    batch_location = 'batch'
+
     def __init__(self, endpoints=(), middleware=None):
         self.endpoints = []
-        self.middleware = load_middleware(middleware or ())
+        self.middleware = get_pipeline(middleware or ())
+        self._resolver = None
 
         [self.add(n, e) for n, e in endpoints] #MAP() works well, PYPY works better.
 
     def add(self, location, endpoint):
         endpoint = endpoint() if callable(endpoint) else endpoint
-        endpoint.middleware = self.middleware #Override the endpoint specific middleware with our own.
-        self.endpoints.append((
-            location,
-            endpoint() if callable(endpoint) else endpoint,
-        ))
+        endpoint.middleware = self.middleware #Override the endpoint specific middleware with our own, shared by reference.
+        self.endpoints.append((location, endpoint))
+        self._resolver = None
+
+    def endpoint_urls(self):
+        return patterns('',
+            #Endpoint patterns start at the slash after their location.
+            *[url(r"^%s" % location, include(endpoint.urls)) for location, endpoint in self.endpoints]
+        )
+
+    def resolve(self, path):
+        """
+        Resolves a path relative to this API to (endpoint dispatch, args, kwargs).
+        """
+        if self._resolver is None:
+            self._resolver = RegexURLResolver(r'^', self.endpoint_urls())
+        return self._resolver.resolve(path)
 
     @property
     def urls(self):
@@ -83,9 +236,10 @@ class API(object):
         This is responsible for unrolling all of the endpoint URLS into a single url conf with the appropriate
         prefixes.
         """
-        urlpatterns = patterns('',
-            *[url(r"^%s/" % location, include(endpoint.urls)) for location, endpoint in self.endpoints]
-        )
+        urlpatterns = self.endpoint_urls()
+        if self.batch_location:
+            batch = BatchEndpoint(self, middleware=self.middleware, location=self.batch_location)
+            urlpatterns += patterns('', url(r"^%s" % self.batch_location, include(batch.urls)))
         return urlpatterns
 
 
@@ -99,12 +253,17 @@ class Endpoint(object):
     2) An APIResponse object which will be serialized appropriately.
     3) It can raise an exception, which will be presented to the client in the correct fashion.
 
+    Set ``cache`` to a ``cache.ResponseCache`` to serve GETs from it, see that module.
     """
     http_method_names = ['get', 'post', 'put', 'delete', 'options']
 
     parameter_mask = "\w\d-"
     params = ()
     middleware = ()
+    timing = API_TIMING
+    cache = None
+    _dispatch_table = None
+    _compiled_for = None
 
     def __init__(self, params=(), middleware=()):
         if params:
@@ -113,8 +272,123 @@ class Endpoint(object):
             self.middleware = middleware
 
     def install_middleware(self):
-        if not hasattr(self, '_middleware'):
-            self._middleware = load_middleware(self.middleware)
+        self._middleware = get_pipeline(self.middleware)
+
+    def timed(self, stage, func):
+        """
+        When timing is enabled, wraps func so its calls are recorded in ``timing.timings``.
+        """
+        if not self.timing:
+            return func
+        return timings.timer(self.__class__.__name__, stage, func)
+
+    def timed_middleware(self, stage, middleware):
+        if not self.timing:
+            return middleware
+        return tuple(self.timed('%s:%s' % (stage, middleware_name(m)), m) for m in middleware)
+
+    def compile(self):
+        """
+        Builds the dispatch table, one precompiled closure per HTTP method. Each closure only contains
+        the middleware stages that actually have hooks, so dispatching is a single call. Timers are
+        compiled in the same way, so they cost nothing unless timing is enabled.
+        """
+        self._compiled_for = self.compile_key()
+        self.install_middleware()
+        if self.cache is not None and self.cache.prefix is None:
+            self.cache.prefix = 'api:%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+
+        table = {}
+        for request_method in self.http_method_names:
+            table[request_method.upper()] = self.compile_method(request_method)
+        self._dispatch_table = table
+        self._not_allowed = self.compile_stage(raise_not_allowed(self.http_method_names))
+        return table
+
+    def compile_key(self):
+        """
+        Everything the dispatch table is built from, the table is rebuilt when this changes.
+        """
+        return (self.middleware, self.timing, self.cache,
+                tuple(getattr(self, request_method, None) for request_method in self.http_method_names))
+
+    def negotiated_format(self, request):
+        """
+        The format the serializing middleware will pick for request, or the Accept header if there isn't one.
+        """
+        for middleware_method in self._middleware.response:
+            determine_format = getattr(getattr(middleware_method, 'im_self', None), 'determine_format', None)
+            if determine_format is not None:
+                return determine_format(request)
+        return request.META.get('HTTP_ACCEPT', '')
+
+    def invalidate_cache(self):
+        """
+        Call from write methods, drops every cached GET of this endpoint.
+        """
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    def compile_method(self, request_method):
+        method = getattr(self, request_method, None)
+        if method is None:
+            return self.compile_stage(raise_not_implemented(request_method))
+
+        pipeline = self._middleware
+        call = self.timed('handler', method)
+
+        cache = self.cache if request_method == 'get' else None
+        if cache is not None:
+            call = self.timed('cached', cache_stage(call, cache, self.negotiated_format))
+
+        if pipeline.view:
+            call = view_stage(call, method, self.timed_middleware('view', pipeline.view))
+
+        if pipeline.exception:
+            call = exception_stage(call, self.timed_middleware('exception', pipeline.exception))
+
+        if pipeline.request:
+            call = request_stage(call, self.timed_middleware('request', pipeline.request))
+
+        return self.compile_stage(call, cache)
+
+    def compile_stage(self, call, cache=None):
+        """
+        Wraps a (request, *args, **kwargs) callable with response normalization and response middleware.
+        With a cache, responses served from it are already finished and go straight back, others are stored.
+        """
+        response_middleware = self.timed_middleware('response', self._middleware.response)
+        normalize = self.timed('normalize', normalize_response)
+
+        def stage(request, args, kwargs):
+            try:
+                response = call(request, *args, **kwargs)
+                if response is None:
+                    return HttpResponse(status=201) #No Content
+                if getattr(response, 'from_cache', False):
+                    if not_modified(request, response):
+                        return not_modified_response(response)
+                    return response
+                response = normalize(response)
+            except APIException as e:
+                response = e()
+            except Exception as e:
+                #if settings.DEBUG and not API_HANDLE_EXCEPTIONS:
+                #    raise
+                response = PlainException(e)()
+                #return self._handle_500(request, e)
+
+            if response_middleware:
+                try:
+                    for middleware_method in response_middleware:
+                        response = middleware_method(request, response)
+                except Exception as e:
+                    response = HttpResponse(str(e))
+
+            if cache is not None and hasattr(request, 'api_cache_key'):
+                cache.set(request.api_cache_key[0], response, request.api_cache_key[1])
+            return response
+        return self.timed('total', stage)
 
     def base_urls(self):
         s = '/?' if API_ALLOW_MISSING_SLASH else '/'
@@ -138,73 +412,16 @@ class Endpoint(object):
 
     @property
     def urls(self):
+        if self._dispatch_table is None or self._compiled_for != self.compile_key():
+            self.compile()
         return patterns('', *(self.override_urls() + self.base_urls()))
 
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
-        self.install_middleware()
-
-        try:
-            request_method = request.method.lower()
-            if request_method not in self.http_method_names:
-                raise NotAllowed(self.http_method_names)
-
-            method = getattr(self, request_method, None)
-            if method is None:
-                raise HttpNotImplemented(
-                    _(u'The "%s" method is not implemented.' % request_method)
-                )
-
-            #Request middleware
-            response = None
-            for middleware_method in self._middleware['request']:
-                response = middleware_method(request)
-                if response:
-                    break
-
-            if response is None:
-                try:
-                    for middleware_method in self._middleware['view']:
-                        response = middleware_method(request, method, kwargs)
-                        if response:
-                            break
-
-                    if response is None:
-                        response = method(request, *args, **kwargs)
-
-                    if response is None:
-                        return HttpResponse(status=201) #No Content
-
-                except Exception as e:
-                    for middleware_method in self._middleware['exception']:
-                        response = middleware_method(request, e)
-                        if response:
-                            break
-                    if response is None:
-                        raise
-
-            # Normalize response from view_func based on known response types.
-            # Responses from view functions should be and HTTPResponse, APIResponse
-            # or a bare response which will be wrapped in an APIResponse
-            if isinstance(response, APIResponse):
-                response = response()
-            elif not isinstance(response, HttpResponse):
-                response = APIOK(response)() #Just received a raw value...
-        except APIException as e:
-            response = e()
-        except Exception as e:
-            #if settings.DEBUG and not API_HANDLE_EXCEPTIONS:
-            #    raise
-            response = PlainException(e)()
-            #return self._handle_500(request, e)
-
-        try:
-            for middleware_method in self._middleware['response']:
-                response = middleware_method(request, response)
-        except Exception as e:
-            response = HttpResponse(str(e))
-
-        return response
+        table = self._dispatch_table
+        if table is None:
+            table = self.compile()
+        return table.get(request.method, self._not_allowed)(request, args, kwargs)
 
 
 #    def wrap_view(self, view_func):
@@ -261,6 +478,176 @@ class Endpoint(object):
 #        return wrapper
 
 
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def get_batch_pool():
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPool(API_BATCH_WORKERS)
+        return _batch_pool
+
+
+class BatchEndpoint(Endpoint):
+    """
+    Takes a list of sub-requests and answers them all in one response. The body is a list (or
+    ``{"requests": [...], "parallel": true}``) of::
+
+        {"method": "GET", "path": "contacts/?limit=5", "body": {...}, "headers": {"Accept": "..."}}
+
+    Paths are relative to the API (absolute ones under it work too). Each sub-request is dispatched
+    straight into its endpoint's pipeline, Django's URL resolution and middleware only run once for
+    the batch, and sub-requests share the batch's user and session. The response is a list of
+    ``{"status": ..., "headers": {...}, "body": ...}`` in the same order, error responses are
+    serialized like any other.
+
+    With ``parallel``, runs of consecutive GETs are spread over a pool of ``API_BATCH_WORKERS``
+    threads, anything else waits for the requests before it. Those GETs get their own copies of the
+    user and session, run in the batch's language and close their database connections when done.
+
+    ``location`` is the path the endpoint is mounted at under the API (``API`` passes its
+    ``batch_location``), when it isn't given the last segment of the batch's path is taken.
+    """
+    http_method_names = ['post']
+    max_requests = API_BATCH_MAX
+    parallel_methods = ('GET', 'HEAD')
+    shared_attributes = ('user', 'session')
+
+    def __init__(self, api, params=(), middleware=(), location=None):
+        super(BatchEndpoint, self).__init__(params, middleware)
+        self.api = api
+        self.location = location
+
+    def compile(self):
+        table = super(BatchEndpoint, self).compile()
+        self._not_found = self.compile_stage(raise_not_found)
+        return table
+
+    def api_prefix(self, request):
+        """
+        The path the API is mounted at, the batch's own path less its location.
+        """
+        path = request.path_info.rstrip('/')
+        location = (self.location or '').strip('/')
+        if location and path.endswith('/' + location):
+            return path[:-len(location)]
+        return path[:path.rfind('/') + 1] or '/'
+
+    def post(self, request, *args, **kwargs):
+        data = getattr(request, 'data', None)
+        if data is None:
+            data = json.loads(request.body or '[]')
+
+        parallel = False
+        if isinstance(data, dict):
+            parallel = bool(data.get('parallel'))
+            data = data.get('requests')
+        if not isinstance(data, list) or not all(isinstance(spec, dict) and 'path' in spec for spec in data):
+            raise BadRequest(_(u'Expected a list of requests, each with a path.'))
+        if len(data) > self.max_requests:
+            raise BadRequest(_(u'No more than %d requests can be batched.' % self.max_requests))
+
+        prefix = self.api_prefix(request)
+        requests = [self.build_request(request, prefix, spec, parallel) for spec in data]
+
+        responses = []
+        run = []
+        for sub_request in requests + [None]:
+            if parallel and sub_request is not None and sub_request.method in self.parallel_methods:
+                run.append(sub_request)
+                continue
+            if len(run) > 1:
+                responses.extend(get_batch_pool().map(partial(self.dispatch_pooled, translation.get_language()), run))
+            else:
+                responses.extend(self.dispatch_one(r) for r in run)
+            run = []
+            if sub_request is not None:
+                responses.append(self.dispatch_one(sub_request))
+
+        return HttpResponse('[%s]' % ','.join(self.encode_response(q, r) for q, r in zip(requests, responses)), content_type='application/json')
+
+    def build_request(self, request, prefix, spec, parallel=False):
+        path, _sep, query = spec['path'].partition('?')
+        path = path[len(prefix):] if path.startswith(prefix) else path.lstrip('/')
+
+        body = spec.get('body', '')
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        environ = dict(request.META)
+        environ.update({
+            'REQUEST_METHOD': str(spec.get('method', 'GET')).upper(),
+            'PATH_INFO': prefix + path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': spec.get('content_type', 'application/json'),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        })
+        for header, value in spec.get('headers', {}).items():
+            environ['HTTP_%s' % str(header).upper().replace('-', '_')] = str(value)
+
+        sub_request = WSGIRequest(environ)
+        sub_request.api_path = path
+        isolated = parallel and sub_request.method in self.parallel_methods
+        for attribute in self.shared_attributes:
+            if hasattr(request, attribute):
+                value = getattr(request, attribute)
+                if isolated:
+                    value = self.copy_state(value)
+                setattr(sub_request, attribute, value)
+        return sub_request
+
+    @staticmethod
+    def copy_state(value):
+        """
+        A copy of a per request object for a sub-request on another thread. Lazy objects (such as the
+        user) are evaluated here first, on the request's own thread.
+        """
+        if isinstance(value, LazyObject):
+            if value._wrapped is empty:
+                value._setup()
+            value = value._wrapped
+        return copy.deepcopy(value)
+
+    def dispatch_one(self, request):
+        try:
+            view, args, kwargs = self.api.resolve(request.api_path)
+        except Resolver404:
+            if self._dispatch_table is None:
+                self.compile()
+            return self._not_found(request, (), {})
+        return view(request, *args, **kwargs)
+
+    def dispatch_pooled(self, language, request):
+        """
+        dispatch_one on a pool thread, which has none of the request thread's translation or
+        database connection handling.
+        """
+        translation.activate(language)
+        try:
+            return self.dispatch_one(request)
+        finally:
+            translation.deactivate()
+            close_connection()
+
+    @staticmethod
+    def encode_response(request, response):
+        """
+        JSON bodies are embedded as they are, anything else as a string.
+        """
+        content = response.content
+        if not content:
+            body = 'null'
+        elif getattr(request, 'api_format', None) == 'json' or response.get('Content-Type', '').startswith('application/json'):
+            body = content
+        else:
+            body = json.dumps(content.decode('utf-8', 'replace'))
+        return '{"status":%d,"headers":%s,"body":%s}' % (response.status_code, json.dumps(dict(response.items())), body)
+
+
 class DetailEndpoint(Endpoint):
     params = ('id',)
 
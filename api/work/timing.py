@@ -0,0 +1,102 @@
+"""
+In process latency histograms for the talker. Endpoints compile timers around their dispatch stages
+only when timing is turned on (``API_TIMING`` or ``Endpoint.timing``), when it's off nothing is
+wrapped and nothing is recorded.
+"""
+import threading
+from bisect import bisect_left
+from timeit import default_timer
+from django.conf import settings
+
+__author__ = 'trey'
+
+#Settings and Defaults
+API_TIMING = getattr(settings, 'API_TIMING', False)
+
+#Upper bounds of the histogram buckets, in milliseconds.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'max_ms': self.max,
+            'buckets': dict(('<=%s' % b, c) for b, c in zip(self.buckets, self.counts) if c),
+        }
+
+
+class Timings(object):
+    """
+    Histograms keyed on endpoint and then stage.
+
+    Compiled endpoints hold on to their histograms, so ``reset`` empties them in place and histograms
+    that have recorded nothing are left out of ``snapshot`` and ``as_text``.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+
+    def reset(self):
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.clear()
+
+    def histogram(self, endpoint, stage):
+        key = (endpoint, stage)
+        try:
+            return self.histograms[key]
+        except KeyError:
+            with self._lock:
+                return self.histograms.setdefault(key, Histogram())
+
+    def timer(self, endpoint, stage, func):
+        """
+        Wraps func so that every call is recorded against endpoint and stage.
+        """
+        histogram = self.histogram(endpoint, stage)
+        def timed(*args, **kwargs):
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.add((default_timer() - start) * 1000)
+        return timed
+
+    def snapshot(self):
+        data = {}
+        for (endpoint, stage), histogram in self.histograms.items():
+            if not histogram.count:
+                continue
+            data.setdefault(endpoint, {})[stage] = histogram.snapshot()
+        return data
+
+    def as_text(self):
+        lines = ['%-30s %-40s %8s %10s %10s' % ('endpoint', 'stage', 'count', 'mean_ms', 'max_ms')]
+        for (endpoint, stage), histogram in sorted(self.histograms.items()):
+            if not histogram.count:
+                continue
+            s = histogram.snapshot()
+            lines.append('%-30s %-40s %8d %10.3f %10.3f' % (endpoint, stage, s['count'], s['mean_ms'], s['max_ms']))
+        return '\n'.join(lines)
+
+timings = Timings()
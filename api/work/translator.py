@@ -4,14 +4,17 @@ representations to go over the wire. Most notably, JSON.
 """
 import time
 import inspect, decimal, types
+from collections import Mapping
 from datetime import date, datetime, time as timeobj, tzinfo, timedelta
 from calendar import timegm
 from json import JSONDecoder, JSONEncoder
 from django.conf import settings
+from lib.utilities import LRUCache
 
 __author__ = 'trey'
 
 API_DATETIME_FORMATTING = getattr(settings, 'API_DATETIME_FORMATTING', 'iso-8601')
+API_JSON_PROFILE = getattr(settings, 'API_JSON_PROFILE', 'pretty')
 
 
 ZERO = timedelta(0)
@@ -33,7 +36,14 @@ class UTC(tzinfo):
 
 
 class LocalTimezone(tzinfo):
-    """Proxy timezone information from time module. (Django implementation, sans dependencies)"""
+    """
+    Proxy timezone information from time module. (Django implementation, sans dependencies)
+
+    DST only ever flips on the hour, so the mktime/localtime round trip is done once per hour and the
+    answer kept in a small ``LRUCache`` shared by every instance.
+    """
+    _dst_hours = LRUCache(4096)
+
     def __init__(self, dt):
         tzinfo.__init__(self)
         self._tzname = self.tzname(dt)
@@ -56,8 +66,18 @@ class LocalTimezone(tzinfo):
     def tzname(self, dt):
         return time.tzname[self._isdst(dt)]
 
-    def _isdst(self, dt):
-        tt = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.weekday(), 0, -1)
+    @classmethod
+    def _isdst(cls, dt):
+        hour = (dt.year, dt.month, dt.day, dt.hour)
+        isdst = cls._dst_hours.get(hour)
+        if isdst is None:
+            isdst = cls._lookup_isdst(dt)
+            cls._dst_hours.set(hour, isdst)
+        return isdst
+
+    @staticmethod
+    def _lookup_isdst(dt):
+        tt = (dt.year, dt.month, dt.day, dt.hour, 0, 0, dt.weekday(), 0, -1)
         try:
             stamp = time.mktime(tt)
         except (OverflowError, ValueError):
@@ -82,28 +102,68 @@ def decoder(obj):
         return datetime.datetime.fromtimestamp(obj['epoch'], UTC())
     return obj
 
-def encoder(obj):
+utc = UTC()
+_local_timezones = {}
+
+def local_timezone(dt):
     """
-    The primary role of this function is to convert datetime instances
-    into a JSON representation of a UTC datetime.
+    The offset of a LocalTimezone only depends on whether DST is in effect, so keep one per offset.
     """
+    isdst = LocalTimezone._isdst(dt)
+    try:
+        return _local_timezones[isdst]
+    except KeyError:
+        return _local_timezones.setdefault(isdst, LocalTimezone(dt))
+
+def to_utc(obj):
     if type(obj) is date:
         #Convert to datetime
         obj = datetime.combine(obj, timeobj())
-    if type(obj) is datetime:
-        #If object is naive, replace the lack of a timezone with the locally derived timezone.
-        if obj.tzinfo is None or obj.tzinfo.utcoffset(obj) is None:
-            obj = obj.replace(tzinfo=LocalTimezone(obj))
-        utc_obj = obj.astimezone(UTC())
-        return {'__complex__': 'datetime',
-                'tz': 'UTC',
-                'epoch': timegm(utc_obj.timetuple()),
-                'iso8601': utc_obj.isoformat(' '),
-                'rfc2822': time.strftime("%a, %d %b %Y %H:%M:%S +0000", utc_obj.timetuple())}
-    raise TypeError(repr(obj) + " is not JSON serializable")
+    #If object is naive, replace the lack of a timezone with the locally derived timezone.
+    if obj.tzinfo is None or obj.tzinfo.utcoffset(obj) is None:
+        obj = obj.replace(tzinfo=local_timezone(obj))
+    return obj.astimezone(utc)
+
+datetime_formatters = {
+    'complex': lambda utc_obj: {
+        '__complex__': 'datetime',
+        'tz': 'UTC',
+        'epoch': timegm(utc_obj.timetuple()),
+        'iso8601': utc_obj.isoformat(' '),
+        'rfc2822': time.strftime("%a, %d %b %Y %H:%M:%S +0000", utc_obj.timetuple())},
+    'epoch': lambda utc_obj: timegm(utc_obj.timetuple()),
+    'iso-8601': lambda utc_obj: utc_obj.isoformat(' '),
+    'rfc-2822': lambda utc_obj: time.strftime("%a, %d %b %Y %H:%M:%S +0000", utc_obj.timetuple()),
+}
+
+def make_encoder(formatting):
+    """
+    Builds a ``default`` function for JSONEncoder that renders datetimes using one of ``datetime_formatters``.
+    """
+    format = datetime_formatters[formatting]
+    def encoder(obj):
+        if type(obj) is date or type(obj) is datetime:
+            return format(to_utc(obj))
+        raise TypeError(repr(obj) + " is not JSON serializable")
+    return encoder
+
+#The original representation, every datetime becomes a dict of all the formats above.
+encoder = make_encoder('complex')
 
 date_aware_json_decoder = JSONDecoder(encoding='utf-8', object_hook=decoder)
 date_aware_json_encoder = JSONEncoder(encoding='utf-8', default=encoder, sort_keys=True,  indent=2)
+compact_json_encoder = JSONEncoder(encoding='utf-8', default=make_encoder(API_DATETIME_FORMATTING), separators=(',', ':'))
+
+json_encoders = {
+    'pretty': date_aware_json_encoder,
+    'compact': compact_json_encoder,
+}
+
+def get_json_encoder(profile=None):
+    """
+    Returns the encoder for the named profile, unknown profiles get the configured default.
+    """
+    return json_encoders.get(profile) or json_encoders[API_JSON_PROFILE]
 
 
 class NoTransformer(Exception):
@@ -114,10 +174,15 @@ class SimpleTranslator(object):
     """
     This translator turns all objects into the most basic
     representation we know how.
+
+    The converter chosen for a concrete type is remembered, so the list of tests is only walked
+    the first time a type is seen. Predicate (function) tests look at the instance rather than its
+    type, so any type that has to walk past one of them is never cached.
     """
     def __init__(self, callback=None):
         self.tests = []
         self.callback = callback
+        self._cache = {}
 
         self.add_defaults()
 
@@ -130,10 +195,10 @@ class SimpleTranslator(object):
             None) #We add these anyway to short circuit the other checks, even though they are already primitive.
         self.register_type('date', (datetime, date),
             None) #This is safe because of the JSON serializer we use.
-        self.register_type('map', dict,
-            lambda x: dict([ (k, self.resolve(v)) for k, v in x.iteritems() ]))
+        self.register_type('map', (dict, Mapping),
+            self.convert_map) #Mappings that aren't dicts, like lazily decoded BSON documents, are maps too.
         self.register_type('list', (tuple, list, types.GeneratorType),
-            lambda x: [ self.resolve(v) for v in x ])
+            self.convert_list)
         self.register_type('emit', lambda x: hasattr(x, '__emittable__'),
             lambda f: f.__emittable__())
         self.register_type('dec', decimal.Decimal,
@@ -142,32 +207,97 @@ class SimpleTranslator(object):
             lambda x: x())
 
     def register_type(self, name, test, conv, priority=LOW_PRIORITY):
-        atom = (name, test if inspect.isfunction(test) else lambda x: isinstance(x, test), conv)
+        if inspect.isfunction(test):
+            atom = (name, test, conv, True)
+        else:
+            atom = (name, lambda x: isinstance(x, test), conv, False)
         if priority:
             self.tests.insert(0, atom)
         else:
             self.tests.append(atom)
+        self._cache.clear()
 
     def unregister_type(self, name):
         index = None
-        for i in len(self.tests):
+        for i in range(len(self.tests)):
             if self.tests[i][0] == name:
                 index = i
                 break
         if index is not None:
             self.tests.pop(index)
+        self._cache.clear()
 
     def get_transformer(self, obj):
-        for name, test, converter in self.tests:
+        try:
+            return self._cache[type(obj)]
+        except KeyError:
+            pass
+
+        cacheable = True
+        for name, test, converter, predicate in self.tests:
             if test(obj) is True:
+                if cacheable:
+                    self._cache[type(obj)] = converter
                 return converter
+            if predicate:
+                cacheable = False
         raise NoTransformer('No transformer could be found for %s' % str(type(obj)))
 
+    def convert_map(self, obj):
+        return dict([ (k, self.resolve(v)) for k, v in obj.iteritems() ])
+
+    def convert_list(self, obj):
+        return [ self.resolve(v) for v in obj ]
+
     def resolve(self, obj):
-        trans = self.get_transformer(obj)
-        if trans is not None:
+        cache = self._cache
+        trans = cache.get(type(obj), False)
+        if trans is None: #Primitives never get any further than this.
+            return obj
+        if trans is False:
+            trans = self.get_transformer(obj)
+            if trans is None:
+                return obj
+
+        convert_map, convert_list = self.convert_map, self.convert_list
+        if trans != convert_map and trans != convert_list:
             return trans(obj)
-        return obj
+
+        #Containers are converted iteratively, each new container is created empty, attached to its
+        #parent right away and filled in once it comes off of the stack.
+        result = {} if trans == convert_map else []
+        stack = [(obj, result)]
+        while stack:
+            source, target = stack.pop()
+            if type(target) is dict:
+                items = source.iteritems()
+            else:
+                items = enumerate(source)
+            append = target.append if type(target) is list else None
+
+            for k, v in items:
+                trans = cache.get(type(v), False)
+                if trans is False:
+                    trans = self.get_transformer(v)
+
+                if trans is None:
+                    pass
+                elif trans == convert_map:
+                    child = {}
+                    stack.append((v, child))
+                    v = child
+                elif trans == convert_list:
+                    child = []
+                    stack.append((v, child))
+                    v = child
+                else:
+                    v = trans(v)
+
+                if append is None:
+                    target[k] = v
+                else:
+                    append(v)
+        return result
 
 translator = SimpleTranslator()
 
@@ -0,0 +1,151 @@
+import os
+import threading
+from bson import BSON, ObjectId
+from bson.errors import InvalidDocument
+from pymongo import Connection
+from pymongo.errors import BulkInsertError, OperationFailure
+
+
+class ConnectionRegistry(object):
+    """
+    Hands out a single, shared ``Connection`` per set of connection parameters.
+
+    ``Connection`` already pools its sockets, so building a new one per request only buys
+    us a fresh TCP connect and ``ismaster`` handshake. Like ``pymongo.pool.Pool`` we remember
+    the pid we were populated in and start over after a fork, child processes must never
+    share sockets with their parent.
+
+    ``stats`` counts connections made, connections reused and ``lock_waits``, the times a caller found
+    the registry busy (usually with another thread's connect) and had to wait for it. Waits for a
+    socket happen in the connection's own ``Pool``.
+    """
+    def __init__(self, connection_class=Connection):
+        self.connection_class = connection_class
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._connections = {}
+        self.stats = {
+            'connects': 0,
+            'reuses': 0,
+            'lock_waits': 0,
+        }
+
+    @staticmethod
+    def _key(params):
+        #Values such as read preferences or tag sets aren't always hashable.
+        return tuple(sorted((k, repr(v)) for k, v in params.iteritems()))
+
+    def get(self, **params):
+        key = self._key(params)
+
+        waited = not self._lock.acquire(False)
+        if waited:
+            #Somebody else holds the registry, most likely while connecting, wait our turn.
+            self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._reset()
+            if waited:
+                self.stats['lock_waits'] += 1
+
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = self.connection_class(**params)
+                self._connections[key] = connection
+                self.stats['connects'] += 1
+            else:
+                self.stats['reuses'] += 1
+            return connection
+        finally:
+            self._lock.release()
+
+    def disconnect(self):
+        """Close and forget every registered connection."""
+        self._lock.acquire()
+        try:
+            for connection in self._connections.values():
+                connection.disconnect()
+            self._connections.clear()
+        finally:
+            self._lock.release()
+
+
+registry = ConnectionRegistry()
+
+def get_connection(**params):
+    return registry.get(**params)
+
+
+def _unencodable(collection, docs):
+    """
+    The error for each document that can't be encoded or is over the server's ``max_bson_size``, None for the others.
+    """
+    max_bson_size = collection.database.connection.max_bson_size
+    errors = []
+    for doc in docs:
+        try:
+            size = len(BSON.encode(doc, check_keys=True))
+            if max_bson_size and size > max_bson_size:
+                raise InvalidDocument("Document too large: %d bytes, the limit is %d." % (size, max_bson_size))
+            errors.append(None)
+        except (InvalidDocument, TypeError) as e:
+            errors.append(e)
+    return errors
+
+def _find_stored(collection, docs, indexes, results, error):
+    """
+    The server only reports the last error of a message, look its documents up to find the ones that made it in.
+    """
+    ids = [docs[i]['_id'] for i in indexes]
+    stored = set(d['_id'] for d in collection.find({'_id': {'$in': ids}}, fields=['_id']))
+    for i in indexes:
+        if docs[i]['_id'] not in stored:
+            results[i] = error
+
+def _insert(collection, docs, indexes, results, continue_on_error, kwargs):
+    try:
+        collection.insert([docs[i] for i in indexes], safe=True, continue_on_error=continue_on_error, **kwargs)
+    except BulkInsertError as e:
+        failure, position = None, 0
+        for result in e.results:
+            batch = indexes[position:position + len(result['ids'])]
+            position += len(batch)
+            if not result['sent']:
+                for i in batch:
+                    results[i] = failure
+            elif result['error'] is not None:
+                failure = result['error']
+                _find_stored(collection, docs, batch, results, failure)
+    except OperationFailure as e:
+        _find_stored(collection, docs, indexes, results, e)
+
+def bulk_insert(collection, docs, continue_on_error=True, **kwargs):
+    """
+    Inserts docs with a single safe ``Collection.insert``, which encodes them once and splits them into
+    as many messages as the server's maximum message size requires.
+
+    Returns one result per document, in order: its ``_id`` if it was stored or the exception
+    explaining why it wasn't. Documents that can't be encoded get their own error and the others are
+    still inserted. Without continue_on_error nothing is sent after the first failing message.
+    """
+    for doc in docs:
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+    results = [doc['_id'] for doc in docs]
+
+    try:
+        _insert(collection, docs, range(len(docs)), results, continue_on_error, kwargs)
+    except (InvalidDocument, TypeError):
+        #Nothing was sent. Only now is it worth encoding the documents one by one to find the culprits.
+        indexes = []
+        for i, error in enumerate(_unencodable(collection, docs)):
+            if error is None:
+                indexes.append(i)
+            else:
+                results[i] = error
+        if indexes:
+            _insert(collection, docs, indexes, results, continue_on_error, kwargs)
+    return results
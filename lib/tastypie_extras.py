@@ -1,7 +1,15 @@
+import base64
+import json
 from django.conf.urls.defaults import *
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
+from django.core.urlresolvers import resolve, Resolver404, get_script_prefix
 from django.http import HttpResponse, Http404
+from django.utils.http import urlencode
 import mongoengine
+from mongoengine.queryset import OperationError, DoesNotExist, MultipleObjectsReturned as MultipleDocumentsReturned
+from bson import json_util
+from pymongo import ASCENDING
+from lib.pymongo_extras import bulk_insert
 from tastypie.api import Api
 from tastypie import fields
 from tastypie.fields import ApiField, BooleanField, IntegerField, ListField, DateTimeField, CharField, DictField, RelatedField, NOT_PROVIDED
@@ -10,8 +18,9 @@ from tastypie.utils.mime import determine_format, build_content_type
 from tastypie.authorization import Authorization
 from tastypie.bundle import Bundle
 from tastypie.exceptions import NotFound, BadRequest, InvalidFilterError, HydrationError, InvalidSortError, ImmediateHttpResponse, ApiFieldError
-from tastypie.http import HttpAccepted, HttpCreated
-from tastypie.resources import Resource, ModelDeclarativeMetaclass
+from tastypie.http import HttpAccepted, HttpCreated, HttpBadRequest, HttpMethodNotAllowed
+from tastypie.paginator import Paginator
+from tastypie.resources import Resource, ModelDeclarativeMetaclass, convert_post_to_patch
 from tastypie.utils import is_valid_jsonp_callback_value, dict_strip_unicode_keys, trailing_slash
 
 
@@ -28,6 +37,356 @@ class EmbeddedDocumentField(DictField):
         return d
 
 
+class MongoPaginator(Paginator):
+    """
+    Paginates a pymongo ``Cursor`` by setting ``skip``/``limit`` on it, so only the requested page
+    comes over the wire.
+
+    Counting a large collection isn't free, with ``count_total = False`` (or ``?total_count=false``)
+    no count is run: one extra document is fetched to find out whether there is a next page and
+    ``total_count`` is reported as None.
+    """
+    count_total = True
+
+    def should_count(self):
+        if self.request_data.get('total_count', '').lower() in ('0', 'false', 'no'):
+            return False
+        return self.count_total
+
+    def get_slice(self, limit, offset):
+        return self.objects.skip(offset).limit(limit)
+
+    def get_count(self):
+        #Cursor.count() ignores skip and limit unless asked otherwise.
+        return self.objects.count()
+
+    def page(self):
+        limit = self.get_limit()
+        offset = self.get_offset()
+
+        if self.should_count():
+            count = self.get_count()
+            objects = self.get_slice(limit, offset)
+            has_next = offset + limit < count
+        else:
+            count = None
+            objects = list(self.get_slice(limit + 1 if limit else 0, offset))
+            has_next = bool(limit) and len(objects) > limit
+            if has_next:
+                objects = objects[:limit]
+
+        meta = {
+            'offset': offset,
+            'limit': limit,
+            'total_count': count,
+        }
+
+        if limit:
+            meta['previous'] = self.get_previous(limit, offset)
+            meta['next'] = self._generate_uri(limit, offset + limit) if has_next else None
+
+        return {
+            'objects': objects,
+            'meta': meta,
+        }
+
+
+class KeysetPaginator(MongoPaginator):
+    """
+    Paginates a pymongo ``Cursor`` or a mongoengine ``QuerySet`` by position instead of by offset.
+
+    The ``next`` link carries an opaque ``after`` token holding the sort key values and ``_id`` of the
+    last object on the page, the following page is then a range query starting right after it. With an
+    index on the sort keys every page costs the same as the first, where ``skip`` has to walk past
+    every earlier document. ``_id`` is appended to the sort to break ties.
+
+    A ``QuerySet`` is narrowed to the range here. A pymongo ``Cursor`` can't be narrowed once it is
+    built, so the range has to go into its ``find()`` spec: see ``find_spec``, which ``ModeledResource``
+    calls from ``obj_get_list``. A cursor doesn't tell its sort either, that comes in as ``ordering``
+    (the cursor's sort, e.g. from ``get_sort``), and ``unbounded`` is the same query without the range
+    for counting.
+
+    There are no ``previous`` links and ``offset`` is ignored. No count is run unless asked for,
+    ``?total_count=true`` counts the query and ``?total_count=approximate`` reports the size of the
+    whole collection, which Mongo knows without scanning.
+    """
+    count_total = False
+    token_param = 'after'
+
+    def __init__(self, request_data, objects, resource_uri=None, limit=None, offset=0, ordering=None, unbounded=None):
+        super(KeysetPaginator, self).__init__(request_data, objects, resource_uri, limit, offset)
+        self.ordering = ordering
+        self.unbounded = unbounded
+
+    def should_count(self):
+        value = self.request_data.get('total_count', '').lower()
+        if value in ('1', 'true', 'yes', 'approximate'):
+            return value
+        return super(KeysetPaginator, self).should_count()
+
+    def get_count(self, approximate=False):
+        if approximate:
+            if hasattr(self.objects, '_ordering'):
+                return self.objects._collection.count()
+            return self.objects.collection.count()
+        if self.unbounded is not None:
+            return self.unbounded.count()
+        return self.objects.count()
+
+    def get_ordering(self):
+        """
+        The sort of ``objects`` as a list of (key, direction), ending in ``_id``.
+        """
+        objects = self.objects
+        if hasattr(objects, '_ordering'):
+            #mongoengine QuerySet, which only applies the Document's default ordering lazily.
+            if not objects._ordering and objects._document._meta.get('ordering'):
+                objects.order_by(*objects._document._meta['ordering'])
+            ordering = list(objects._ordering)
+        else:
+            ordering = list(self.ordering or ())
+
+        if not ordering or ordering[-1][0] != '_id':
+            ordering = self.complete_ordering(ordering)
+            self.sort(ordering)
+        return ordering
+
+    @staticmethod
+    def complete_ordering(ordering):
+        """
+        ordering with ``_id`` moved to the end, in the direction of the last key.
+        """
+        ordering = [tuple(o) for o in ordering if o[0] != '_id']
+        ordering.append(('_id', ordering[-1][1] if ordering else ASCENDING))
+        return ordering
+
+    @classmethod
+    def find_spec(cls, request_data, sort, spec):
+        """
+        The spec to ``find()`` the page requested by request_data with, for a cursor sorted on sort.
+        """
+        token = request_data.get(cls.token_param)
+        if not token:
+            return spec
+        ordering = cls.complete_ordering(sort)
+        condition = cls.range_query(ordering, cls.decode_token(token, ordering))
+        return {'$and': [spec, condition]} if spec else condition
+
+    def sort(self, ordering):
+        if hasattr(self.objects, '_ordering'):
+            self.objects = self.objects.order_by(*[('-' if d < 0 else '') + k for k, d in ordering])
+        else:
+            self.objects = self.objects.sort(ordering)
+
+    def restrict(self, condition):
+        """
+        Narrows a ``QuerySet`` down to the documents that also match condition. The ``$and`` keeps the
+        range from being merged key by key into the query's own conditions.
+        """
+        self.objects = self.objects.filter(__raw__={'$and': [condition]})
+
+    @staticmethod
+    def range_query(ordering, values):
+        """
+        The query for everything sorting after values, e.g. for a sort on (a, _id):
+        ``{'$or': [{'a': {'$gt': a}}, {'a': a, '_id': {'$gt': _id}}]}``
+
+        Null and missing values sort before everything else, so after a null comes anything that is set
+        when ascending and nothing when descending, while a descending range also takes in the nulls.
+        """
+        clauses = []
+        for i, (key, direction) in enumerate(ordering):
+            value = values[i]
+            if value is None:
+                conditions = [{'$ne': None}] if direction > 0 else []
+            elif direction > 0:
+                conditions = [{'$gt': value}]
+            else:
+                conditions = [{'$lt': value}] if key == '_id' else [{'$lt': value}, None]
+            for condition in conditions:
+                clause = dict((k, v) for (k, d), v in zip(ordering[:i], values))
+                clause[key] = condition
+                clauses.append(clause)
+        return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+    @staticmethod
+    def key_values(obj, ordering):
+        if hasattr(obj, 'to_mongo'):
+            obj = obj.to_mongo()
+        values = []
+        for key, direction in ordering:
+            value = obj
+            for part in key.split('.'):
+                value = value.get(part) if hasattr(value, 'get') else None
+            values.append(value)
+        return values
+
+    @staticmethod
+    def encode_token(values):
+        return base64.urlsafe_b64encode(json.dumps(values, default=json_util.default, separators=(',', ':')))
+
+    @classmethod
+    def decode_token(cls, token, ordering):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(token)), object_hook=json_util.object_hook)
+        except (TypeError, ValueError):
+            raise BadRequest("Invalid '%s' token." % cls.token_param)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise BadRequest("The '%s' token doesn't match the current ordering." % cls.token_param)
+        return values
+
+    def get_next(self, limit, token):
+        if self.resource_uri is None:
+            return None
+        request_params = dict((k, v) for k, v in self.request_data.items() if k not in ('offset', self.token_param))
+        request_params.update({'limit': limit, self.token_param: token})
+        return '%s?%s' % (self.resource_uri, urlencode(request_params))
+
+    def page(self):
+        limit = self.get_limit()
+        ordering = self.get_ordering()
+
+        counting = self.should_count()
+        count = self.get_count(approximate=counting == 'approximate') if counting else None
+
+        token = self.request_data.get(self.token_param)
+        if token and hasattr(self.objects, '_ordering'):
+            self.restrict(self.range_query(ordering, self.decode_token(token, ordering)))
+
+        objects = list(self.objects.limit(limit + 1) if limit else self.objects)
+        has_next = bool(limit) and len(objects) > limit
+        if has_next:
+            objects = objects[:limit]
+
+        meta = {
+            'limit': limit,
+            'total_count': count,
+            'previous': None,
+            'next': None,
+        }
+        if has_next:
+            meta['next'] = self.get_next(limit, self.encode_token(self.key_values(objects[-1], ordering)))
+
+        return {
+            'objects': objects,
+            'meta': meta,
+        }
+
+
+class HttpMultiStatus(HttpResponse):
+    status_code = 207
+
+
+class BulkCreateMixin(object):
+    """
+    POSTing a list (or ``{"objects": [...]}``) to a list endpoint creates every item at once, as does
+    every item in a list PATCH without a ``resource_uri`` or whose ``resource_uri`` doesn't name an
+    existing object (a create-via-PUT, stored under the key from the URI). All of the items are
+    validated first, if any of them is invalid nothing is written and the errors come back keyed on the
+    item's index. Otherwise they go to ``obj_create_many``, which should write them in as few round trips as it can.
+
+    The response has one result per item, in order: its ``resource_uri`` or the ``error`` that kept
+    it from being stored. The status is 201 if everything was created and 207 if something wasn't.
+
+    Resources provide ``post_detail_data(request, data, **kwargs)`` for a POST of a single object,
+    ``validate_many(request, rows)`` returning (cleaned rows, {index: errors}) like
+    ``DataModel.validate_many`` and ``obj_create_many(request, rows, **kwargs)`` returning either the
+    stored object or an exception for each row. ``with_lookup(row, lookup)`` puts the key from a
+    create-via-PUT's URI on its validated row.
+    """
+    missing_exceptions = (ObjectDoesNotExist, MultipleObjectsReturned, DoesNotExist, MultipleDocumentsReturned)
+
+    def post_list(self, request, **kwargs):
+        deserialized = self.deserialize(request, request.raw_post_data, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if isinstance(deserialized, dict) and 'objects' not in deserialized:
+            return self.post_detail_data(request, deserialized, **kwargs)
+
+        rows = deserialized['objects'] if isinstance(deserialized, dict) else deserialized
+        results = self.bulk_create(request, rows, **kwargs)
+        status = HttpCreated if not any(isinstance(r, Exception) for r in results) else HttpMultiStatus
+        return self.create_response(request, {'objects': self.bulk_results(results)}, response_class=status)
+
+    def patch_list(self, request, **kwargs):
+        request = convert_post_to_patch(request)
+        deserialized = self.deserialize(request, request.raw_post_data, format=request.META.get('CONTENT_TYPE', 'application/json'))
+
+        if "objects" not in deserialized:
+            raise BadRequest("Invalid data sent.")
+
+        if len(deserialized.get('deleted_objects', [])) and 'delete' not in self._meta.detail_allowed_methods:
+            raise ImmediateHttpResponse(response=HttpMethodNotAllowed())
+
+        new_rows, lookups, updates = [], [], []
+        for data in deserialized["objects"]:
+            if "resource_uri" not in data:
+                new_rows.append(data)
+                lookups.append(None)
+                continue
+            if 'put' not in self._meta.detail_allowed_methods:
+                raise ImmediateHttpResponse(response=HttpMethodNotAllowed())
+            lookup = self.lookup_via_uri(data.pop('resource_uri'))
+            try:
+                obj = self.obj_get(request=request, **lookup)
+            except self.missing_exceptions:
+                obj = None
+            if obj is None:
+                #The object doesn't exist, so this is a create-via-PUT, same as tastypie.
+                new_rows.append(data)
+                lookups.append(lookup)
+            else:
+                updates.append((obj, data))
+
+        new_rows = self.bulk_validate(request, new_rows)
+        new_rows = [self.with_lookup(row, lookup) if lookup else row for row, lookup in zip(new_rows, lookups)]
+
+        for obj, data in updates:
+            #Update in place, same as tastypie.
+            bundle = self.build_bundle(obj=obj, request=request)
+            bundle = self.full_dehydrate(bundle)
+            bundle = self.alter_detail_data_to_serialize(request, bundle)
+            self.update_in_place(request, bundle, data)
+
+        results = self.obj_create_many(request, new_rows, **self.remove_api_resource_names(kwargs))
+
+        for uri in deserialized.get('deleted_objects', []):
+            obj = self.get_via_uri(uri, request=request)
+            self.obj_delete(request=request, _obj=obj)
+
+        return self.create_response(request, {'objects': self.bulk_results(results)}, response_class=HttpAccepted)
+
+    def lookup_via_uri(self, uri):
+        """
+        The ``obj_get`` kwargs for uri, resolved like ``get_via_uri`` does.
+        """
+        prefix = get_script_prefix()
+        chomped_uri = uri
+        if prefix and chomped_uri.startswith(prefix):
+            chomped_uri = chomped_uri[len(prefix)-1:]
+        try:
+            view, args, kwargs = resolve(chomped_uri)
+        except Resolver404:
+            raise NotFound("The URL provided '%s' was not a link to a valid resource." % uri)
+        return self.remove_api_resource_names(kwargs)
+
+    def with_lookup(self, row, lookup):
+        return dict(row, **lookup)
+
+    def bulk_validate(self, request, rows):
+        rows = [self.alter_deserialized_detail_data(request, dict_strip_unicode_keys(row)) for row in rows]
+        cleaned, errors = self.validate_many(request, rows)
+        if errors:
+            raise ImmediateHttpResponse(response=self.create_response(request, {'errors': errors}, response_class=HttpBadRequest))
+        return cleaned
+
+    def bulk_create(self, request, rows, **kwargs):
+        rows = self.bulk_validate(request, rows)
+        return self.obj_create_many(request, rows, **self.remove_api_resource_names(kwargs))
+
+    def bulk_results(self, results):
+        return [{'error': unicode(r)} if isinstance(r, Exception) else {'resource_uri': self.get_resource_uri(r)}
+                for r in results]
+
+
 class EmptyApi(Api):
     @property
     def urls(self):
@@ -153,8 +512,15 @@ class MERef(RelatedField):
         return self.build_related_resource(value, request=bundle.request)
 
 
-class MongoEngineResource(Resource):
+class MongoEngineResource(BulkCreateMixin, Resource):
+    """
+    Lists POSTed or PATCHed to the resource are converted, hydrated and validated like a single
+    ``obj_create`` and then written with one batched insert of their ``to_mongo()`` documents. That
+    insert bypasses ``Document.save()``, so ``pre_save``/``post_save`` signals don't fire and overridden
+    ``save`` methods aren't called; set ``save_each = True`` for documents that rely on them.
+    """
     __metaclass__ = ModelDeclarativeMetaclass
+    save_each = False
 
     class Meta:
         object_class = mongoengine.Document
@@ -420,8 +786,49 @@ class MongoEngineResource(Resource):
                 obj = self._get_object_class(kwargs['request'], filters=dict(kwargs['request'].GET.items()))
         return Bundle(obj, data)
 
-    def post_list(self, request, **kwargs):
-        deserialized = self.deserialize(request, request.raw_post_data, format=request.META.get('CONTENT_TYPE', 'application/json'))
+    def validate_many(self, request, rows):
+        object_class = self._get_object_class(request, filters=request.GET.copy())
+        documents, errors = [], {}
+        for i, data in enumerate(rows):
+            try:
+                for k, v in data.items():
+                    value = self._convert_field(k, v)
+                    if value is not None:
+                        data[k] = value
+                bundle = self.full_hydrate(Bundle(obj=object_class(**data), data=data, request=request))
+                document = bundle.obj
+                document.validate()
+            except (mongoengine.ValidationError, AttributeError) as e:
+                errors[i] = [unicode(e)]
+                document = None
+            documents.append(document)
+        return documents, errors
+
+    def with_lookup(self, document, lookup):
+        for k, v in lookup.items():
+            setattr(document, k, v)
+        return document
+
+    def obj_create_many(self, request, documents, **kwargs):
+        object_class = self._get_object_class(request, filters=request.GET.copy())
+        for document in documents:
+            for k, v in kwargs.items():
+                setattr(document, k, v)
+        if self.save_each:
+            results = []
+            for document in documents:
+                try:
+                    results.append(document.save())
+                except (mongoengine.ValidationError, OperationError) as e:
+                    results.append(e)
+            return results
+        results = bulk_insert(object_class.objects._collection, [document.to_mongo() for document in documents])
+        for document, result in zip(documents, results):
+            if not isinstance(result, Exception):
+                document.pk = result
+        return [r if isinstance(r, Exception) else d for d, r in zip(documents, results)]
+
+    def post_detail_data(self, request, deserialized, **kwargs):
         deserialized = self.alter_deserialized_list_data(request, deserialized)
         bundle = self.build_bundle_custom_class(data=dict_strip_unicode_keys(deserialized), request=request)
         self.is_valid(bundle, request)
@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+
+
 
 
 def random_password(minpairs=3, maxpairs=4):
@@ -20,3 +24,43 @@ def random_password(minpairs=3, maxpairs=4):
             vowel = string.upper(vowel)
         password += vowel
     return password
+
+
+class LRUCache(object):
+    """
+    A small thread safe, size bounded mapping that evicts the least recently used key.
+    """
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
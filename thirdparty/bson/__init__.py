@@ -21,6 +21,8 @@ import re
 import struct
 import warnings
 
+from collections import Mapping
+
 from bson.binary import Binary, OLD_UUID_SUBTYPE
 from bson.code import Code
 from bson.dbref import DBRef
@@ -60,10 +62,36 @@ EPOCH_AWARE = datetime.datetime.fromtimestamp(0, utc)
 EPOCH_NAIVE = datetime.datetime.utcfromtimestamp(0)
 
 
+# The decoder walks one string by offsets, nothing is sliced out of it
+# except the bytes of the values themselves. Sub-documents and arrays are
+# decoded in place and arrays go straight into lists.
+_UNPACK_INT = struct.Struct("<i").unpack_from
+_UNPACK_UINT = struct.Struct("<I").unpack_from
+_UNPACK_LONG = struct.Struct("<q").unpack_from
+_UNPACK_FLOAT = struct.Struct("<d").unpack_from
+_UNPACK_TIMESTAMP = struct.Struct("<II").unpack_from
+
+
+def _as_str(data):
+    """Return `data` as a :class:`str` (copied only if it isn't one).
+
+    Any object supporting the buffer interface is accepted, str is the only
+    type in Python 2 that can be searched for a NUL and sliced without an
+    extra copy per value.
+    """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+
 def _get_int(data, position, as_class=None, tz_aware=False, unsigned=False):
-    format = unsigned and "I" or "i"
     try:
-        value = struct.unpack("<%s" % format, data[position:position + 4])[0]
+        if unsigned:
+            value = _UNPACK_UINT(data, position)[0]
+        else:
+            value = _UNPACK_INT(data, position)[0]
     except struct.error:
         raise InvalidBSON()
     position += 4
@@ -72,9 +100,8 @@ def _get_int(data, position, as_class=None, tz_aware=False, unsigned=False):
 
 def _get_c_string(data, position, length=None):
     if length is None:
-        try:
-            end = data.index("\x00", position)
-        except ValueError:
+        end = data.find("\x00", position)
+        if end < 0:
             raise InvalidBSON()
     else:
         end = position + length
@@ -100,43 +127,54 @@ def _make_c_string(string, check_null=False):
 
 
 def _get_number(data, position, as_class, tz_aware):
-    num = struct.unpack("<d", data[position:position + 8])[0]
-    position += 8
-    return num, position
+    return _UNPACK_FLOAT(data, position)[0], position + 8
 
 
 def _get_string(data, position, as_class, tz_aware):
-    length = struct.unpack("<i", data[position:position + 4])[0] - 1
-    position += 4
-    return _get_c_string(data, position, length)
+    end = position + 3 + _UNPACK_INT(data, position)[0]
+    if end < position + 4:
+        raise InvalidBSON("bad string length")
+    return unicode(data[position + 4:end], "utf-8"), end + 1
 
 
 def _get_object(data, position, as_class, tz_aware):
-    obj_size = struct.unpack("<i", data[position:position + 4])[0]
-    encoded = data[position + 4:position + obj_size - 1]
-    object = _elements_to_dict(encoded, as_class, tz_aware)
-    position += obj_size
+    end = position + _UNPACK_INT(data, position)[0] - 1
+    object = _elements_to_dict(data, position + 4, end, as_class, tz_aware)
     if "$ref" in object:
         return (DBRef(object.pop("$ref"), object.pop("$id"),
-                      object.pop("$db", None), object), position)
-    return object, position
+                      object.pop("$db", None), object), end + 1)
+    return object, end + 1
 
 
 def _get_array(data, position, as_class, tz_aware):
-    obj, position = _get_object(data, position, as_class, tz_aware)
+    end = position + _UNPACK_INT(data, position)[0] - 1
+    position += 4
     result = []
-    i = 0
-    while True:
+    append = result.append
+    find = data.find
+    getter = _element_getter
+    while position < end:
+        element_type = data[position]
+        # The keys are just "0", "1", ... and are skipped.
+        position = find("\x00", position + 1) + 1
+        if not position:
+            raise InvalidBSON()
         try:
-            result.append(obj[str(i)])
-            i += 1
+            value, position = getter[element_type](data, position,
+                                                   as_class, tz_aware)
         except KeyError:
-            break
-    return result, position
+            raise InvalidBSON("no decoder for element type %r" %
+                              element_type)
+        append(value)
+    if position != end:
+        raise InvalidBSON("bad array length")
+    return result, end + 1
 
 
 def _get_binary(data, position, as_class, tz_aware):
     length, position = _get_int(data, position)
+    if length < 0:
+        raise InvalidBSON("bad binary length")
     subtype = ord(data[position])
     position += 1
     if subtype == 2:
@@ -154,19 +192,15 @@ def _get_binary(data, position, as_class, tz_aware):
 
 
 def _get_oid(data, position, as_class, tz_aware):
-    value = ObjectId(data[position:position + 12])
-    position += 12
-    return value, position
+    return ObjectId(data[position:position + 12]), position + 12
 
 
 def _get_boolean(data, position, as_class, tz_aware):
-    value = data[position] == "\x01"
-    position += 1
-    return value, position
+    return data[position] == "\x01", position + 1
 
 
 def _get_date(data, position, as_class, tz_aware):
-    seconds = float(struct.unpack("<q", data[position:position + 8])[0]) / 1000.0
+    seconds = float(_UNPACK_LONG(data, position)[0]) / 1000.0
     position += 8
     if tz_aware:
         return EPOCH_AWARE + datetime.timedelta(seconds=seconds), position
@@ -206,21 +240,18 @@ def _get_regex(data, position, as_class, tz_aware):
 def _get_ref(data, position, as_class, tz_aware):
     position += 4
     collection, position = _get_c_string(data, position)
-    oid, position = _get_oid(data, position)
+    oid, position = _get_oid(data, position, as_class, tz_aware)
     return DBRef(collection, oid), position
 
 
 def _get_timestamp(data, position, as_class, tz_aware):
-    inc, position = _get_int(data, position, unsigned=True)
-    timestamp, position = _get_int(data, position, unsigned=True)
-    return Timestamp(timestamp, inc), position
+    inc, timestamp = _UNPACK_TIMESTAMP(data, position)
+    return Timestamp(timestamp, inc), position + 8
 
 
 def _get_long(data, position, as_class, tz_aware):
     # Have to cast to long; on 32-bit unpack may return an int.
-    value = long(struct.unpack("<q", data[position:position + 8])[0])
-    position += 8
-    return value, position
+    return long(_UNPACK_LONG(data, position)[0]), position + 8
 
 
 _element_getter = {
@@ -246,32 +277,52 @@ _element_getter = {
     "\x7F": lambda w, x, y, z: (MaxKey(), x)}
 
 
-def _element_to_dict(data, position, as_class, tz_aware):
-    element_type = data[position]
-    position += 1
-    element_name, position = _get_c_string(data, position)
-    value, position = _element_getter[element_type](data, position,
-                                                    as_class, tz_aware)
-    return element_name, value, position
-
-
-def _elements_to_dict(data, as_class, tz_aware):
+def _elements_to_dict(data, position, end, as_class, tz_aware):
+    """Decode the elements of the document whose elements start at
+    `position` and whose terminating NUL is at `end`.
+    """
     result = as_class()
-    position = 0
-    end = len(data) - 1
+    find = data.find
+    getter = _element_getter
     while position < end:
-        (key, value, position) = _element_to_dict(data, position, as_class, tz_aware)
+        element_type = data[position]
+        name_end = find("\x00", position + 1)
+        if name_end < 0:
+            raise InvalidBSON()
+        key = unicode(data[position + 1:name_end], "utf-8")
+        try:
+            value, position = getter[element_type](data, name_end + 1,
+                                                   as_class, tz_aware)
+        except KeyError:
+            raise InvalidBSON("no decoder for element type %r" %
+                              element_type)
         result[key] = value
+    if position != end:
+        raise InvalidBSON("bad object length")
     return result
 
+
+def _document_at(data, position, as_class, tz_aware):
+    """Decode the top level document at `position`, returning it and the
+    position just past it.
+    """
+    try:
+        obj_size = _UNPACK_INT(data, position)[0]
+        end = position + obj_size - 1
+        if len(data) < position + obj_size:
+            raise InvalidBSON("objsize too large")
+        if obj_size < 5 or data[end] != "\x00":
+            raise InvalidBSON("bad eoo")
+        return (_elements_to_dict(data, position + 4, end,
+                                  as_class, tz_aware), end + 1)
+    except (struct.error, IndexError):
+        raise InvalidBSON("truncated document")
+
+
 def _bson_to_dict(data, as_class, tz_aware):
-    obj_size = struct.unpack("<i", data[:4])[0]
-    if len(data) < obj_size:
-        raise InvalidBSON("objsize too large")
-    if data[obj_size - 1] != "\x00":
-        raise InvalidBSON("bad eoo")
-    elements = data[4:obj_size - 1]
-    return (_elements_to_dict(elements, as_class, tz_aware), data[obj_size:])
+    data = _as_str(data)
+    document, position = _document_at(data, 0, as_class, tz_aware)
+    return document, data[position:]
 if _use_c:
     _bson_to_dict = _cbson._bson_to_dict
 
@@ -374,6 +425,9 @@ def _element_to_bson(key, value, check_keys, uuid_subtype):
         return "\xFF" + name
     if isinstance(value, MaxKey):
         return "\x7F" + name
+    # Any other mapping (e.g. a bson.lazy.LazyDocument) is a document too.
+    if isinstance(value, Mapping):
+        return "\x03" + name + _dict_to_bson(value, check_keys, uuid_subtype, False)
 
     raise InvalidDocument("cannot convert value of type %s to bson" %
                           type(value))
@@ -413,8 +467,8 @@ def _to_dicts(data, as_class=dict, tz_aware=True):
 def decode_all(data, as_class=dict, tz_aware=True):
     """Decode BSON data to multiple documents.
 
-    `data` must be a string of concatenated, valid, BSON-encoded
-    documents.
+    `data` must be a string (or any object supporting the buffer
+    interface) of concatenated, valid, BSON-encoded documents.
 
     :Parameters:
       - `data`: BSON data
@@ -425,18 +479,13 @@ def decode_all(data, as_class=dict, tz_aware=True):
 
     .. versionadded:: 1.9
     """
+    data = _as_str(data)
     docs = []
     position = 0
     end = len(data) - 1
     while position < end:
-        obj_size = struct.unpack("<i", data[position:position + 4])[0]
-        if len(data) - position < obj_size:
-           raise InvalidBSON("objsize too large")
-        if data[position + obj_size - 1] != "\x00":
-            raise InvalidBSON("bad eoo")
-        elements = data[position + 4:position + obj_size - 1]
-        position += obj_size
-        docs.append(_elements_to_dict(elements, as_class, tz_aware))
+        document, position = _document_at(data, position, as_class, tz_aware)
+        docs.append(document)
     return docs
 if _use_c:
     decode_all = _cbson.decode_all
@@ -0,0 +1,272 @@
+# Copyright 2009-2010 10gen, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Documents that are only decoded as far as they are read.
+
+Pass :class:`LazyDocument` as the `as_class` of a query (or as the
+`document_class` of a connection) to get results that keep their raw BSON
+and decode each value the first time it is read.
+"""
+
+import struct
+from collections import MutableMapping
+
+import bson
+from bson.errors import InvalidBSON
+
+_UNPACK_INT = bson._UNPACK_INT
+
+# Bytes taken by the values of fixed size element types.
+_FIXED_SIZES = {
+    "\x01": 8,
+    "\x06": 0,
+    "\x07": 12,
+    "\x08": 1,
+    "\x09": 8,
+    "\x0A": 0,
+    "\x10": 4,
+    "\x11": 8,
+    "\x12": 8,
+    "\xFF": 0,
+    "\x7F": 0}
+
+
+def _skip(data, element_type, position):
+    """Return the position just past the value starting at `position`,
+    without decoding it.
+    """
+    try:
+        return position + _FIXED_SIZES[element_type]
+    except KeyError:
+        pass
+    if element_type in "\x02\x0D\x0E":
+        end = position + 4 + _UNPACK_INT(data, position)[0]
+    elif element_type in "\x03\x04\x0F":
+        end = position + _UNPACK_INT(data, position)[0]
+    elif element_type == "\x05":
+        end = position + 5 + _UNPACK_INT(data, position)[0]
+    elif element_type == "\x0C":
+        end = position + 16 + _UNPACK_INT(data, position)[0]
+    elif element_type == "\x0B":
+        end = data.find("\x00", data.find("\x00", position) + 1) + 1
+    else:
+        raise InvalidBSON("no decoder for element type %r" % element_type)
+    if end <= position:
+        raise InvalidBSON("bad element length")
+    return end
+
+
+def _decode(data, element_type, position, tz_aware):
+    """Decode one value, embedded documents become lazy as well.
+    """
+    if element_type == "\x03":
+        document = LazyDocument(data, tz_aware, position)
+        if "$ref" in document:
+            return bson._get_object(data, position, dict, tz_aware)[0]
+        return document
+    if element_type == "\x04":
+        end = position + _UNPACK_INT(data, position)[0] - 1
+        position += 4
+        result = []
+        while position < end:
+            element_type = data[position]
+            position = data.find("\x00", position + 1) + 1
+            if not position:
+                raise InvalidBSON()
+            result.append(_decode(data, element_type, position, tz_aware))
+            position = _skip(data, element_type, position)
+        return result
+    try:
+        getter = bson._element_getter[element_type]
+    except KeyError:
+        raise InvalidBSON("no decoder for element type %r" % element_type)
+    return getter(data, position, dict, tz_aware)[0]
+
+
+def _key(key):
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    return key
+
+
+def _materialize(value, as_class):
+    if isinstance(value, LazyDocument):
+        return value.materialize(as_class)
+    if isinstance(value, list):
+        return [_materialize(v, as_class) for v in value]
+    return value
+
+
+class LazyDocument(MutableMapping):
+    """A BSON document that decodes each value the first time it is read.
+
+    The first access walks the raw bytes once to find the keys, values are
+    skipped over rather than decoded. Embedded documents, including those
+    in arrays, are :class:`LazyDocument` instances over the same bytes.
+    Keys can be assigned and deleted like in a :class:`dict`, but
+    :attr:`raw` always holds the bytes the document was decoded from.
+
+    :Parameters:
+      - `data` (optional): string containing the BSON document, an empty
+        document if omitted
+      - `tz_aware` (optional): if ``True``, return timezone-aware
+        :class:`~datetime.datetime` instances
+      - `position` (optional): where the document starts in `data`
+    """
+
+    def __init__(self, data=None, tz_aware=False, position=0):
+        if data is None:
+            data = "\x05\x00\x00\x00\x00"
+        try:
+            end = position + _UNPACK_INT(data, position)[0] - 1
+            if end < position + 4 or data[end] != "\x00":
+                raise InvalidBSON("bad eoo")
+        except (struct.error, IndexError):
+            raise InvalidBSON("objsize too large")
+        self.__data = data
+        self.__tz_aware = tz_aware
+        self.__start = position
+        self.__end = end
+        self.__keys = None
+        self.__offsets = None
+        self.__values = {}
+
+    @classmethod
+    def decode_all(cls, data, tz_aware=True):
+        """Return a lazy document for each of the concatenated, BSON-encoded
+        documents in `data`.
+        """
+        data = bson._as_str(data)
+        docs = []
+        position = 0
+        end = len(data) - 1
+        while position < end:
+            obj_size = _UNPACK_INT(data, position)[0]
+            if obj_size < 5 or len(data) - position < obj_size:
+                raise InvalidBSON("objsize too large")
+            docs.append(cls(data[position:position + obj_size], tz_aware))
+            position += obj_size
+        return docs
+
+    @property
+    def raw(self):
+        """The BSON this document was decoded from.
+        """
+        return self.__data[self.__start:self.__end + 1]
+
+    def __index(self):
+        # Keys are kept as the UTF-8 strings they are stored as, ASCII
+        # unicode keys look them up unchanged and only iteration decodes them.
+        data = self.__data
+        keys = []
+        offsets = {}
+        position = self.__start + 4
+        end = self.__end
+        find = data.find
+        fixed = _FIXED_SIZES
+        try:
+            while position < end:
+                element_type = data[position]
+                name_end = find("\x00", position + 1)
+                if name_end < 0:
+                    raise InvalidBSON()
+                key = data[position + 1:name_end]
+                keys.append(key)
+                position = name_end + 1
+                offsets[key] = (element_type, position)
+                # Strings and fixed size values are the common case and are
+                # skipped inline.
+                if element_type == "\x02":
+                    length = _UNPACK_INT(data, position)[0]
+                    if length < 1:
+                        raise InvalidBSON("bad string length")
+                    position += 4 + length
+                elif element_type in fixed:
+                    position += fixed[element_type]
+                else:
+                    position = _skip(data, element_type, position)
+        except (struct.error, IndexError):
+            raise InvalidBSON("truncated document")
+        if position != end:
+            raise InvalidBSON("bad object length")
+        self.__keys = keys
+        self.__offsets = offsets
+
+    def __getitem__(self, key):
+        values = self.__values
+        try:
+            return values[key]
+        except KeyError:
+            pass
+        if self.__keys is None:
+            self.__index()
+        key = _key(key)
+        if key in values:
+            return values[key]
+        element_type, position = self.__offsets[key]
+        value = _decode(self.__data, element_type, position, self.__tz_aware)
+        values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.__keys.append(_key(key))
+        self.__values[_key(key)] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        key = _key(key)
+        self.__keys.remove(key)
+        self.__offsets.pop(key, None)
+        self.__values.pop(key, None)
+
+    def __contains__(self, key):
+        if self.__keys is None:
+            self.__index()
+        key = _key(key)
+        return key in self.__offsets or key in self.__values
+
+    def __iter__(self):
+        if self.__keys is None:
+            self.__index()
+        for key in self.__keys:
+            yield unicode(key, "utf-8")
+
+    def __len__(self):
+        if self.__keys is None:
+            self.__index()
+        return len(self.__keys)
+
+    def materialize(self, as_class=dict):
+        """Decode the whole document into an instance of `as_class`.
+        """
+        if self.__keys is None:
+            return bson._elements_to_dict(self.__data, self.__start + 4,
+                                          self.__end, as_class,
+                                          self.__tz_aware)
+        result = as_class()
+        values = self.__values
+        for key in self.__keys:
+            if key in values:
+                value = _materialize(values[key], as_class)
+            else:
+                element_type, position = self.__offsets[key]
+                value = bson._element_getter[element_type](
+                    self.__data, position, as_class, self.__tz_aware)[0]
+            result[unicode(key, "utf-8")] = value
+        return result
+
+    def __repr__(self):
+        return "LazyDocument(%r)" % (self.materialize(),)
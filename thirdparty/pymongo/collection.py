@@ -16,6 +16,8 @@
 
 import warnings
 
+from collections import Mapping
+
 from bson.binary import OLD_UUID_SUBTYPE, UUID_SUBTYPE
 from bson.code import Code
 from bson.son import SON
@@ -23,7 +25,11 @@ from pymongo import (common,
                      helpers,
                      message)
 from pymongo.cursor import Cursor
-from pymongo.errors import ConfigurationError, InvalidName, InvalidOperation
+from pymongo.errors import (_bulk_insert_error,
+                            ConfigurationError,
+                            InvalidName,
+                            InvalidOperation,
+                            OperationFailure)
 
 _ZERO = "\x00\x00\x00\x00"
 
@@ -200,8 +206,8 @@ class Collection(common.BaseObject):
         the ``"_id"`` will be added by the server but this method will
         return ``None``.
 
-        Raises :class:`TypeError` if `to_save` is not an instance of
-        :class:`dict`. If `safe` is ``True`` then the save will be
+        Raises :class:`TypeError` if `to_save` is not a mapping type,
+        e.g. a :class:`dict` or a :class:`~bson.lazy.LazyDocument`. If `safe` is ``True`` then the save will be
         checked for errors, raising
         :class:`~pymongo.errors.OperationFailure` if one
         occurred. Safe inserts wait for a response from the database,
@@ -221,13 +227,15 @@ class Collection(common.BaseObject):
             ``safe=True``, and will be used as options for the
             `getLastError` command
 
+        .. versionchanged:: 2.1+
+           Any mapping type can be saved.
         .. versionadded:: 1.8
            Support for passing `getLastError` options as keyword
            arguments.
 
         .. mongodoc:: insert
         """
-        if not isinstance(to_save, dict):
+        if not isinstance(to_save, Mapping):
             raise TypeError("cannot save object of type %s" % type(to_save))
 
         if "_id" not in to_save:
@@ -238,7 +246,8 @@ class Collection(common.BaseObject):
             return to_save.get("_id", None)
 
     def insert(self, doc_or_docs, manipulate=True,
-               safe=False, check_keys=True, continue_on_error=False, **kwargs):
+               safe=False, check_keys=True, continue_on_error=False,
+               return_results=False, **kwargs):
         """Insert a document(s) into this collection.
 
         If `manipulate` is ``True``, the document(s) are manipulated using
@@ -261,6 +270,21 @@ class Collection(common.BaseObject):
         command. For example, to wait for replication to 3 nodes, pass
         ``w=3``.
 
+        A bulk insert larger than the server's
+        :attr:`~pymongo.connection.Connection.max_message_size` is split
+        into several messages which are sent one after the other. In safe
+        mode each of them is checked with its own `getLastError`; if any
+        fails :class:`~pymongo.errors.BulkInsertError` (which is also an
+        instance of the failure's own class) is raised once the
+        batches have been sent (only up to the failed one, unless
+        `continue_on_error` is ``True``), its
+        :attr:`~pymongo.errors.BulkInsertError.results` tell which
+        documents were inserted. Documents larger than
+        :attr:`~pymongo.connection.Connection.max_bson_size` raise
+        :class:`~bson.errors.InvalidDocument` before anything is sent.
+        With `return_results` the same per message results are returned
+        after a successful insert as well.
+
         :Parameters:
           - `doc_or_docs`: a document or list of documents to be
             inserted
@@ -276,12 +300,21 @@ class Collection(common.BaseObject):
             inserts, except lastError will be set if any insert fails, not just
             the last one. If multiple errors occur, only the most recent will
             be reported by :meth:`~pymongo.database.Database.error`.
+          - `return_results` (optional): return a tuple of the ``"_id"``
+            value(s) and a list with one dict per message sent, like
+            :attr:`~pymongo.errors.BulkInsertError.results`, whose
+            ``"response"`` is that message's *lastError* response (``None``
+            unless `safe`)
           - `**kwargs` (optional): any additional arguments imply
             ``safe=True``, and will be used as options for the
             `getLastError` command
 
         .. note:: `continue_on_error` requires server version **>= 1.9.1**
 
+        .. versionchanged:: 2.1+
+           Bulk inserts are split to fit the server's maximum message
+           size. Any mapping type can be inserted. The `return_results`
+           parameter.
         .. versionadded:: 2.1
            Support for continue_on_error.
         .. versionadded:: 1.8
@@ -294,7 +327,7 @@ class Collection(common.BaseObject):
         """
         docs = doc_or_docs
         return_one = False
-        if isinstance(docs, dict):
+        if isinstance(docs, Mapping):
             return_one = True
             docs = [docs]
 
@@ -306,20 +339,66 @@ class Collection(common.BaseObject):
             if not kwargs:
                 kwargs.update(self.get_lasterror_options())
 
-        self.__database.connection._send_message(
-            message.insert(self.__full_name, docs,
-                           check_keys, safe, kwargs,
-                           continue_on_error, self.__uuid_subtype), safe)
+        connection = self.__database.connection
+        max_message_size = (getattr(connection, "max_message_size", 0) or
+                            common.MAX_MESSAGE_SIZE)
+        messages = message.insert_batches(self.__full_name, docs,
+                                          check_keys, safe, kwargs,
+                                          continue_on_error,
+                                          self.__uuid_subtype,
+                                          getattr(connection,
+                                                  "max_bson_size", 0),
+                                          max_message_size)
 
         ids = [doc.get("_id", None) for doc in docs]
+        if len(messages) == 1 and not return_results:
+            connection._send_message(messages[0][0], safe)
+        else:
+            results = self.__send_batches(connection, messages, ids,
+                                          safe, continue_on_error)
+            if return_results:
+                return return_one and ids[0] or ids, results
         return return_one and ids[0] or ids
 
+    def __send_batches(self, connection, messages, ids,
+                       safe, continue_on_error):
+        """Send the messages of a split bulk insert in order and return
+        their results.
+
+        Unsafe messages are written back to back without waiting. Safe
+        ones are checked one at a time and the failures collected into a
+        :class:`~pymongo.errors.BulkInsertError`. A failure of a single
+        message is raised as it is.
+        """
+        results = []
+        failure = None
+        position = 0
+        for msg, count in messages:
+            result = {"ids": ids[position:position + count],
+                      "sent": False,
+                      "error": None,
+                      "response": None}
+            results.append(result)
+            position += count
+            if failure is not None and not continue_on_error:
+                continue
+            try:
+                result["response"] = connection._send_message(msg, safe)
+            except OperationFailure, why:
+                result["error"] = failure = why
+            result["sent"] = True
+        if failure is not None:
+            if len(results) == 1:
+                raise failure
+            raise _bulk_insert_error(failure, results)
+        return results
+
     def update(self, spec, document, upsert=False, manipulate=False,
                safe=False, multi=False, _check_keys=False, **kwargs):
         """Update a document(s) in this collection.
 
         Raises :class:`TypeError` if either `spec` or `document` is
-        not an instance of ``dict`` or `upsert` is not an instance of
+        not a mapping type or `upsert` is not an instance of
         ``bool``. If `safe` is ``True`` then the update will be
         checked for errors, raising
         :class:`~pymongo.errors.OperationFailure` if one
@@ -351,11 +430,11 @@ class Collection(common.BaseObject):
         ``w=3``.
 
         :Parameters:
-          - `spec`: a ``dict`` or :class:`~bson.son.SON` instance
+          - `spec`: a ``dict``, :class:`~bson.son.SON` or other mapping
             specifying elements which must be present for a document
             to be updated
-          - `document`: a ``dict`` or :class:`~bson.son.SON`
-            instance specifying the document to be used for the update
+          - `document`: a ``dict``, :class:`~bson.son.SON` or other
+            mapping specifying the document to be used for the update
             or (in the case of an upsert) insert - see docs on MongoDB
             `update modifiers`_
           - `upsert` (optional): perform an upsert if ``True``
@@ -375,6 +454,8 @@ class Collection(common.BaseObject):
             ``safe=True``, and will be used as options for the
             `getLastError` command
 
+        .. versionchanged:: 2.1+
+           `spec` and `document` can be any mapping type.
         .. versionadded:: 1.8
            Support for passing `getLastError` options as keyword
            arguments.
@@ -387,10 +468,10 @@ class Collection(common.BaseObject):
 
         .. mongodoc:: update
         """
-        if not isinstance(spec, dict):
-            raise TypeError("spec must be an instance of dict")
-        if not isinstance(document, dict):
-            raise TypeError("document must be an instance of dict")
+        if not isinstance(spec, Mapping):
+            raise TypeError("spec must be a mapping type")
+        if not isinstance(document, Mapping):
+            raise TypeError("document must be a mapping type")
         if not isinstance(upsert, bool):
             raise TypeError("upsert must be an instance of bool")
 
@@ -474,7 +555,7 @@ class Collection(common.BaseObject):
         """
         if spec_or_id is None:
             spec_or_id = {}
-        if not isinstance(spec_or_id, dict):
+        if not isinstance(spec_or_id, Mapping):
             spec_or_id = {"_id": spec_or_id}
 
         if self.safe or kwargs:
@@ -514,7 +595,7 @@ class Collection(common.BaseObject):
            instance as an ``"_id"`` query, not just
            :class:`~bson.objectid.ObjectId` instances.
         """
-        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+        if spec_or_id is not None and not isinstance(spec_or_id, Mapping):
             spec_or_id = {"_id": spec_or_id}
 
         for result in self.find(spec_or_id, *args, **kwargs).limit(-1):
@@ -577,7 +658,9 @@ class Collection(common.BaseObject):
             examined when performing the query
           - `as_class` (optional): class to use for documents in the
             query result (default is
-            :attr:`~pymongo.connection.Connection.document_class`)
+            :attr:`~pymongo.connection.Connection.document_class`). Pass
+            :class:`~bson.lazy.LazyDocument` to only decode the values
+            that are read
           - `slave_okay` (optional): if True, allows this query to
             be run against a replica secondary.
           - `await_data` (optional): if True, the server will block for
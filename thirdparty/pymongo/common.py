@@ -19,6 +19,13 @@ import warnings
 from pymongo import ReadPreference
 from pymongo.errors import ConfigurationError
 
+# Defaults for servers that don't report their limits in ismaster.
+MAX_BSON_SIZE = 4 * 1024 * 1024
+MAX_MESSAGE_SIZE = 48 * 1000 * 1000
+# Seconds a thread waits for a pooled socket unless waitQueueTimeoutMS
+# says otherwise.
+WAIT_QUEUE_TIMEOUT = 120.0
+
 
 def raise_config_error(key, dummy):
     """Raise ConfigurationError with the given key name."""
@@ -115,6 +122,8 @@ VALIDATORS = {
     'journal': validate_boolean,
     'connecttimeoutms': validate_timeout_or_none,
     'sockettimeoutms': validate_timeout_or_none,
+    'waitqueuetimeoutms': validate_timeout_or_none,
+    'maxidletimems': validate_timeout_or_none,
     'ssl': validate_boolean,
     'read_preference': validate_read_preference,
 }
@@ -48,6 +48,7 @@ from pymongo import (common,
                      message,
                      uri_parser)
 from pymongo.cursor_manager import CursorManager
+from pymongo.pool import Pool
 from pymongo.errors import (AutoReconnect,
                             ConfigurationError,
                             ConnectionFailure,
@@ -56,28 +57,12 @@ from pymongo.errors import (AutoReconnect,
                             InvalidURI,
                             OperationFailure)
 
-if sys.platform.startswith('java'):
-    from select import cpython_compatible_select as select
-else:
-    from select import select
-
 have_ssl = True
 try:
     import ssl
 except ImportError:
     have_ssl = False
 
-def _closed(sock):
-    """Return True if we know socket has been closed, False otherwise.
-    """
-    try:
-        rd, _, _ = select([sock], [], [], 0)
-    # Any exception here is equally bad (select.error, ValueError, etc.).
-    except:
-        return True
-    return len(rd) > 0
-
-
 def _partition_node(node):
     """Split a host:port string returned from mongod/s into
     a (host, int(port)) pair needed for socket.connect().
@@ -92,98 +77,6 @@ def _partition_node(node):
     return host, port
 
 
-class _Pool(threading.local):
-    """A simple connection pool.
-
-    Uses thread-local socket per thread. By calling return_socket() a
-    thread can return a socket to the pool.
-    """
-
-    # Non thread-locals
-    __slots__ = ["pid", "max_size", "net_timeout",
-                 "conn_timeout", "use_ssl", "sockets"]
-
-    # thread-local default
-    sock = None
-
-    def __init__(self, max_size, net_timeout, conn_timeout, use_ssl):
-        self.pid = os.getpid()
-        self.max_size = max_size
-        self.net_timeout = net_timeout
-        self.conn_timeout = conn_timeout
-        self.use_ssl = use_ssl
-        if not hasattr(self, "sockets"):
-            self.sockets = []
-
-    def connect(self, host, port):
-        """Connect to Mongo and return a new (connected) socket.
-        """
-        try:
-            # Prefer IPv4. If there is demand for an option
-            # to specify one or the other we can add it later.
-            s = socket.socket(socket.AF_INET)
-            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            s.settimeout(self.conn_timeout or 20.0)
-            s.connect((host, port))
-        except socket.gaierror:
-            # If that fails try IPv6
-            s = socket.socket(socket.AF_INET6)
-            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            s.settimeout(self.conn_timeout or 20.0)
-            s.connect((host, port))
-
-        if self.use_ssl:
-            try:
-                s = ssl.wrap_socket(s)
-            except ssl.SSLError:
-                s.close()
-                raise ConnectionFailure("SSL handshake failed. MongoDB may "
-                                        "not be configured with SSL support.")
-
-        s.settimeout(self.net_timeout)
-
-        return s
-
-    def get_socket(self, host, port):
-        # We use the pid here to avoid issues with fork / multiprocessing.
-        # See test.test_connection:TestConnection.test_fork for an example of
-        # what could go wrong otherwise
-        pid = os.getpid()
-
-        if pid != self.pid:
-            self.sock = None
-            self.sockets = []
-            self.pid = pid
-
-        if self.sock is not None and self.sock[0] == pid:
-            return (self.sock[1], True)
-
-        try:
-            self.sock = (pid, self.sockets.pop())
-            return (self.sock[1], True)
-        except IndexError:
-            self.sock = (pid, self.connect(host, port))
-            return (self.sock[1], False)
-
-    def discard_socket(self):
-        """Close and discard the active socket.
-        """
-        if self.sock:
-            self.sock[1].close()
-            self.sock = None
-
-    def return_socket(self):
-        if self.sock is not None and self.sock[0] == os.getpid():
-            # There's a race condition here, but we deliberately
-            # ignore it.  It means that if the pool_size is 10 we
-            # might actually keep slightly more than that.
-            if len(self.sockets) < self.max_size:
-                self.sockets.append(self.sock[1])
-            else:
-                self.sock[1].close()
-        self.sock = None
-
-
 class Connection(common.BaseObject):
     """Connection to MongoDB.
     """
@@ -191,7 +84,8 @@ class Connection(common.BaseObject):
     HOST = "localhost"
     PORT = 27017
 
-    __max_bson_size = 4 * 1024 * 1024
+    __max_bson_size = common.MAX_BSON_SIZE
+    __max_message_size = common.MAX_MESSAGE_SIZE
 
     def __init__(self, host=None, port=None, max_pool_size=10,
                  network_timeout=None, document_class=dict,
@@ -227,8 +121,8 @@ class Connection(common.BaseObject):
             it must be enclosed in '[' and ']' characters following
             the RFC2732 URL syntax (e.g. '[::1]' for localhost)
           - `port` (optional): port number on which to connect
-          - `max_pool_size` (optional): The maximum size limit for
-            the connection pool.
+          - `max_pool_size` (optional): The maximum number of sockets
+            the connection pool will open, 0 for no limit.
           - `network_timeout` (optional): timeout (in seconds) to use
             for socket operations - default is no timeout
           - `document_class` (optional): default class to use for
@@ -263,13 +157,29 @@ class Connection(common.BaseObject):
             before timing out.
           - `connectTimeoutMS`: How long a connection can take to be opened
             before timing out.
+          - `waitQueueTimeoutMS`: How long a thread will wait for a socket
+            when `max_pool_size` sockets are already checked out before
+            raising :class:`~pymongo.errors.ConnectionFailure`. Defaults
+            to two minutes.
+          - `maxIdleTimeMS`: Close pooled sockets that have been idle for
+            this long.
           - `ssl`: If True, create the connection to the server using SSL.
           - `read_preference`: The read preference for this connection.
             See :class:`~pymongo.ReadPreference` for available options.
           - `slave_okay` or `slaveOk` (deprecated): Use `read_preference`
             instead.
 
+        .. warning:: Sockets are no longer pinned to threads. An unsafe
+           write and a read that follows it in the same thread may go out
+           on different sockets, so the read can miss the write. Use safe
+           writes, or call :meth:`start_request` to keep the thread on one
+           socket when it has to read its own unsafe writes.
+
         .. seealso:: :meth:`end_request`
+        .. versionchanged:: 2.1+
+           Sockets are shared by every thread and `max_pool_size` limits
+           the number of open sockets, see :class:`~pymongo.pool.Pool`.
+           Added `waitQueueTimeoutMS` and `maxIdleTimeMS`.
         .. versionchanged:: 2.1
            Support `w` = integer or string.
            Added `ssl` option.
@@ -358,12 +268,11 @@ class Connection(common.BaseObject):
                                      "are using a python version previous to "
                                      "2.6 you must install the ssl package "
                                      "from PyPI.")
-        self.__pool = _Pool(self.__max_pool_size,
-                            self.__net_timeout,
-                            self.__conn_timeout,
-                            self.__use_ssl)
-
-        self.__last_checkout = time.time()
+        self.__wait_queue_timeout = options.get('waitqueuetimeoutms',
+                                                common.WAIT_QUEUE_TIMEOUT)
+        self.__max_idle_time = options.get('maxidletimems')
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
 
         self.__document_class = document_class
         self.__tz_aware = tz_aware
@@ -571,6 +480,15 @@ class Connection(common.BaseObject):
         """
         return self.__max_bson_size
 
+    @property
+    def max_message_size(self):
+        """Return the maximum size message the connected server accepts in
+        bytes. Defaults to 48MB for servers that don't report it.
+
+        .. versionadded:: 2.1+
+        """
+        return self.__max_message_size
+
     def __try_node(self, node):
         """Try to connect to this node and see if it works
         for our connection type.
@@ -586,6 +504,8 @@ class Connection(common.BaseObject):
 
         if "maxBsonObjectSize" in response:
             self.__max_bson_size = response["maxBsonObjectSize"]
+        if "maxMessageSizeBytes" in response:
+            self.__max_message_size = response["maxMessageSizeBytes"]
 
         # Replica Set?
         if len(self.__nodes) > 1 or self.__repl:
@@ -658,36 +578,64 @@ class Connection(common.BaseObject):
         self.disconnect()
         raise AutoReconnect(', '.join(errors))
 
+    def __get_pool(self, host, port):
+        pool = self.__pool
+        if pool is None or pool.host != (host, port):
+            self.__pool_lock.acquire()
+            try:
+                pool = self.__pool
+                if pool is None or pool.host != (host, port):
+                    pool = Pool((host, port),
+                                self.__max_pool_size,
+                                self.__net_timeout,
+                                self.__conn_timeout,
+                                self.__use_ssl,
+                                self.__wait_queue_timeout,
+                                self.__max_idle_time)
+                    self.__pool = pool
+            finally:
+                self.__pool_lock.release()
+        return pool
+
     def __socket(self):
-        """Get a socket from the pool.
+        """Check a socket out of the pool, returns a (pool, socket) pair.
 
-        If it's been > 1 second since the last time we checked out a
-        socket, we also check to see if the socket has been closed -
-        this let's us avoid seeing *some*
+        The pool checks that sockets which have been idle for a while are
+        still open, this let's us avoid seeing *some*
         :class:`~pymongo.errors.AutoReconnect` exceptions on server
-        hiccups, etc. We only do this if it's been > 1 second since
-        the last socket checkout, to keep performance reasonable - we
-        can't avoid those completely anyway.
+        hiccups, etc. New sockets are authenticated with the cached
+        credentials.
         """
         host, port = (self.__host, self.__port)
         if host is None or port is None:
             host, port = self.__find_node()
 
+        pool = self.__get_pool(host, port)
         try:
-            sock, from_pool = self.__pool.get_socket(host, port)
+            sock, authset = pool.get_socket()
         except socket.error, why:
             self.disconnect()
             raise AutoReconnect("could not connect to "
                                 "%s:%d: %s" % (host, port, str(why)))
-        t = time.time()
-        if t - self.__last_checkout > 1:
-            if _closed(sock):
-                self.disconnect()
-                sock, from_pool = self.__pool.get_socket(host, port)
-        self.__last_checkout = t
-        if self.__auth_credentials and not from_pool:
-            self.__authenticate_socket()
-        return sock
+        if self.__auth_credentials and not authset:
+            # Authenticating runs commands on this same socket.
+            authset.update(self.__auth_credentials)
+            try:
+                self.__authenticate_socket()
+            except:
+                pool.discard_socket()
+                raise
+        return pool, sock
+
+    @property
+    def pool_stats(self):
+        """Checkout, wait, timeout, creation and discard counts of the
+        current connection pool.
+        """
+        pool = self.__pool
+        if pool is None:
+            return {}
+        return dict(pool.stats, size=pool.count, idle=len(pool.sockets))
 
     def disconnect(self):
         """Disconnect from MongoDB.
@@ -702,10 +650,9 @@ class Connection(common.BaseObject):
         .. seealso:: :meth:`end_request`
         .. versionadded:: 1.3
         """
-        self.__pool = _Pool(self.__max_pool_size,
-                            self.__net_timeout,
-                            self.__conn_timeout,
-                            self.__use_ssl)
+        pool, self.__pool = self.__pool, None
+        if pool is not None:
+            pool.close()
         self.__host = None
         self.__port = None
 
@@ -808,41 +755,48 @@ class Connection(common.BaseObject):
           - `with_last_error`: check getLastError status after sending the
             message
         """
-        sock = self.__socket()
+        (request_id, data) = self.__check_bson_size(message)
+        pool, sock = self.__socket()
         try:
-            (request_id, data) = self.__check_bson_size(message)
             sock.sendall(data)
             # Safe mode. We pack the message together with a lastError
             # message and send both. We then get the response (to the
             # lastError) and raise OperationFailure if it is an error
             # response.
+            response = None
             if with_last_error:
                 response = self.__receive_message_on_socket(1, request_id,
                                                             sock)
-                return self.__check_response_to_last_error(response)
-            return None
         except (ConnectionFailure, socket.error), e:
+            pool.discard_socket()
             self.disconnect()
             raise AutoReconnect(str(e))
+        except:
+            pool.discard_socket()
+            raise
+        pool.return_socket()
+
+        if with_last_error:
+            return self.__check_response_to_last_error(response)
+        return None
 
     def __receive_data_on_socket(self, length, sock):
         """Lowest level receive operation.
 
-        Takes length to receive and repeatedly calls recv until able to
-        return a buffer of that length, raising ConnectionFailure on error.
+        Takes length to receive and repeatedly calls recv_into until it has
+        filled a :class:`bytearray` of that length, raising
+        ConnectionFailure on error. The data is read straight into the
+        buffer, it is never copied or concatenated.
         """
-        message = ""
-        while len(message) < length:
-            try:
-                chunk = sock.recv(length - len(message))
-            except:
-                # If recv was interrupted, discard the socket
-                # and re-raise the exception.
-                self.__pool.discard_socket()
-                raise
-            if chunk == "":
+        message = bytearray(length)
+        view = memoryview(message)
+        received = 0
+        while received < length:
+            # If recv is interrupted the caller discards the socket.
+            chunk_length = sock.recv_into(view[received:])
+            if not chunk_length:
                 raise ConnectionFailure("connection closed")
-            message += chunk
+            received += chunk_length
         return message
 
     def __receive_message_on_socket(self, operation, request_id, sock):
@@ -851,11 +805,10 @@ class Connection(common.BaseObject):
         Returns the response data with the header removed.
         """
         header = self.__receive_data_on_socket(16, sock)
-        length = struct.unpack("<i", header[:4])[0]
-        assert request_id == struct.unpack("<i", header[8:12])[0], \
-            "ids don't match %r %r" % (request_id,
-                                       struct.unpack("<i", header[8:12])[0])
-        assert operation == struct.unpack("<i", header[12:])[0]
+        length, _, response_to, op_code = struct.unpack_from("<iiii", header)
+        assert request_id == response_to, \
+            "ids don't match %r %r" % (request_id, response_to)
+        assert operation == op_code
 
         return self.__receive_data_on_socket(length - 16, sock)
 
@@ -877,32 +830,35 @@ class Connection(common.BaseObject):
         :Parameters:
           - `message`: (request_id, data) pair making up the message to send
         """
-        sock = self.__socket()
+        pool, sock = self.__socket()
 
         try:
-            try:
-                if "network_timeout" in kwargs:
-                    sock.settimeout(kwargs["network_timeout"])
-                return self.__send_and_receive(message, sock)
-            except (ConnectionFailure, socket.error), e:
-                self.disconnect()
-                raise AutoReconnect(str(e))
-        finally:
             if "network_timeout" in kwargs:
-                try:
-                    sock.settimeout(self.__net_timeout)
-                except socket.error:
-                    # There was an exception and we've closed the socket
-                    pass
+                sock.settimeout(kwargs["network_timeout"])
+            response = self.__send_and_receive(message, sock)
+            if "network_timeout" in kwargs:
+                sock.settimeout(self.__net_timeout)
+        except (ConnectionFailure, socket.error), e:
+            pool.discard_socket()
+            self.disconnect()
+            raise AutoReconnect(str(e))
+        except:
+            pool.discard_socket()
+            raise
+        pool.return_socket()
+        return response
 
     def start_request(self):
-        """DEPRECATED all operations will start a request.
+        """Keep using the same socket in this thread until
+        :meth:`end_request` is called.
 
-        .. versionchanged:: 1.4
-           DEPRECATED
+        Sockets are shared by every thread and only checked out for one
+        operation at a time. A thread that needs to read its own unsafe
+        writes should do so inside a request.
         """
-        warnings.warn("the Connection.start_request method is deprecated",
-                      DeprecationWarning)
+        pool, sock = self.__socket()
+        pool.start_request()
+        pool.return_socket()
 
     def end_request(self):
         """Allow this thread's connection to return to the pool.
@@ -923,7 +879,9 @@ class Connection(common.BaseObject):
         finished, as otherwise its :class:`~socket.socket` will not be
         reclaimed.
         """
-        self.__pool.return_socket()
+        pool = self.__pool
+        if pool is not None:
+            pool.end_request()
 
     def __cmp__(self, other):
         if isinstance(other, Connection):
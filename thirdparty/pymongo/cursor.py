@@ -14,6 +14,10 @@
 
 """Cursor class to iterate over Mongo query results."""
 
+import Queue
+import threading
+from collections import deque, Mapping
+
 from bson.code import Code
 from bson.son import SON
 from pymongo import (helpers,
@@ -32,6 +36,76 @@ _QUERY_OPTIONS = {
     "partial": 128}
 
 
+class _Prefetcher(object):
+    """Sends the getMores of a cursor from a background thread, keeping up
+    to `batches` unpacked replies queued ahead of the cursor.
+
+    The thread holds no reference to the cursor, so an abandoned cursor is
+    still collected (and :meth:`cancel`\s its prefetcher). A failure is
+    queued in place of the reply and ends the thread.
+
+    Each getMore checks a socket out of the connection's pool for as long
+    as it runs, next to any socket the consuming thread holds.
+    """
+
+    # Seconds :meth:`cancel` waits for a getMore in flight.
+    cancel_timeout = 5
+
+    def __init__(self, fetch, full_name, cursor_id, retrieved,
+                 limit, batch_size, batches):
+        self.queue = Queue.Queue(batches)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       args=(fetch, full_name, cursor_id,
+                                             retrieved, limit, batch_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, fetch, full_name, cursor_id, retrieved, limit, batch_size):
+        try:
+            while not self.cancelled.isSet():
+                if limit:
+                    ntoreturn = limit - retrieved
+                    if batch_size:
+                        ntoreturn = min(ntoreturn, batch_size)
+                else:
+                    ntoreturn = batch_size
+                response = fetch(message.get_more(full_name, ntoreturn,
+                                                  cursor_id), cursor_id)
+                self.queue.put(response)
+                cursor_id = response["cursor_id"]
+                retrieved += response["number_returned"]
+                if not cursor_id or (limit and limit <= retrieved):
+                    return
+        except Exception, why:
+            self.queue.put(why)
+
+    def get(self):
+        """Return the next reply, raising the error the thread ran into
+        instead if it failed.
+        """
+        response = self.queue.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def cancel(self):
+        """Stop the thread, waiting (up to :attr:`cancel_timeout` seconds)
+        for the getMore it may be running so the cursor isn't killed while
+        that getMore is still in flight.
+        """
+        self.cancelled.set()
+        # Make room for a thread blocked on a full queue. It puts at most
+        # one more reply before it sees it was cancelled.
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        if self.thread is not threading.currentThread():
+            self.thread.join(self.cancel_timeout)
+
+
 # TODO might be cool to be able to do find().include("foo") or
 # find().exclude(["bar", "baz"]) or find().slice("a", 1, 2) as an
 # alternative to the fields specifier.
@@ -58,8 +132,8 @@ class Cursor(object):
         if spec is None:
             spec = {}
 
-        if not isinstance(spec, dict):
-            raise TypeError("spec must be an instance of dict")
+        if not isinstance(spec, Mapping):
+            raise TypeError("spec must be a mapping type")
         if not isinstance(skip, int):
             raise TypeError("skip must be an instance of int")
         if not isinstance(limit, int):
@@ -92,6 +166,7 @@ class Cursor(object):
         self.__skip = skip
         self.__limit = limit
         self.__batch_size = 0
+        self.__prefetch = 0
 
         # This is ugly. People want to be able to do cursor[5:5] and
         # get an empty result set (old behavior was an
@@ -120,10 +195,11 @@ class Cursor(object):
         self.__uuid_subtype = _uuid_subtype or collection.uuid_subtype
         self.__query_flags = 0
 
-        self.__data = []
+        self.__data = deque()
         self.__connection_id = None
         self.__retrieved = 0
         self.__killed = False
+        self.__prefetcher = None
 
         # this is for passing network_timeout through if it's specified
         # need to use kwargs as None is a legit value for network_timeout
@@ -151,7 +227,8 @@ class Cursor(object):
         be sent to the server, even if the resultant data has already been
         retrieved by this cursor.
         """
-        self.__data = []
+        self.__cancel_prefetch()
+        self.__data = deque()
         self.__id = None
         self.__connection_id = None
         self.__retrieved = 0
@@ -174,6 +251,7 @@ class Cursor(object):
         copy.__explain = self.__explain
         copy.__hint = self.__hint
         copy.__batch_size = self.__batch_size
+        copy.__prefetch = self.__prefetch
         copy.__max_scan = self.__max_scan
         copy.__as_class = self.__as_class
         copy.__slave_okay = self.__slave_okay
@@ -191,6 +269,7 @@ class Cursor(object):
     def __die(self):
         """Closes this cursor.
         """
+        self.__cancel_prefetch()
         if self.__id and not self.__killed:
             connection = self.__collection.database.connection
             if self.__connection_id is not None:
@@ -203,6 +282,9 @@ class Cursor(object):
         """Explicitly close this cursor. Required for PyPy, Jython and
         other Python implementations that don't use reference counting
         garbage collection.
+
+        Stops any read-ahead (see :meth:`prefetch`) before the cursor is
+        killed on the server.
         """
         self.__die()
 
@@ -317,6 +399,45 @@ class Cursor(object):
         self.__batch_size = batch_size == 1 and 2 or batch_size
         return self
 
+    def prefetch(self, batches=1):
+        """Read up to `batches` batches ahead on a background thread.
+
+        Once the first batch has arrived, each getMore is sent while the
+        batches before it are still being consumed, so processing the
+        documents overlaps with waiting on the network. At most `batches`
+        replies are held ahead of the consumer. ``0`` turns read-ahead off
+        (the default). Tailable cursors never read ahead.
+
+        The thread stops when the cursor is exhausted, closed, rewound or
+        garbage collected. Closing waits for a getMore in flight before
+        killing the cursor. Errors it runs into are raised by the call to
+        :meth:`next` that would have used its reply.
+
+        .. note:: Every getMore sent ahead checks a socket out of the
+           connection's pool, in addition to any socket the consuming
+           thread holds (in a request, for instance). Pools are bounded by
+           `max_pool_size`, so leave room for the read-ahead threads or
+           they will wait for sockets like any other thread.
+
+        Raises :class:`TypeError` if `batches` is not an instance of
+        :class:`int`. Raises :class:`ValueError` if `batches` is less
+        than ``0``. Raises :class:`~pymongo.errors.InvalidOperation` if
+        this :class:`Cursor` has already been used.
+
+        :Parameters:
+          - `batches` (optional): how many batches to read ahead
+
+        .. versionadded:: 2.1+
+        """
+        if not isinstance(batches, int):
+            raise TypeError("batches must be an int")
+        if batches < 0:
+            raise ValueError("batches must be >= 0")
+        self.__check_okay_to_chain()
+
+        self.__prefetch = batches
+        return self
+
     def skip(self, skip):
         """Skips the first `skip` results of this cursor.
 
@@ -602,15 +723,19 @@ class Cursor(object):
         self.__spec["$where"] = code
         return self
 
-    def __send_message(self, message):
-        """Send a query or getmore message and handles the response.
-        """
-        db = self.__collection.database
+    def __send_kwargs(self):
         kwargs = {"_must_use_master": self.__must_use_master}
         kwargs["read_preference"] = self.__read_preference
         if self.__connection_id is not None:
             kwargs["_connection_to_use"] = self.__connection_id
         kwargs.update(self.__kwargs)
+        return kwargs
+
+    def __send_message(self, message):
+        """Send a query or getmore message and handles the response.
+        """
+        db = self.__collection.database
+        kwargs = self.__send_kwargs()
 
         response = db.connection._send_message_with_response(message,
                                                              **kwargs)
@@ -629,6 +754,9 @@ class Cursor(object):
         except AutoReconnect:
             db.connection.disconnect()
             raise
+        self.__handle_response(response)
+
+    def __handle_response(self, response):
         self.__id = response["cursor_id"]
 
         # starting from doesn't get set on getmore's for tailable cursors
@@ -636,11 +764,57 @@ class Cursor(object):
             assert response["starting_from"] == self.__retrieved
 
         self.__retrieved += response["number_returned"]
-        self.__data = response["data"]
+        self.__data = deque(response["data"])
 
         if self.__limit and self.__id and self.__limit <= self.__retrieved:
             self.__die()
 
+    def __fetcher(self):
+        """Return a function that sends a getmore and unpacks the reply, for
+        the prefetch thread. It holds no reference to this cursor.
+        """
+        connection = self.__collection.database.connection
+        kwargs = self.__send_kwargs()
+        as_class = self.__as_class
+        tz_aware = self.__tz_aware
+
+        def fetch(message, cursor_id):
+            response = connection._send_message_with_response(message,
+                                                              **kwargs)
+            if isinstance(response, tuple):
+                response = response[1]
+            return helpers._unpack_response(response, cursor_id,
+                                            as_class, tz_aware)
+        return fetch
+
+    def __start_prefetch(self):
+        self.__prefetcher = _Prefetcher(self.__fetcher(),
+                                        self.__collection.full_name,
+                                        self.__id, self.__retrieved,
+                                        self.__limit, self.__batch_size,
+                                        self.__prefetch)
+
+    def __receive_prefetched(self):
+        """Take the next reply from the prefetch thread.
+        """
+        try:
+            response = self.__prefetcher.get()
+        except AutoReconnect:
+            self.__prefetcher = None
+            self.__collection.database.connection.disconnect()
+            raise
+        except:
+            self.__prefetcher = None
+            raise
+        self.__handle_response(response)
+        if not self.__id:
+            self.__prefetcher = None
+
+    def __cancel_prefetch(self):
+        if self.__prefetcher is not None:
+            self.__prefetcher.cancel()
+            self.__prefetcher = None
+
     def _refresh(self):
         """Refreshes the cursor with more data from Mongo.
 
@@ -666,6 +840,10 @@ class Cursor(object):
                               self.__uuid_subtype))
             if not self.__id:
                 self.__killed = True
+            elif self.__prefetch and not self.__tailable:
+                self.__start_prefetch()
+        elif self.__prefetcher is not None:  # Read ahead
+            self.__receive_prefetched()
         elif self.__id:  # Get More
             if self.__limit:
                 limit = self.__limit - self.__retrieved
@@ -702,12 +880,46 @@ class Cursor(object):
         db = self.__collection.database
         if len(self.__data) or self._refresh():
             if self.__manipulate:
-                return db._fix_outgoing(self.__data.pop(0), self.__collection)
+                return db._fix_outgoing(self.__data.popleft(),
+                                        self.__collection)
             else:
-                return self.__data.pop(0)
+                return self.__data.popleft()
         else:
             raise StopIteration
 
+    def next_batch(self):
+        """Return the rest of the current batch as a list, fetching the
+        next batch from the server if the current one is used up.
+
+        Outgoing SON manipulators are applied to the whole batch at once.
+        Raises :class:`StopIteration` when the cursor is exhausted, like
+        :meth:`next`. Use :meth:`batch_size` to control how many documents
+        the server sends at a time.
+
+        .. versionadded:: 2.1+
+        """
+        if self.__empty:
+            raise StopIteration
+        if not (len(self.__data) or self._refresh()):
+            raise StopIteration
+        batch = list(self.__data)
+        self.__data.clear()
+        if self.__manipulate:
+            db = self.__collection.database
+            return db._fix_outgoing_many(batch, self.__collection)
+        return batch
+
+    def iter_batches(self):
+        """Iterate over this cursor a batch (a list of documents) at a time.
+
+        Mixing this with :meth:`next` is fine, each batch starts with the
+        first document not yet returned. See :meth:`next_batch`.
+
+        .. versionadded:: 2.1+
+        """
+        while True:
+            yield self.next_batch()
+
     def __enter__(self):
         return self
 
@@ -267,6 +267,22 @@ class Database(common.BaseObject):
             son = manipulator.transform_outgoing(son, collection)
         return son
 
+    def _fix_outgoing_many(self, sons, collection):
+        """Apply manipulators to a list of SON objects as they come out of
+        the database, each manipulator is applied to the whole list in turn.
+
+        :Parameters:
+          - `sons`: list of son objects coming out of the database
+          - `collection`: the collection the son objects were saved in
+        """
+        for manipulator in reversed(self.__outgoing_manipulators):
+            transform = manipulator.transform_outgoing
+            sons = [transform(son, collection) for son in sons]
+        for manipulator in reversed(self.__outgoing_copying_manipulators):
+            transform = manipulator.transform_outgoing
+            sons = [transform(son, collection) for son in sons]
+        return sons
+
     def command(self, command, value=1,
                 check=True, allowable_errors=[],
                 uuid_subtype=OLD_UUID_SUBTYPE, **kwargs):
@@ -74,6 +74,46 @@ class DuplicateKeyError(OperationFailure):
     """
 
 
+class BulkInsertError(OperationFailure):
+    """Raised when a safe bulk insert that was split into several messages
+    fails.
+
+    :attr:`results` holds one dict per message, in order: ``"ids"`` (the
+    ``_id`` values of its documents), ``"sent"`` (whether it was sent),
+    ``"error"`` (the :class:`OperationFailure` it raised, or ``None``) and
+    ``"response"`` (its *lastError* response, if it succeeded).
+    The error and code are those of the last message that failed, and the
+    exception is also an instance of that failure's class, so handlers for
+    e.g. :class:`DuplicateKeyError` still catch it.
+
+    .. versionadded:: 2.1+
+    """
+
+    def __init__(self, error, code=None, results=None):
+        self.results = results or []
+        OperationFailure.__init__(self, error, code)
+
+
+_bulk_insert_errors = {}
+
+
+def _bulk_insert_error(failure, results):
+    """Return a :class:`BulkInsertError` for `failure` that is also an
+    instance of `failure`'s own class.
+    """
+    failure_class = type(failure)
+    if issubclass(BulkInsertError, failure_class):
+        error_class = BulkInsertError
+    else:
+        error_class = _bulk_insert_errors.get(failure_class)
+        if error_class is None:
+            error_class = type("BulkInsertError",
+                               (BulkInsertError, failure_class), {})
+            error_class.__module__ = __name__
+            _bulk_insert_errors[failure_class] = error_class
+    return error_class(str(failure), getattr(failure, "code", None), results)
+
+
 class InvalidOperation(PyMongoError):
     """Raised when a client attempts to perform an invalid operation.
     """
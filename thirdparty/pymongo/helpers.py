@@ -24,6 +24,7 @@ import random
 import struct
 
 import bson
+from bson.lazy import LazyDocument
 from bson.son import SON
 import pymongo
 from pymongo.errors import (AutoReconnect,
@@ -80,13 +81,15 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
     containing the response data.
 
     :Parameters:
-      - `response`: byte string as returned from the database
+      - `response`: byte string or :class:`bytearray` as returned from the
+        database
       - `cursor_id` (optional): cursor_id we sent to get this response -
         used for raising an informative exception when we get cursor id not
         valid at server response
-      - `as_class` (optional): class to use for resulting documents
+      - `as_class` (optional): class to use for resulting documents, a
+        :class:`~bson.lazy.LazyDocument` subclass leaves them undecoded
     """
-    response_flag = struct.unpack("<i", response[:4])[0]
+    response_flag = struct.unpack_from("<i", response)[0]
     if response_flag & 1:
         # Shouldn't get this response if we aren't doing a getMore
         assert cursor_id is not None
@@ -101,10 +104,18 @@ def _unpack_response(response, cursor_id=None, as_class=dict, tz_aware=False):
                                error_object["$err"])
 
     result = {}
-    result["cursor_id"] = struct.unpack("<q", response[4:12])[0]
-    result["starting_from"] = struct.unpack("<i", response[12:16])[0]
-    result["number_returned"] = struct.unpack("<i", response[16:20])[0]
-    result["data"] = bson.decode_all(response[20:], as_class, tz_aware)
+    (result["cursor_id"], result["starting_from"],
+     result["number_returned"]) = struct.unpack_from("<qii", response, 4)
+    # The documents are handed over as a view of the reply, the pure Python
+    # decoder makes the one str copy it walks. The C decoder only accepts str.
+    documents = buffer(response, 20)
+    if isinstance(as_class, type) and issubclass(as_class, LazyDocument):
+        result["data"] = as_class.decode_all(documents, tz_aware)
+        assert len(result["data"]) == result["number_returned"]
+        return result
+    if bson._use_c:
+        documents = str(documents)
+    result["data"] = bson.decode_all(documents, as_class, tz_aware)
     assert len(result["data"]) == result["number_returned"]
     return result
 
@@ -27,6 +27,7 @@ import struct
 
 import bson
 from bson.binary import OLD_UUID_SUBTYPE
+from bson.errors import InvalidDocument
 from bson.son import SON
 try:
     from pymongo import _cmessage
@@ -89,6 +90,59 @@ if _use_c:
     insert = _cmessage._insert_message
 
 
+def insert_batches(collection_name, docs, check_keys, safe,
+                   last_error_args, continue_on_error, uuid_subtype,
+                   max_bson_size, max_message_size):
+    """Get the **insert** messages for `docs`, split so that no message
+    is larger than `max_message_size`.
+
+    Every document is encoded (and checked against `max_bson_size`, if it
+    is set) before any message is built. Returns a list of (message,
+    number of documents) pairs, each message is a (request_id, data,
+    max_doc_size) triple like the one :func:`insert` returns. In safe
+    mode every message carries its own getLastError.
+    """
+    encoded = [bson.BSON.encode(doc, check_keys, uuid_subtype) for doc in docs]
+    if not encoded:
+        raise InvalidOperation("cannot do an empty bulk insert")
+    max_doc_size = max(map(len, encoded))
+    if max_bson_size and max_doc_size > max_bson_size:
+        raise InvalidDocument("BSON document too large (%d bytes)"
+                              " - the connected server supports"
+                              " BSON document sizes up to %d"
+                              " bytes." % (max_doc_size, max_bson_size))
+
+    options = 0
+    if continue_on_error:
+        options += 1
+    prefix = struct.pack("<i", options)
+    prefix += bson._make_c_string(collection_name)
+    room = max_message_size - 16 - len(prefix)
+
+    batches = []
+    batch = []
+    size = 0
+    for doc in encoded:
+        if batch and size + len(doc) > room:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(doc)
+        size += len(doc)
+    batches.append(batch)
+
+    messages = []
+    for batch in batches:
+        (request_id, insert_message) = __pack_message(2002,
+                                                      prefix + "".join(batch))
+        if safe:
+            (request_id, error_message, _) = __last_error(last_error_args)
+            insert_message += error_message
+        messages.append(((request_id, insert_message, max(map(len, batch))),
+                         len(batch)))
+    return messages
+
+
 def update(collection_name, upsert, multi,
            spec, doc, safe, last_error_args, check_keys, uuid_subtype):
     """Get an **update** message.
@@ -14,10 +14,17 @@
 
 import os
 import socket
+import sys
 import threading
+import time
 
 from pymongo.errors import ConnectionFailure
 
+if sys.platform.startswith('java'):
+    from select import cpython_compatible_select as select
+else:
+    from select import select
+
 have_ssl = True
 try:
     import ssl
@@ -25,29 +32,75 @@ except ImportError:
     have_ssl = False
 
 
-class Pool(threading.local):
-    """A simple connection pool.
+def _closed(sock):
+    """Return True if we know socket has been closed, False otherwise.
+    """
+    try:
+        rd, _, _ = select([sock], [], [], 0)
+    # Any exception here is equally bad (select.error, ValueError, etc.).
+    except:
+        return True
+    return len(rd) > 0
+
 
-    Uses thread-local socket per thread. By calling return_socket() a
-    thread can return a socket to the pool.
+class SocketInfo(object):
+    """A pooled socket and the databases it has been authenticated to.
     """
+    __slots__ = ["sock", "authset", "last_checkin"]
 
-    # Non thread-locals
-    __slots__ = ["pid", "host", "max_size",
-                 "net_timeout", "conn_timeout", "use_ssl", "sockets"]
+    def __init__(self, sock):
+        self.sock = sock
+        self.authset = set()
+        self.last_checkin = time.time()
 
-    # thread-local default
-    sock = None
 
-    def __init__(self, host, max_size, net_timeout, conn_timeout, use_ssl):
-        self.pid = os.getpid()
+class Pool(object):
+    """A connection pool shared by every thread.
+
+    A thread checks a socket out for the length of one operation, nested
+    checkouts by the same thread get the same socket back. Between
+    :meth:`start_request` and :meth:`end_request` a thread keeps its
+    socket, which guarantees it reads its own unacknowledged writes.
+    Outside of a request it doesn't: consecutive operations of one thread
+    can use different sockets.
+
+    At most `max_size` sockets are open at once (0 means no limit, and no
+    idle sockets are kept). Further checkouts wait up to
+    `wait_queue_timeout` seconds (forever if None) for a socket to be
+    returned. Idle sockets are closed after `max_idle_time` seconds, and
+    sockets idle for longer than `check_interval` seconds are checked with
+    :func:`_closed` before they are handed out.
+    """
+
+    check_interval = 1
+
+    def __init__(self, host, max_size, net_timeout, conn_timeout, use_ssl,
+                 wait_queue_timeout=None, max_idle_time=None):
         self.host = host
         self.max_size = max_size
         self.net_timeout = net_timeout
         self.conn_timeout = conn_timeout
         self.use_ssl = use_ssl
-        if not hasattr(self, "sockets"):
-            self.sockets = []
+        self.wait_queue_timeout = wait_queue_timeout
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Condition(threading.Lock())
+        self.closed = False
+        self.reset()
+
+    def reset(self):
+        # Sockets opened by a parent process are simply forgotten, the
+        # child must never use them.
+        self.pid = os.getpid()
+        self.sockets = []
+        self.count = 0
+        self.local = threading.local()
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'creations': 0,
+            'discards': 0,
+        }
 
     def connect(self):
         """Connect to Mongo and return a new (connected) socket.
@@ -79,46 +132,159 @@ class Pool(threading.local):
         return s
 
     def get_socket(self):
-        """Get a socket from the pool. Returns a new socket if the
-        pool is empty.
+        """Check out a socket, returns a (socket, authset) pair.
+
+        Every call must be matched by a call to :meth:`return_socket` or
+        :meth:`discard_socket`.
         """
         # We use the pid here to avoid issues with fork / multiprocessing.
         # See test.test_connection:TestConnection.test_fork for an example of
         # what could go wrong otherwise
-        pid = os.getpid()
+        if self.pid != os.getpid():
+            self.lock.acquire()
+            try:
+                if self.pid != os.getpid():
+                    self.reset()
+            finally:
+                self.lock.release()
 
-        if pid != self.pid:
-            self.sock = None
-            self.sockets = []
-            self.pid = pid
+        local = self.local
+        sock_info = getattr(local, "sock_info", None)
+        if sock_info is not None:
+            local.depth += 1
+            return sock_info.sock, sock_info.authset
 
-        if self.sock is not None and self.sock[0] == pid:
-            return (self.sock[1], self.sock[2])
+        sock_info = self.__checkout()
+        local.sock_info, local.depth = sock_info, 1
+        return sock_info.sock, sock_info.authset
 
+    def __checkout(self):
+        deadline = None
+        self.lock.acquire()
         try:
-            sock, auth = self.sockets.pop()
-            self.sock = (pid, sock, auth)
-        except IndexError:
-            self.sock = (pid, self.connect(), set())
-        return (self.sock[1], self.sock[2])
+            while True:
+                self.__evict_idle()
+                if self.sockets:
+                    sock_info = self.sockets.pop()
+                    break
+                if not self.max_size or self.count < self.max_size:
+                    self.count += 1
+                    sock_info = None
+                    break
 
-    def discard_socket(self):
-        """Close and discard the active socket.
+                if deadline is None:
+                    self.stats['waits'] += 1
+                    if self.wait_queue_timeout is not None:
+                        deadline = time.time() + self.wait_queue_timeout
+                if self.wait_queue_timeout is None:
+                    self.lock.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise ConnectionFailure("Timed out waiting for a socket "
+                                            "to %s:%d" % self.host)
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+        if sock_info is None:
+            try:
+                sock_info = SocketInfo(self.connect())
+            except:
+                self.__forget(None)
+                raise
+            self.stats['creations'] += 1
+        elif (time.time() - sock_info.last_checkin > self.check_interval and
+              _closed(sock_info.sock)):
+            self.__forget(sock_info)
+            return self.__checkout()
+
+        self.stats['checkouts'] += 1
+        return sock_info
+
+    def __evict_idle(self):
+        # Called with the lock held. The oldest sockets are at the front.
+        if self.max_idle_time is None:
+            return
+        cutoff = time.time() - self.max_idle_time
+        while self.sockets and self.sockets[0].last_checkin < cutoff:
+            self.sockets.pop(0).sock.close()
+            self.count -= 1
+            self.stats['discards'] += 1
+
+    def __forget(self, sock_info):
+        """Close a checked out socket and make room for another one.
         """
-        if self.sock:
-            self.sock[1].close()
-            self.sock = None
+        if sock_info is not None:
+            sock_info.sock.close()
+        self.lock.acquire()
+        try:
+            self.count -= 1
+            if sock_info is not None:
+                self.stats['discards'] += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def __checkin(self, sock_info):
+        if self.closed or self.pid != os.getpid() or not self.max_size:
+            self.__forget(sock_info)
+            return
+        self.lock.acquire()
+        try:
+            sock_info.last_checkin = time.time()
+            self.sockets.append(sock_info)
+            self.lock.notify()
+        finally:
+            self.lock.release()
 
     def return_socket(self):
-        """Return the socket currently in use to the pool. If the
-        pool is full the socket will be discarded.
+        """Return the socket this thread checked out to the pool.
         """
-        if self.sock is not None and self.sock[0] == os.getpid():
-            # There's a race condition here, but we deliberately
-            # ignore it.  It means that if the pool_size is 10 we
-            # might actually keep slightly more than that.
-            if len(self.sockets) < self.max_size:
-                self.sockets.append((self.sock[1], self.sock[2]))
-            else:
-                self.sock[1].close()
-        self.sock = None
+        local = self.local
+        sock_info = getattr(local, "sock_info", None)
+        if sock_info is None:
+            return
+        local.depth -= 1
+        if local.depth > 0 or getattr(local, "in_request", False):
+            return
+        local.sock_info = None
+        self.__checkin(sock_info)
+
+    def discard_socket(self):
+        """Close and discard the socket this thread checked out.
+        """
+        local = self.local
+        sock_info = getattr(local, "sock_info", None)
+        if sock_info is None:
+            return
+        local.sock_info, local.depth = None, 0
+        self.__forget(sock_info)
+
+    def start_request(self):
+        """Keep this thread's socket until :meth:`end_request`.
+        """
+        self.local.in_request = True
+
+    def end_request(self):
+        self.local.in_request = False
+        local = self.local
+        if getattr(local, "sock_info", None) is not None and local.depth <= 0:
+            sock_info, local.sock_info = local.sock_info, None
+            self.__checkin(sock_info)
+
+    def close(self):
+        """Close every idle socket, sockets that are checked out are closed
+        when they are returned.
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for sock_info in self.sockets:
+                sock_info.sock.close()
+            self.count -= len(self.sockets)
+            self.sockets = []
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
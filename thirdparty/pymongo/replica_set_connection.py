@@ -56,26 +56,9 @@ from pymongo.errors import (AutoReconnect,
                             OperationFailure)
 
 
-if sys.platform.startswith('java'):
-    from select import cpython_compatible_select as select
-else:
-    from select import select
-
-
 MAX_BSON_SIZE = 4 * 1024 * 1024
 
 
-def _closed(sock):
-    """Return True if we know socket has been closed, False otherwise.
-    """
-    try:
-        readers, _, _ = select([sock], [], [], 0)
-    # Any exception here is equally bad (select.error, ValueError, etc.).
-    except Exception:
-        return True
-    return len(readers) > 0
-
-
 def _partition_node(node):
     """Split a host:port string returned from mongod/s into
     a (host, int(port)) pair needed for socket.connect().
@@ -140,8 +123,8 @@ class ReplicaSetConnection(common.BaseObject):
             pairs. If a host is an IPv6 literal it must be enclosed in '[' and
             ']' characters following the RFC2732 URL syntax (e.g. '[::1]' for
             localhost)
-          - `max_pool_size` (optional): The maximum size limit for
-            each connection pool.
+          - `max_pool_size` (optional): The maximum number of sockets
+            each connection pool will open, 0 for no limit.
           - `document_class` (optional): default class to use for
             documents returned from queries on this connection
           - `tz_aware` (optional): if ``True``,
@@ -173,12 +156,24 @@ class ReplicaSetConnection(common.BaseObject):
             before timing out.
           - `connectTimeoutMS`: How long a connection can take to be opened
             before timing out.
+          - `waitQueueTimeoutMS`: How long a thread will wait for a socket
+            when `max_pool_size` sockets to a member are already checked
+            out before raising :class:`~pymongo.errors.ConnectionFailure`.
+            Defaults to two minutes.
+          - `maxIdleTimeMS`: Close pooled sockets that have been idle for
+            this long.
           - `ssl`: If True, create the connection to the servers using SSL.
           - `read_preference`: The read preference for this connection.
             See :class:`~pymongo.ReadPreference` for available options.
           - `slave_okay` or `slaveOk` (deprecated): Use `read_preference`
             instead.
 
+        .. warning:: Sockets are shared by every thread rather than pinned
+           to one. An unsafe write and a read that follows it in the same
+           thread may go out on different sockets, so the read can miss the
+           write. Use safe writes, or :meth:`start_request` when a thread
+           has to read its own unsafe writes.
+
         .. versionadded:: 2.1
         """
         self.__max_pool_size = max_pool_size
@@ -217,6 +212,9 @@ class ReplicaSetConnection(common.BaseObject):
                                      "keyword parameter is required.")
         self.__net_timeout = self.__opts.get('sockettimeoutms')
         self.__conn_timeout = self.__opts.get('connecttimeoutms')
+        self.__wait_queue_timeout = self.__opts.get('waitqueuetimeoutms',
+                                                    common.WAIT_QUEUE_TIMEOUT)
+        self.__max_idle_time = self.__opts.get('maxidletimems')
         self.__use_ssl = self.__opts.get('ssl', False)
         if self.__use_ssl and not pool.have_ssl:
             raise ConfigurationError("The ssl module is not available. If you "
@@ -417,6 +415,18 @@ class ReplicaSetConnection(common.BaseObject):
             return self.__pools[self.__writer]['max_bson_size']
         return 0
 
+    @property
+    def max_message_size(self):
+        """Returns the maximum size message the connected primary accepts
+        in bytes. Defaults to 48MB for servers that don't report it.
+        Returns 0 if no primary is available.
+
+        .. versionadded:: 2.1+
+        """
+        if self.__writer:
+            return self.__pools[self.__writer]['max_message_size']
+        return 0
+
     def __simple_command(self, sock, dbname, spec):
         """Send a command to the server.
         """
@@ -446,31 +456,51 @@ class ReplicaSetConnection(common.BaseObject):
         """
         mongo = pool.Pool(host, self.__max_pool_size,
                           self.__net_timeout, self.__conn_timeout,
-                          self.__use_ssl)
+                          self.__use_ssl, self.__wait_queue_timeout,
+                          self.__max_idle_time)
         sock = mongo.get_socket()[0]
-        response = self.__simple_command(sock, 'admin', {'ismaster': 1})
+        try:
+            response = self.__simple_command(sock, 'admin', {'ismaster': 1})
+        except:
+            mongo.discard_socket()
+            raise
+        mongo.return_socket()
         return response, mongo
 
+    def __pooled_is_master(self, mongo):
+        """Call ismaster on a socket from an existing pool. The socket
+        always goes back to the pool, or is discarded if it failed.
+        """
+        sock = self.__socket(mongo)
+        try:
+            response = self.__simple_command(sock, 'admin', {'ismaster': 1})
+        except (ConnectionFailure, socket.error):
+            mongo['pool'].discard_socket()
+            raise
+        except:
+            mongo['pool'].return_socket()
+            raise
+        mongo['pool'].return_socket()
+        return response
+
     def __update_pools(self):
         """Update the mapping of (host, port) pairs to connection pools.
         """
         secondaries = []
         for host in self.__hosts:
-            mongo = None
             try:
                 if host in self.__pools:
-                    mongo = self.__pools[host]
-                    sock = self.__socket(mongo)
-                    res = self.__simple_command(sock, 'admin', {'ismaster': 1})
+                    res = self.__pooled_is_master(self.__pools[host])
                 else:
                     res, conn = self.__is_master(host)
                     bson_max = res.get('maxBsonObjectSize', MAX_BSON_SIZE)
+                    message_max = res.get('maxMessageSizeBytes',
+                                          common.MAX_MESSAGE_SIZE)
                     self.__pools[host] = {'pool': conn,
                                           'last_checkout': time.time(),
-                                          'max_bson_size': bson_max}
+                                          'max_bson_size': bson_max,
+                                          'max_message_size': message_max}
             except (ConnectionFailure, socket.error):
-                if mongo:
-                    mongo['pool'].discard_socket()
                 continue
             # Only use hosts that are currently in 'secondary' state
             # as readers.
@@ -490,13 +520,9 @@ class ReplicaSetConnection(common.BaseObject):
         hosts = set()
 
         for node in nodes:
-            mongo = None
             try:
                 if node in self.__pools:
-                    mongo = self.__pools[node]
-                    sock = self.__socket(mongo)
-                    response = self.__simple_command(sock, 'admin',
-                                                     {'ismaster': 1})
+                    response = self.__pooled_is_master(self.__pools[node])
                 else:
                     response, conn = self.__is_master(node)
 
@@ -520,8 +546,6 @@ class ReplicaSetConnection(common.BaseObject):
                     hosts.update([_partition_node(h)
                                   for h in response["passives"]])
             except (ConnectionFailure, socket.error), why:
-                if mongo:
-                    mongo['pool'].discard_socket()
                 errors.append("%s:%d: %s" % (node[0], node[1], str(why)))
             if hosts:
                 self.__hosts = hosts
@@ -537,20 +561,18 @@ class ReplicaSetConnection(common.BaseObject):
         """Checks if this host is the primary for the replica set.
         """
         try:
-            mongo = None
             if host in self.__pools:
-                mongo = self.__pools[host]
-                sock = self.__socket(mongo)
-                res = self.__simple_command(sock, 'admin', {'ismaster': 1})
+                res = self.__pooled_is_master(self.__pools[host])
             else:
                 res, conn = self.__is_master(host)
                 bson_max = res.get('maxBsonObjectSize', MAX_BSON_SIZE)
+                message_max = res.get('maxMessageSizeBytes',
+                                      common.MAX_MESSAGE_SIZE)
                 self.__pools[host] = {'pool': conn,
                                       'last_checkout': time.time(),
-                                      'max_bson_size': bson_max}
+                                      'max_bson_size': bson_max,
+                                      'max_message_size': message_max}
         except (ConnectionFailure, socket.error), why:
-            if mongo:
-                mongo['pool'].discard_socket()
             raise ConnectionFailure("%s:%d: %s" % (host[0], host[1], str(why)))
 
         if res["ismaster"]:
@@ -585,32 +607,44 @@ class ReplicaSetConnection(common.BaseObject):
         raise AutoReconnect(', '.join(errors))
 
     def __socket(self, mongo):
-        """Get a socket from the pool.
+        """Check a socket out of the pool.
 
-        If it's been > 1 second since the last time we checked out a
-        socket, we also check to see if the socket has been closed -
-        this let's us avoid seeing *some*
+        The pool checks that sockets which have been idle for a while are
+        still open, this let's us avoid seeing *some*
         :class:`~pymongo.errors.AutoReconnect` exceptions on server
-        hiccups, etc. We only do this if it's been > 1 second since
-        the last socket checkout, to keep performance reasonable - we
-        can't avoid those completely anyway.
+        hiccups, etc. Every checkout has to be matched by a
+        ``return_socket()`` or ``discard_socket()`` on the pool.
         """
         sock, authset = mongo['pool'].get_socket()
-
-        now = time.time()
-        if now - mongo['last_checkout'] > 1:
-            if _closed(sock):
-                mongo['pool'] = pool.Pool(mongo['pool'].host,
-                                          self.__max_pool_size,
-                                          self.__net_timeout,
-                                          self.__conn_timeout,
-                                          self.__use_ssl)
-                sock, authset = mongo['pool'].get_socket()
-        mongo['last_checkout'] = now
+        mongo['last_checkout'] = time.time()
         if self.__auth_credentials or authset:
-            self.__check_auth(sock, authset)
+            try:
+                self.__check_auth(sock, authset)
+            except:
+                mongo['pool'].discard_socket()
+                raise
         return sock
 
+    def start_request(self):
+        """Keep using the same socket to the primary in this thread until
+        :meth:`end_request` is called.
+
+        Sockets are shared by every thread and only checked out for one
+        operation at a time. A thread that needs to read its own unsafe
+        writes should do so inside a request.
+
+        .. versionadded:: 2.1+
+        """
+        self.__find_primary()['pool'].start_request()
+
+    def end_request(self):
+        """Allow this thread's sockets to return to their pools.
+
+        .. versionadded:: 2.1+
+        """
+        for mongo in self.__pools.values():
+            mongo['pool'].end_request()
+
     def disconnect(self):
         """Disconnect from the replica set primary.
         """
@@ -620,7 +654,9 @@ class ReplicaSetConnection(common.BaseObject):
         """Disconnect from all set members.
         """
         self.__writer = None
-        self.__pools = {}
+        pools, self.__pools = self.__pools, {}
+        for mongo in pools.values():
+            mongo['pool'].close()
 
     def __check_response_to_last_error(self, response):
         """Check a response to a lastError message for errors.
@@ -655,17 +691,19 @@ class ReplicaSetConnection(common.BaseObject):
     def __recv_data(self, length, sock):
         """Lowest level receive operation.
 
-        Takes length to receive and repeatedly calls recv until able to
-        return a buffer of that length, raising ConnectionFailure on error.
+        Takes length to receive and repeatedly calls recv_into until it has
+        filled a :class:`bytearray` of that length, raising
+        ConnectionFailure on error.
         """
-        chunks = []
-        while length:
-            chunk = sock.recv(length)
-            if chunk == "":
+        message = bytearray(length)
+        view = memoryview(message)
+        received = 0
+        while received < length:
+            chunk_length = sock.recv_into(view[received:])
+            if not chunk_length:
                 raise ConnectionFailure("connection closed")
-            length -= len(chunk)
-            chunks.append(chunk)
-        return "".join(chunks)
+            received += chunk_length
+        return message
 
     def __recv_msg(self, operation, request_id, sock):
         """Receive a message in response to `request_id` on `sock`.
@@ -673,11 +711,10 @@ class ReplicaSetConnection(common.BaseObject):
         Returns the response data with the header removed.
         """
         header = self.__recv_data(16, sock)
-        length = struct.unpack("<i", header[:4])[0]
-        resp_id = struct.unpack("<i", header[8:12])[0]
+        length, _, resp_id, op_code = struct.unpack_from("<iiii", header)
         assert resp_id == request_id, "ids don't match %r %r" % (resp_id,
                                                                  request_id)
-        assert operation == struct.unpack("<i", header[12:])[0]
+        assert operation == op_code
 
         return self.__recv_data(length - 16, sock)
 
@@ -727,10 +764,9 @@ class ReplicaSetConnection(common.BaseObject):
             # message and send both. We then get the response (to the
             # lastError) and raise OperationFailure if it is an error
             # response.
+            response = None
             if safe:
                 response = self.__recv_msg(1, rqst_id, sock)
-                return self.__check_response_to_last_error(response)
-            return None
         except(ConnectionFailure, socket.error), why:
             mongo['pool'].discard_socket()
             if _connection_to_use in (None, -1):
@@ -741,6 +777,9 @@ class ReplicaSetConnection(common.BaseObject):
             raise
 
         mongo['pool'].return_socket()
+        if safe:
+            return self.__check_response_to_last_error(response)
+        return None
 
     def __send_and_receive(self, mongo, msg, **kwargs):
         """Send a message on the given socket and return the response data.